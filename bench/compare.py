@@ -0,0 +1,69 @@
+"""
+Compare two bench.load reports.
+
+For each workload in both, prints the baseline and candidate ops/sec and p50/p95/p99
+latency with the change in percent, as JSON. Exits with status 1 if any workload's
+throughput dropped or p99 rose by more than --threshold percent.
+
+    python -m bench.compare baseline.json candidate.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+# Metrics compared, and whether a higher value is better
+METRICS = [
+    ("ops_per_s", lambda result: result["ops_per_s"], True),
+    ("p50_ms", lambda result: result["latency_ms"]["p50"], False),
+    ("p95_ms", lambda result: result["latency_ms"]["p95"], False),
+    ("p99_ms", lambda result: result["latency_ms"]["p99"], False),
+    ("errors", lambda result: result["errors"], False),
+    ("server_peak_rss_mb", lambda result: result["server_peak_rss_mb"], False),
+]
+
+# Metrics whose change beyond the threshold counts as a regression
+GATED = {"ops_per_s", "p99_ms"}
+
+
+def change_pct(baseline, candidate):
+    if baseline is None or candidate is None or baseline == 0:
+        return None
+    return round((candidate / baseline - 1) * 100, 2)
+
+
+def compare(baseline, candidate, threshold):
+    workloads = {}
+    regressions = []
+    for name in baseline["workloads"].keys() & candidate["workloads"].keys():
+        rows = {}
+        for metric, value, higher_is_better in METRICS:
+            before = value(baseline["workloads"][name])
+            after = value(candidate["workloads"][name])
+            change = change_pct(before, after)
+            rows[metric] = {"baseline": before, "candidate": after, "change_pct": change}
+            if metric in GATED and change is not None:
+                worse = -change if higher_is_better else change
+                if worse > threshold:
+                    regressions.append(f"{name}.{metric}")
+        workloads[name] = rows
+    return {"workloads": dict(sorted(workloads.items())), "regressions": sorted(regressions)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline, open(args.candidate) as candidate:
+        baseline, candidate = json.load(baseline), json.load(candidate)
+    if baseline["config"] != candidate["config"]:
+        print("Warning: the runs were made with different settings", file=sys.stderr)
+    result = compare(baseline, candidate, args.threshold)
+    print(json.dumps({"benchmark": "compare", **result}, indent=2))
+    sys.exit(1 if result["regressions"] else 0)
+
+
+if __name__ == "__main__":
+    main()
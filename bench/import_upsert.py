@@ -0,0 +1,90 @@
+"""
+CSV import benchmark: chunked set-based upsert vs. the old row-at-a-time loop.
+
+Both importers load the same generated rows into an empty accounts table, half of
+which already exist so updates and inserts are mixed. The row-at-a-time loop is slow,
+so it runs on a smaller sample (--legacy-rows) and is compared by rows/sec.
+
+    python -m bench.import_upsert --rows 1000000 --legacy-rows 20000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine, delete, insert, select
+from sqlalchemy.orm import sessionmaker
+
+from sbs.main import _import_rows
+from sbs.models import Account, Base
+
+
+def generate_rows(count):
+    return [
+        {"account_id": str(uuid.uuid4()), "name": f"Account {i}", "balance_cents": i % 1000000 + 25}
+        for i in range(count)
+    ]
+
+
+def prepare(session_factory, rows):
+    # Start from a table that already holds every other row, so the import updates half
+    with session_factory() as db:
+        db.execute(delete(Account))
+        db.execute(insert(Account), [
+            {"account_id": row["account_id"], "name": "Old", "balance_cents": 0} for row in rows[::2]
+        ])
+        db.commit()
+
+
+def legacy_import(db, rows):
+    # The original /load loop: one SELECT per row, then an ORM add or update
+    with db.begin():
+        for row in rows:
+            stmt = select(Account).where(Account.account_id == row["account_id"])
+            account = db.execute(stmt).scalar_one_or_none()
+            if not account:
+                db.add(Account(account_id=row["account_id"], name=row["name"], balance_cents=row["balance_cents"]))
+            else:
+                account.name = row["name"]
+                account.balance_cents = row["balance_cents"]
+
+
+def timed(session_factory, rows, importer):
+    prepare(session_factory, rows)
+    with session_factory() as db:
+        started = time.perf_counter()
+        importer(db, rows)
+        elapsed = time.perf_counter() - started
+    return {"rows": len(rows), "seconds": round(elapsed, 3), "rows_per_s": round(len(rows) / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Database URL (default: a temporary SQLite file)")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--legacy-rows", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    rows = generate_rows(args.rows)
+    chunked = timed(session_factory, rows, lambda db, rows: _import_rows(db, rows, args.chunk_size))
+    legacy = timed(session_factory, rows[:args.legacy_rows], legacy_import)
+
+    print(json.dumps({
+        "benchmark": "import_upsert",
+        "chunk_size": args.chunk_size,
+        "chunked": chunked,
+        "row_at_a_time": legacy,
+        "speedup": round(chunked["rows_per_s"] / legacy["rows_per_s"], 1),
+    }))
+
+
+if __name__ == "__main__":
+    main()
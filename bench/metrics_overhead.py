@@ -0,0 +1,99 @@
+"""
+Overhead of the request and database metrics.
+
+Sends the same requests through an app built without metrics and one built with them
+(the middleware plus the statement timing listeners), alternating in rounds so drift in
+the machine's speed hits both alike. Reports mean and p50 latency per request for each,
+and the instrumented app's overhead in percent.
+
+    python -m bench.metrics_overhead --requests 2000 --rounds 5
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from sbs.main import account_cache, create_app, get_db
+from sbs.metrics import track_queries, untrack_queries
+from sbs.models import Account, Base
+
+
+def build_client(session_factory, metrics):
+    def override_get_db():
+        with session_factory() as db:
+            yield db
+
+    app = create_app("sync", metrics=metrics)
+    app.dependency_overrides[get_db] = override_get_db
+    return TestClient(app)  # Without startup: the tables are created below
+
+
+def run_round(client, account_ids, requests):
+    samples = []
+    for i in range(requests):
+        account_id = account_ids[i % len(account_ids)]
+        started = time.perf_counter()
+        if i % 2:
+            response = client.put(f"/accounts/{account_id}/deposit", params={"amount": "1.00"})
+        else:
+            response = client.get(f"/accounts/{account_id}")
+        samples.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.text
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Database URL (default: a temporary SQLite file)")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per round and app")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    account_ids = [str(uuid.uuid4()) for _ in range(100)]
+    with session_factory() as db:
+        db.execute(insert(Account), [
+            {"account_id": account_id, "name": "Bench", "balance_cents": 0} for account_id in account_ids
+        ])
+        db.commit()
+    account_cache.maxsize = 0  # Every GET reads the database
+
+    plain = build_client(session_factory, metrics=False)
+    instrumented = build_client(session_factory, metrics=True)
+    for client in (plain, instrumented):
+        run_round(client, account_ids, min(args.requests, 200))  # Warm up both before measuring
+
+    samples = {"plain": [], "instrumented": []}
+    for _ in range(args.rounds):
+        untrack_queries()
+        samples["plain"].extend(run_round(plain, account_ids, args.requests))
+        track_queries()
+        samples["instrumented"].extend(run_round(instrumented, account_ids, args.requests))
+
+    results = {
+        name: {
+            "requests": len(values),
+            "mean_us": round(statistics.fmean(values) * 1e6, 1),
+            "p50_us": round(statistics.median(values) * 1e6, 1),
+        }
+        for name, values in samples.items()
+    }
+    print(json.dumps({
+        "benchmark": "metrics_overhead",
+        **results,
+        "overhead_pct": round((results["instrumented"]["mean_us"] / results["plain"]["mean_us"] - 1) * 100, 2),
+    }))
+
+
+if __name__ == "__main__":
+    main()
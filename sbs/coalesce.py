@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+from sqlalchemy.util import await_only
+
+from sbs.db import pause
+
+
+class _ThreadWaiter:
+    """Blocks a threadpool worker until its batch is done."""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def set(self):
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+
+
+class _LoopWaiter:
+    """Suspends a request's greenlet on the event loop until its batch is done."""
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    def set(self):
+        self._loop.call_soon_threadsafe(self._resolve)
+
+    def wait(self):
+        await_only(self._future)
+
+
+class _Batch:
+    __slots__ = ("items", "waiters", "results", "error")
+
+    def __init__(self):
+        self.items = []
+        self.waiters = []
+        self.results = None
+        self.error = None
+
+
+class Coalescer:
+    """
+    Combines calls for the same key that arrive within window seconds into one apply().
+
+    The first caller for a key leads the batch: it waits window seconds while others join,
+    then runs apply(db, key, items) on its own session and each caller gets the result at
+    its position in the returned list. A batch stops taking items at max_batch; the next
+    caller starts a new one. If apply raises, every caller in the batch gets the exception.
+
+    Callers that joined wait the way their session allows: on an Event in sync mode, and
+    on a future from the request's greenlet in async mode, so the event loop keeps running.
+    """
+
+    def __init__(self, window, max_batch, apply):
+        self.window = window
+        self.max_batch = max_batch
+        self.apply = apply
+        self._open = {}  # key -> batch still taking items
+        self._lock = threading.Lock()
+
+    def submit(self, db, key, item):
+        """Add item to key's batch, wait for the batch to be applied and return item's result."""
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch:
+                del self._open[key]
+            if not leader:
+                waiter = _LoopWaiter() if db.get_bind().dialect.is_async else _ThreadWaiter()
+                batch.waiters.append(waiter)
+
+        if not leader:
+            waiter.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.results[index]
+
+        try:
+            pause(db, self.window)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            batch.results = self.apply(db, key, list(batch.items))
+        except BaseException as exc:
+            batch.error = exc
+            raise
+        finally:
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]  # The leader failed before closing the batch
+                waiters = list(batch.waiters)
+            for waiter in waiters:
+                waiter.set()
+        return batch.results[index]
@@ -0,0 +1,107 @@
+import os
+import tempfile
+
+from sqlalchemy.engine import make_url
+
+DATABASE_URL = os.getenv(
+    "DATABASE_URL", "postgresql://postgres:postgres@db:5432/simple_banking_system"
+)
+
+
+def _env_flag(name, default):
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+# Connection pool per engine: connections kept open, extra ones allowed under load, seconds
+# to wait for a free connection, and seconds after which a connection is replaced
+POOL_SIZE = int(os.getenv("SBS_POOL_SIZE", "5"))
+POOL_MAX_OVERFLOW = int(os.getenv("SBS_POOL_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("SBS_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.getenv("SBS_POOL_RECYCLE", "1800"))
+# Test each connection with a round trip when it is checked out, to skip ones the server dropped
+POOL_PRE_PING = _env_flag("SBS_POOL_PRE_PING", "false")
+
+# Milliseconds a PostgreSQL statement may run before the server cancels it (0 = no limit)
+STATEMENT_TIMEOUT_MS = int(os.getenv("SBS_STATEMENT_TIMEOUT_MS", "0"))
+
+# Connecting through PgBouncer in transaction pooling mode: no prepared statements or
+# connection-level settings, which don't survive the server connection changing
+PGBOUNCER = _env_flag("SBS_PGBOUNCER", "false")
+
+# Drivers that can only be used through SQLAlchemy's asyncio extension
+ASYNC_DRIVERS = {"asyncpg", "aiosqlite", "psycopg_async"}
+
+# "sync" serves requests from Starlette's threadpool, "async" serves them from the
+# event loop through an AsyncSession. Defaults to whatever the DATABASE_URL driver implies.
+DB_MODE = os.getenv("SBS_DB_MODE") or (
+    "async" if make_url(DATABASE_URL).get_driver_name() in ASYNC_DRIVERS else "sync"
+)
+
+# Comma separated URLs of read replicas serving GET /accounts, GET /accounts/{account_id} and
+# /save; a replica that fails to connect is skipped for SBS_REPLICA_RETRY_INTERVAL seconds
+REPLICA_URLS = [url.strip() for url in os.getenv("SBS_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_RETRY_INTERVAL = float(os.getenv("SBS_REPLICA_RETRY_INTERVAL", "5"))
+
+# Seconds a client that wrote keeps reading from the primary, so it sees its own writes (0 = off)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("SBS_READ_YOUR_WRITES_SECONDS", "0"))
+
+# Deposits to one account arriving within this many milliseconds are applied with a single
+# UPDATE and commit (0 = off), up to this many per batch
+DEPOSIT_COALESCE_WINDOW_MS = float(os.getenv("SBS_DEPOSIT_COALESCE_WINDOW_MS", "0"))
+DEPOSIT_COALESCE_MAX_BATCH = int(os.getenv("SBS_DEPOSIT_COALESCE_MAX_BATCH", "1000"))
+
+# Rows each GET /stats counter is spread over, so concurrent writes rarely update the same
+# one, and seconds between full scans that check (and correct) the counters
+STATS_STRIPES = int(os.getenv("SBS_STATS_STRIPES", "16"))
+STATS_RECONCILE_INTERVAL = float(os.getenv("SBS_STATS_RECONCILE_INTERVAL", "3600"))
+
+# Largest number of transfers accepted by POST /transfers/batch in one request
+BATCH_TRANSFER_MAX_ITEMS = int(os.getenv("SBS_BATCH_TRANSFER_MAX_ITEMS", "10000"))
+
+# Largest number of account IDs POST /accounts/lookup resolves in one request
+LOOKUP_MAX_IDS = int(os.getenv("SBS_LOOKUP_MAX_IDS", "1000"))
+
+# Largest number of accounts accepted by POST /accounts/batch in one request
+BATCH_CREATE_MAX_ITEMS = int(os.getenv("SBS_BATCH_CREATE_MAX_ITEMS", "10000"))
+
+# Rows fetched from the server-side cursor, and written out, per /save chunk
+EXPORT_BATCH_SIZE = int(os.getenv("SBS_EXPORT_BATCH_SIZE", "1000"))
+
+# Most key ranges one export may read at once. It takes a connection per range plus one
+# holding the snapshot, so by default the most the pool can open without running dry
+EXPORT_MAX_PARALLELISM = int(os.getenv(
+    "SBS_EXPORT_MAX_PARALLELISM", str(max(1, POOL_SIZE + POOL_MAX_OVERFLOW - 1))
+))
+
+# Key ranges /save reads at once, each on a pooled connection of its own, under one
+# snapshot (1 = one cursor); PostgreSQL in sync mode only, other setups read serially
+EXPORT_PARALLELISM = min(int(os.getenv("SBS_EXPORT_PARALLELISM", "1")), EXPORT_MAX_PARALLELISM)
+
+# Seconds a /save checkpoint is set back from when the export started, so a later
+# GET /save?since= also sends changes whose transactions were still running then
+CHECKPOINT_OVERLAP_SECONDS = float(os.getenv("SBS_CHECKPOINT_OVERLAP_SECONDS", "60"))
+
+# Rows upserted per statement batch and transaction by /load
+IMPORT_CHUNK_SIZE = int(os.getenv("SBS_IMPORT_CHUNK_SIZE", "5000"))
+
+# Bytes of the uploaded file /load reads and decodes at a time
+IMPORT_BUFFER_SIZE = int(os.getenv("SBS_IMPORT_BUFFER_SIZE", str(64 * 1024)))
+
+# Longest line /load accepts, in bytes; a longer one stops the import rather than be buffered
+IMPORT_MAX_LINE_BYTES = int(os.getenv("SBS_IMPORT_MAX_LINE_BYTES", str(1024 * 1024)))
+
+# Worker threads for background import/export jobs, and where their files are kept
+JOB_WORKERS = int(os.getenv("SBS_JOB_WORKERS", "2"))
+JOB_DIR = os.getenv("SBS_JOB_DIR", os.path.join(tempfile.gettempdir(), "sbs-jobs"))
+
+# Entries kept by the in-process account cache (0 disables it), and seconds each stays valid
+ACCOUNT_CACHE_SIZE = int(os.getenv("SBS_ACCOUNT_CACHE_SIZE", "10000"))
+ACCOUNT_CACHE_TTL = float(os.getenv("SBS_ACCOUNT_CACHE_TTL", "60"))
+
+# Seconds an Idempotency-Key is remembered, and keys kept by its in-process front cache
+IDEMPOTENCY_TTL = float(os.getenv("SBS_IDEMPOTENCY_TTL", str(24 * 60 * 60)))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("SBS_IDEMPOTENCY_CACHE_SIZE", "10000"))
+
+# Seconds between background prunes of expired idempotency keys, and rows deleted per batch
+IDEMPOTENCY_PRUNE_INTERVAL = float(os.getenv("SBS_IDEMPOTENCY_PRUNE_INTERVAL", "300"))
+IDEMPOTENCY_PRUNE_BATCH_SIZE = int(os.getenv("SBS_IDEMPOTENCY_PRUNE_BATCH_SIZE", "1000"))
@@ -1,12 +1,155 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import asyncio
+import time
+import uuid
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from fastapi import Depends, Request
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.util import await_only, greenlet_spawn
+from starlette.concurrency import run_in_threadpool
+
+from sbs.config import (
+    DATABASE_URL, DB_MODE, PGBOUNCER, POOL_MAX_OVERFLOW, POOL_PRE_PING, POOL_RECYCLE, POOL_SIZE,
+    POOL_TIMEOUT, REPLICA_RETRY_INTERVAL, REPLICA_URLS, STATEMENT_TIMEOUT_MS,
+)
+from sbs.metrics import REGISTRY
+from sbs.replicas import ReplicaSet, pinned_to_primary
+
+# Driver to use for each backend when talking to it synchronously / asynchronously
+SYNC_DRIVERS = {"postgresql": "psycopg2", "sqlite": "pysqlite"}
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+
+def _with_driver(url, drivers):
+    url = make_url(url)
+    driver = drivers.get(url.get_backend_name())
+    if driver is None:
+        return url
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}")
+
+
+def sync_url(url):
+    return _with_driver(url, SYNC_DRIVERS)
+
+
+def async_url(url):
+    return _with_driver(url, ASYNC_DRIVERS)
+
+
+POOL_CHECKOUT_SECONDS = REGISTRY.histogram(
+    "sbs_db_pool_checkout_seconds",
+    "Time taken to get a connection from the pool, including waiting for one and opening it",
+    ["engine"],
+)
+POOL_CONNECTIONS_IN_USE = REGISTRY.gauge(
+    "sbs_db_pool_connections_in_use", "Connections currently checked out of the pool", ["engine"]
+)
+POOL_CONNECTIONS_OPENED = REGISTRY.counter(
+    "sbs_db_pool_connections_opened_total", "Database connections opened by the pool", ["engine"]
+)
+
+
+def timed_pool(pool_class, label):
+    """Subclass pool_class so every checkout is timed in POOL_CHECKOUT_SECONDS."""
+    class TimedPool(pool_class):
+        def connect(self):
+            started = time.perf_counter()
+            try:
+                return super().connect()
+            finally:
+                POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started, engine=label)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+
+def engine_options(url, mode):
+    """
+    Keyword arguments for create_engine, or create_async_engine in "async" mode, from the
+    SBS_POOL_* settings, SBS_STATEMENT_TIMEOUT_MS and SBS_PGBOUNCER.
+    """
+    backend = make_url(url).get_backend_name()
+    options = {"pool_pre_ping": POOL_PRE_PING}
+    connect_args = {}
+
+    if backend != "sqlite":  # SQLite picks a pool to suit the database file
+        options.update(
+            poolclass=timed_pool(AsyncAdaptedQueuePool if mode == "async" else QueuePool, mode),
+            pool_size=POOL_SIZE,
+            max_overflow=POOL_MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+            pool_recycle=POOL_RECYCLE,
+        )
+
+    if backend == "postgresql":
+        if PGBOUNCER and mode == "async":
+            # asyncpg prepares every statement, and PgBouncer may run the next one on a server
+            # connection that never saw it; unique names keep leftovers from clashing
+            connect_args.update(
+                statement_cache_size=0,
+                prepared_statement_cache_size=0,
+                prepared_statement_name_func=lambda: f"__asyncpg_{uuid.uuid4()}__",
+            )
+        if STATEMENT_TIMEOUT_MS and not PGBOUNCER:
+            # Set once per connection as a startup parameter, which PgBouncer doesn't pass on
+            if mode == "async":
+                connect_args["server_settings"] = {"statement_timeout": str(STATEMENT_TIMEOUT_MS)}
+            else:
+                connect_args["options"] = f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"
+
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+
+def instrument(engine, label):
+    """Count the engine's opened and checked out connections, and apply per-transaction settings."""
+    engine = getattr(engine, "sync_engine", engine)
+
+    event.listen(engine, "connect", lambda dbapi_connection, record: POOL_CONNECTIONS_OPENED.inc(engine=label))
+    event.listen(engine, "checkout", lambda *args: POOL_CONNECTIONS_IN_USE.inc(engine=label))
+    event.listen(engine, "checkin", lambda *args: POOL_CONNECTIONS_IN_USE.dec(engine=label))
+
+    if STATEMENT_TIMEOUT_MS and PGBOUNCER and engine.dialect.name == "postgresql":
+        # Behind PgBouncer a setting only sticks for the transaction it is made in
+        @event.listens_for(engine, "begin")
+        def set_statement_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {STATEMENT_TIMEOUT_MS}")
 
-DATABASE_URL = "postgresql://postgres:postgres@db:5432/simple_banking_system"
 
 # Create synchronous engine and session
-engine = create_engine(DATABASE_URL)
+engine = create_engine(sync_url(DATABASE_URL), **engine_options(DATABASE_URL, "sync"))
+instrument(engine, "sync")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Create async engine and session, only when the app is configured to use them
+if DB_MODE == "async":
+    async_engine = create_async_engine(async_url(DATABASE_URL), **engine_options(DATABASE_URL, "async"))
+    instrument(async_engine, "async")
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False)
+else:
+    async_engine = None
+    AsyncSessionLocal = None
+
+
+# Read replicas, for the engine type of the app's mode; pre-ping catches one that went away
+if DB_MODE == "async":
+    read_replicas = ReplicaSet([
+        create_async_engine(async_url(url), **dict(engine_options(url, "async"), pool_pre_ping=True))
+        for url in REPLICA_URLS
+    ], REPLICA_RETRY_INTERVAL)
+else:
+    read_replicas = ReplicaSet([
+        create_engine(sync_url(url), **dict(engine_options(url, "sync"), pool_pre_ping=True))
+        for url in REPLICA_URLS
+    ], REPLICA_RETRY_INTERVAL)
+for index, replica in enumerate(read_replicas.engines):
+    instrument(replica, f"replica{index}")
+
 
 # Dependency to get a database session
 def get_db():
@@ -17,24 +160,115 @@ def get_db():
         db.close()
 
 
-# from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-# from sqlalchemy.orm import sessionmaker
-# from sqlalchemy.future import select
-#
-# DATABASE_URL = "postgresql+asyncpg://postgres:postgres@db:5432/simple_banking_system"
-#
-# # Create async engine and session
-# async_engine = create_async_engine(DATABASE_URL, echo=True)
-# SessionLocal = sessionmaker(
-#     autocommit=False, autoflush=False, bind=engine, class_=AsyncSession
-# )
-# #Async_Session = sessionmaker(async_engine, expire_on_commit=False, class_=AsyncSession)
-#
-#
-# # Dependency to get a database session
-# async def get_db():
-#     async with Async_Session() as db:
-#         try:
-#             yield db
-#         except:
-#             await db.close()
+# Dependency to get an async database session
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Dependency to get a session for endpoints that only read: a replica when there is a healthy
+# one, else the primary session. Never use it for endpoints that write.
+def get_read_db(request: Request, db=Depends(get_db)):
+    if read_replicas and not pinned_to_primary(request):
+        for replica in read_replicas.candidates():
+            session = Session(bind=replica, autoflush=False, info={"replica": True})
+            try:
+                session.connection()  # Connect now, so a replica that is down can be skipped
+            except DBAPIError:
+                session.close()
+                read_replicas.mark_down(replica)
+                continue
+            try:
+                yield session
+            finally:
+                session.close()
+            return
+    yield db
+
+
+# Async counterpart of get_read_db
+async def get_async_read_db(request: Request, db=Depends(get_async_db)):
+    if read_replicas and not pinned_to_primary(request):
+        for replica in read_replicas.candidates():
+            session = AsyncSession(bind=replica, autoflush=False, info={"replica": True})
+            try:
+                await session.connection()
+            except DBAPIError:
+                await session.close()
+                read_replicas.mark_down(replica)
+                continue
+            try:
+                yield session
+            finally:
+                await session.close()
+            return
+    yield db
+
+
+def from_replica(db):
+    """Whether get_read_db handed out a replica session, which may lag the primary."""
+    return db.info.get("replica", False)
+
+
+def pause(db, seconds):
+    """Sleep between retries without blocking the event loop when db runs in async mode."""
+    if db.get_bind().dialect.is_async:
+        await_only(asyncio.sleep(seconds))
+    else:
+        time.sleep(seconds)
+
+
+class StreamBody:
+    """
+    Body for a StreamingResponse produced by a sync generator that reads from bind.
+
+    Starlette resumes sync iterators on the threadpool, which is what a sync engine needs.
+    A generator reading through an async engine has to be resumed inside a greenlet on the
+    event loop instead, the same way AsyncSession.run_sync drives a sync Session.
+    """
+
+    def __init__(self, bind, iterator):
+        self.bind = bind
+        self.iterator = iterator
+
+    def __iter__(self):
+        return self.iterator
+
+    async def __aiter__(self):
+        resume = greenlet_spawn if self.bind.dialect.is_async else run_in_threadpool
+        done = object()
+        try:
+            while True:
+                chunk = await resume(next, self.iterator, done)
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            # Release the cursor and connection even if the client went away mid-stream
+            await resume(self.iterator.close)
+
+
+def session_runner(db):
+    """
+    Return a function that calls work(session) on a new session bound like db, from any thread.
+
+    With a sync engine the work simply runs on the calling thread. An async engine can only
+    be driven from its event loop, so there the work is handed to that loop and run in a
+    greenlet, as AsyncSession.run_sync would, while the calling thread waits for the result.
+    Must be created on the thread that is handling the request.
+    """
+    bind = db.get_bind()
+
+    def run(work):
+        with Session(bind=bind, autoflush=False) as session:
+            return work(session)
+
+    if not bind.dialect.is_async:
+        return run
+
+    loop = asyncio.get_running_loop()
+
+    def run_on_loop(work):
+        return asyncio.run_coroutine_threadsafe(greenlet_spawn(run, work), loop).result()
+
+    return run_on_loop
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, insert, select
+
+from sbs.cache import LRUCache
+from sbs.db import session_runner
+from sbs.models import IdempotencyKey
+
+
+def fingerprint(*parts):
+    """Hash identifying a request, so a key reused for a different request can be told apart."""
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Responses recorded under Idempotency-Keys, kept for ttl seconds.
+
+    The idempotency_keys table is the source of truth: a response is inserted in the same
+    transaction as the change it describes, so the two commit or roll back together. A
+    bounded LRU cache in front of it answers replays handled by this process without a
+    query. Expired rows are deleted in batches from a background thread.
+    """
+
+    def __init__(self, ttl, cache_size, prune_interval, prune_batch_size):
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.prune_batch_size = prune_batch_size
+        self.cache = LRUCache(maxsize=cache_size, ttl=ttl)
+        self._next_prune = time.monotonic() + prune_interval
+        self._prune_lock = threading.Lock()
+        self._pruner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sbs-idempotency-prune")
+
+    def _cutoff(self):
+        return datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+
+    def lookup(self, db, key, request_fingerprint):
+        """
+        Return the response recorded for key, or None if the key is new or has expired.
+
+        Raises a 422 if the key was recorded for a different request.
+        """
+        cached = self.cache.get(key)
+        if cached is None:
+            # One primary key probe, also telling how long the row has left
+            stmt = select(
+                IdempotencyKey.fingerprint, IdempotencyKey.response, IdempotencyKey.created_at,
+            ).where(IdempotencyKey.key == key)
+            row = db.execute(stmt).first()
+            if row is None:
+                return None
+            created_at = row.created_at
+            if created_at.tzinfo is None:  # SQLite doesn't keep the time zone
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            remaining = (created_at - self._cutoff()).total_seconds()
+            if remaining <= 0:
+                return None  # Not pruned yet; record clears it
+            cached = (row.fingerprint, row.response)
+            # Only for as long as the row lives, after which other processes treat the key as new
+            self.cache.put(key, cached, self.cache.token(), ttl=remaining)
+
+        if cached[0] != request_fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key has already been used for a different request")
+        return json.loads(cached[1])
+
+    def record(self, db, key, request_fingerprint, response):
+        """
+        Insert the response for key in the current transaction and return its stored body.
+
+        A key recorded by a concurrent request makes the insert fail with an IntegrityError.
+        An expired row for key that hasn't been pruned yet is deleted first, in the same
+        transaction, so a retry after a rollback that brought the row back deletes it again.
+        """
+        body = json.dumps(jsonable_encoder(response))
+        db.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.created_at < self._cutoff()))
+        db.connection().execute(
+            insert(IdempotencyKey), {"key": key, "fingerprint": request_fingerprint, "response": body}
+        )
+        return body
+
+    def remember(self, key, request_fingerprint, body):
+        """Put a committed response in the front cache."""
+        self.cache.put(key, (request_fingerprint, body), self.cache.token())
+
+    def prune(self, db):
+        """Delete expired keys, prune_batch_size rows per transaction, and return how many went."""
+        cutoff = self._cutoff()
+        expired = (
+            select(IdempotencyKey.key)
+            .where(IdempotencyKey.created_at < cutoff)
+            .limit(self.prune_batch_size)
+            .scalar_subquery()
+        )
+        stmt = delete(IdempotencyKey).where(IdempotencyKey.key.in_(expired))
+        deleted = 0
+        while True:
+            count = db.execute(stmt, execution_options={"synchronize_session": False}).rowcount
+            db.commit()
+            deleted += count
+            if count < self.prune_batch_size:
+                return deleted
+
+    def schedule_prune(self, db):
+        """Start a prune in the background if prune_interval has passed since the last one."""
+        with self._prune_lock:
+            now = time.monotonic()
+            if now < self._next_prune:
+                return
+            self._next_prune = now + self.prune_interval
+        run = session_runner(db)
+        self._pruner.submit(run, self.prune)
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+
+class Job:
+    """Progress and outcome of one background job."""
+
+    def __init__(self, kind):
+        self.job_id = str(uuid.uuid4())
+        self.kind = kind
+        self.status = "queued"
+        self.rows_processed = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.artifact = None  # Path of the file an export job produced
+
+    def to_dict(self):
+        if self.started_at is None:
+            throughput = None
+        else:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            throughput = round(self.rows_processed / elapsed, 1) if elapsed > 0 else None
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "rows_processed": self.rows_processed,
+            "rows_per_second": throughput,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+            "has_artifact": self.artifact is not None,
+        }
+
+
+class JobStore(ABC):
+    """Where jobs are kept between submission and polling."""
+
+    @abstractmethod
+    def add(self, job):
+        ...
+
+    @abstractmethod
+    def get(self, job_id):
+        """Return the job, or None if it is unknown."""
+
+    @abstractmethod
+    def update(self, job_id, **fields):
+        ...
+
+
+class InMemoryJobStore(JobStore):
+    """
+    Keeps jobs in this process, forgetting the oldest ones beyond max_jobs.
+
+    A forgotten job's artifact can no longer be downloaded, so its file is deleted with it,
+    including one that arrives after the job was forgotten while still running.
+    """
+
+    def __init__(self, max_jobs=1000):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                _, evicted = self._jobs.popitem(last=False)
+                _remove_artifact(evicted.artifact)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                _remove_artifact(fields.get("artifact"))
+                return
+            for name, value in fields.items():
+                setattr(job, name, value)
+
+
+def _remove_artifact(path):
+    if path is not None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class JobRunner:
+    """Runs jobs on a bounded pool of worker threads and records them in a JobStore."""
+
+    def __init__(self, store, max_workers):
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sbs-job")
+
+    def submit(self, kind, work):
+        """
+        Queue work(progress) and return its Job right away.
+
+        work reports the running row count through progress(rows) and returns the job's
+        result, or a (result, artifact_path) tuple. An HTTPException's detail, or any other
+        exception's message, becomes the job's error.
+        """
+        job = Job(kind)
+        self.store.add(job)
+        self._executor.submit(self._run, job.job_id, work)
+        return job
+
+    def _run(self, job_id, work):
+        self.store.update(job_id, status="running", started_at=time.time())
+
+        def progress(rows):
+            self.store.update(job_id, rows_processed=rows)
+
+        try:
+            outcome = work(progress)
+        except HTTPException as exc:
+            self.store.update(job_id, status="failed", error=exc.detail, finished_at=time.time())
+        except Exception as exc:
+            self.store.update(job_id, status="failed", error=str(exc), finished_at=time.time())
+        else:
+            result, artifact = outcome if isinstance(outcome, tuple) else (outcome, None)
+            self.store.update(
+                job_id, status="succeeded", result=result, artifact=artifact, finished_at=time.time()
+            )
+
+    def shutdown(self, wait=False):
+        """Stop the workers; unless waiting for them, queued jobs are dropped."""
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
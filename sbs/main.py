@@ -1,32 +1,57 @@
-from fastapi import FastAPI, HTTPException, Depends, Query, UploadFile, File, Response
-from fastapi.responses import StreamingResponse
-from typing import List
-from sqlalchemy import func
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, Header, Query, UploadFile, File, Response
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from typing import Annotated, List, Literal, Optional
+from sqlalchemy import String, any_, bindparam, delete, func, insert, tuple_, update
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.future import select
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 import uuid
+import base64
+import codecs
 import csv
-import io
+import itertools
+import json
 import os
-
-from sbs.db import get_db, engine
-from sbs.models import Account as AccountModel, Base
-from sbs import schemas
+import shutil
+import tempfile
+
+from sbs.cache import LRUCache
+from sbs.coalesce import Coalescer
+from sbs.config import (
+    ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL, CHECKPOINT_OVERLAP_SECONDS, DB_MODE, DEPOSIT_COALESCE_MAX_BATCH,
+    DEPOSIT_COALESCE_WINDOW_MS, EXPORT_BATCH_SIZE, EXPORT_MAX_PARALLELISM, EXPORT_PARALLELISM,
+    IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_PRUNE_BATCH_SIZE, IDEMPOTENCY_PRUNE_INTERVAL, IDEMPOTENCY_TTL,
+    IMPORT_BUFFER_SIZE, IMPORT_CHUNK_SIZE, IMPORT_MAX_LINE_BYTES, JOB_DIR, JOB_WORKERS, READ_YOUR_WRITES_SECONDS,
+    STATS_RECONCILE_INTERVAL, STATS_STRIPES,
+)
+from sbs.db import get_db, get_read_db, engine, async_engine, from_replica, pause, session_runner, StreamBody
+from sbs.idempotency import IdempotencyStore, fingerprint
+from sbs.jobs import InMemoryJobStore, JobRunner
+from sbs.metrics import REGISTRY, MetricsMiddleware, track_queries
+from sbs.models import (
+    Account as AccountModel, AccountTombstone, Base, Transaction as TransactionModel, lower_name,
+)
+from sbs.money import MAX_CENTS, from_cents, to_cents
+from sbs.replicas import ReadYourWritesMiddleware
+from sbs.routing import async_router
+from sbs.stats import BalanceStats
+from sbs import partitioned, schemas, snapshot
 
 
-app = FastAPI(
-    title="Simple Banking System",
-    description="A simple banking system with FastAPI, PostgreSQL, and Docker",
-    version="1.0.0",
-)
+# Endpoints are written once against a sync Session; create_app serves them either from
+# the threadpool or, in async mode, from the event loop through an AsyncSession
+router = APIRouter()
 
 
 # Startup event to initialize the database
 import time
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
 
 
 # Startup event to initialize the database with retries
-@app.on_event("startup")
 def on_startup():
     retry_attempts = 5  # Number of retries
     retry_delay = 2  # Delay in seconds between retries
@@ -43,17 +68,97 @@ def on_startup():
                 raise  # If retries are exhausted, raise the exception
 
 
-@app.get("/accounts", summary="Fetch records with pagination")
+# Async mode counterpart of on_startup, run on the event loop against the async engine
+async def on_startup_async():
+    retry_attempts = 5  # Number of retries
+    retry_delay = 2  # Delay in seconds between retries
+
+    for attempt in range(retry_attempts):
+        try:
+            async with async_engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)  # Initialize the database
+            break  # If successful, exit the retry loop
+        except OperationalError:
+            if attempt < retry_attempts - 1:
+                await asyncio.sleep(retry_delay)  # Wait before retrying
+            else:
+                raise  # If retries are exhausted, raise the exception
+
+
+# Read-through cache for GET /accounts/{account_id}, local to this process
+account_cache = LRUCache(maxsize=ACCOUNT_CACHE_SIZE, ttl=ACCOUNT_CACHE_TTL)
+
+# Responses of deposits, withdrawals and transfers sent with an Idempotency-Key
+idempotency_store = IdempotencyStore(
+    ttl=IDEMPOTENCY_TTL,
+    cache_size=IDEMPOTENCY_CACHE_SIZE,
+    prune_interval=IDEMPOTENCY_PRUNE_INTERVAL,
+    prune_batch_size=IDEMPOTENCY_PRUNE_BATCH_SIZE,
+)
+
+# Account count, balance total and histogram for GET /stats, updated with every balance change
+balance_stats = BalanceStats(stripes=STATS_STRIPES, reconcile_interval=STATS_RECONCILE_INTERVAL)
+
+# Business counters, served by GET /metrics with the request and database metrics
+MONEY_OPERATIONS = REGISTRY.counter(
+    "sbs_money_operations_total", "Deposits, withdrawals and transfers applied", ["operation"]
+)
+INSUFFICIENT_BALANCE = REGISTRY.counter(
+    "sbs_insufficient_balance_total", "Withdrawals and transfers rejected for insufficient balance", ["operation"]
+)
+
+# Header a client sets to have a retried deposit, withdrawal or transfer applied only once
+IdempotencyKeyHeader = Annotated[Optional[str], Header(
+    alias="Idempotency-Key", max_length=255,
+    description="Unique key for this request; retries with the same key get the first response back")]
+
+
+# Cached total row count, so cursor paging doesn't pay for a full COUNT(*) scan on every request
+ACCOUNT_COUNT_TTL = 30  # Seconds a cached count stays valid
+_account_count_cache = {"value": None, "expires_at": 0.0}
+
+
+def _encode_cursor(account_id):
+    return base64.urlsafe_b64encode(account_id.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _cached_account_count(db):
+    now = time.monotonic()
+    if _account_count_cache["value"] is None or now >= _account_count_cache["expires_at"]:
+        total_count_stmt = select(func.count(AccountModel.account_id))
+        _account_count_cache["value"] = db.execute(total_count_stmt).scalar()
+        _account_count_cache["expires_at"] = now + ACCOUNT_COUNT_TTL
+    return _account_count_cache["value"]
+
+
+@router.get("/accounts", summary="Fetch records with pagination")
 def get_paginated_accounts(
         pagination: schemas.PaginationParams = Depends(),
-        db=Depends(get_db),
+        after: Annotated[Optional[str], Query(
+            description="Cursor from a previous response's 'next_cursor'. Switches to cursor paging; "
+                        "pass an empty value to start from the first account.")] = None,
+        include_total: Annotated[bool, Query(
+            description="In cursor mode, also return a cached total count")] = False,
+        db=Depends(get_read_db),
 ):
-    page = pagination.page
     page_size = pagination.page_size
+
+    if after is not None:
+        return _get_accounts_after(after, page_size, include_total, db)
+
+    page = pagination.page
     offset = (page - 1) * page_size  # Calculate offset
 
-    # Query with limit and offset for pagination
-    stmt = select(AccountModel).limit(page_size).offset(offset)
+    # Query with limit and offset for pagination, ordered so pages and cursors line up
+    stmt = select(AccountModel).order_by(AccountModel.account_id).limit(page_size).offset(offset)
     result = db.execute(stmt)
     accounts = result.scalars().all()  # Get all results for the specified page
 
@@ -73,40 +178,210 @@ def get_paginated_accounts(
         "total_pages": total_pages,
         "current_page": page,
         "page_size": page_size,
-        "accounts": accounts,
+        "accounts": [_account_dict(account) for account in accounts],
+        "next_cursor": _encode_cursor(accounts[-1].account_id) if offset + len(accounts) < total_count else None,
+    }
+
+
+def _get_accounts_after(after, page_size, include_total, db):
+    # Keyset pagination: seek past the cursor on the primary key index, no OFFSET scan
+    stmt = select(AccountModel).order_by(AccountModel.account_id).limit(page_size + 1)
+    if after:
+        stmt = stmt.where(AccountModel.account_id > _decode_cursor(after))
+    result = db.execute(stmt)
+    accounts = result.scalars().all()
+
+    if not accounts:
+        raise HTTPException(status_code=404, detail="No accounts found after the given cursor")
+
+    # The extra row only tells us whether another page exists
+    has_more = len(accounts) > page_size
+    accounts = accounts[:page_size]
+
+    response = {
+        "page_size": page_size,
+        "accounts": [_account_dict(account) for account in accounts],
+        "next_cursor": _encode_cursor(accounts[-1].account_id) if has_more else None,
+    }
+    if include_total:
+        response["total_count"] = _cached_account_count(db)
+    return response
+
+
+def _account_dict(account):
+    # Balances are stored as integer cents and returned as two-place decimals
+    return {
+        "account_id": account.account_id,
+        "name": account.name,
+        "balance": account.balance,
+    }
+
+
+def _prefix_end(prefix):
+    """Return the smallest string after every string starting with prefix, or None if there is none."""
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    following = ord(prefix[-1]) + 1
+    if 0xD800 <= following <= 0xDFFF:
+        following = 0xE000  # Skip the surrogates, which can't be encoded
+    return prefix[:-1] + chr(following)
+
+
+def _escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _decode_name_cursor(cursor):
+    try:
+        name_key, account_id = json.loads(_decode_cursor(cursor))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return name_key, account_id
+
+
+# Endpoint to search accounts by name; declared before /accounts/{account_id}, which would
+# otherwise take "search" for an account ID
+@router.get("/accounts/search", summary="Search accounts by name")
+def search_accounts(
+        name: Annotated[str, Query(
+            min_length=1, max_length=255,
+            description="Case-insensitive start of the name, or part of it with match=contains")],
+        match: Annotated[Literal["prefix", "contains"], Query(
+            description="'prefix' matches names starting with name, 'contains' names containing it")] = "prefix",
+        after: Annotated[Optional[str], Query(
+            description="Cursor from a previous response's 'next_cursor'")] = None,
+        page_size: Annotated[int, Query(ge=1, le=1000, description="Number of accounts per page")] = 10,
+        db=Depends(get_read_db),
+):
+    term = name.lower()
+    key = lower_name(AccountModel.name)
+    # Keyset pagination in the order of the (lower_name, account_id) index
+    stmt = (
+        select(AccountModel, key.label("name_key"))
+        .order_by(key, AccountModel.account_id)
+        .limit(page_size + 1)
+    )
+    if match == "prefix":
+        # Names starting with the term are a range of the index
+        stmt = stmt.where(key >= term)
+        end = _prefix_end(term)
+        if end is not None:
+            stmt = stmt.where(key < end)
+    else:
+        # Trigram matches need three characters; anything shorter would scan every name
+        if len(term) < 3:
+            raise HTTPException(status_code=422, detail="match=contains needs at least 3 characters")
+        stmt = stmt.where(func.lower(AccountModel.name).like(f"%{_escape_like(term)}%", escape="\\"))
+    if after:
+        stmt = stmt.where(tuple_(key, AccountModel.account_id) > _decode_name_cursor(after))
+    rows = db.execute(stmt).all()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    return {
+        "name": name,
+        "match": match,
+        "page_size": page_size,
+        "accounts": [_account_dict(row.Account) for row in rows],
+        "next_cursor": _encode_cursor(json.dumps([rows[-1].name_key, rows[-1].Account.account_id]))
+        if has_more else None,
     }
 
 
 # Endpoint to create a new bank account
-@app.post("/accounts")
+@router.post("/accounts")
 def create_account(
         name: str,
-        starting_balance: float,
+        starting_balance: Decimal = Query(..., decimal_places=2),
         db=Depends(get_db)
 ):
     account_id = str(uuid.uuid4())
+    cents = to_cents(starting_balance)
     new_account = AccountModel(
         account_id=account_id,
         name=name,
-        balance=starting_balance,
+        balance_cents=cents,
     )
 
     db.add(new_account)
+    _record_transactions(db, [_ledger_entry(account_id, "open", cents, cents)])
+    # Built before the commit expires the instance, so it isn't read back from the database
+    response = _account_dict(new_account)
     db.commit()
-    db.refresh(new_account)
+
+    return response
+
+
+# Endpoint to create many accounts at once, e.g. when onboarding from another system
+@router.post("/accounts/batch", summary="Create a batch of accounts")
+def batch_create_accounts(
+        batch: schemas.BatchCreateAccountsRequest,
+        chunk_size: Annotated[Optional[int], Query(
+            ge=1, description="Accounts per transaction; the whole batch is one transaction if omitted")] = None,
+        db=Depends(get_db),
+):
+    # IDs are generated here rather than by the database, so nothing needs to be read back
+    rows = [
+        {"account_id": str(uuid.uuid4()), "name": item.name, "balance_cents": to_cents(item.starting_balance)}
+        for item in batch.accounts
+    ]
+    if chunk_size is None:
+        _commit_with_retries(db, lambda: _insert_accounts(db, rows))
+        return {"message": "Accounts created", "accounts": [_created_account(row) for row in rows]}
+
+    # Each chunk commits on its own, so one that fails leaves the chunks before it created;
+    # report every chunk, as /transfers/batch does for each transfer, rather than fail the request
+    created = []
+    chunks = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        try:
+            _commit_with_retries(db, lambda: _insert_accounts(db, chunk))
+        except DBAPIError as exc:
+            chunks.append({"index": start, "count": len(chunk), "status": "failed", "detail": str(exc.orig)})
+            continue
+        created.extend(_created_account(row) for row in chunk)
+        chunks.append({"index": start, "count": len(chunk), "status": "ok"})
 
     return {
-        "account_id": new_account.account_id,
-        "name": new_account.name,
-        "balance": new_account.balance
+        "message": "Accounts created" if len(created) == len(rows) else "Batch processed",
+        "succeeded": len(created),
+        "failed": len(rows) - len(created),
+        "accounts": created,
+        "chunks": chunks,
     }
 
 
+def _created_account(row):
+    return {"account_id": row["account_id"], "name": row["name"], "balance": from_cents(row["balance_cents"])}
+
+
+def _insert_accounts(db, rows):
+    """Insert accounts and their opening ledger entries in the current transaction, one executemany each."""
+    db.connection().execute(insert(AccountModel), rows)
+    _record_transactions(db, [
+        _ledger_entry(row["account_id"], "open", row["balance_cents"], row["balance_cents"]) for row in rows
+    ])
+
+
+def _record_tombstones(db, account_ids):
+    """Record deleted accounts for GET /save?since=, replacing earlier tombstones of the same IDs."""
+    db.execute(delete(AccountTombstone).where(AccountTombstone.account_id.in_(account_ids)))
+    db.connection().execute(insert(AccountTombstone), [{"account_id": account_id} for account_id in account_ids])
+
+
 # Endpoint to get account details by ID
-@app.get("/accounts/{account_id}")
+@router.get("/accounts/{account_id}")
 def get_account(
-        account_id: str, db=Depends(get_db)
+        account_id: str, db=Depends(get_read_db)
 ):
+    # Hot accounts are served from the in-process cache; every write invalidates its entry
+    cached = account_cache.get(account_id)
+    if cached is not None:
+        return dict(cached)
+    token = account_cache.token()
+
     stmt = select(AccountModel).where(AccountModel.account_id == account_id)
     result = db.execute(stmt)
     account = result.scalar_one_or_none()
@@ -118,23 +393,66 @@ def get_account(
     if 'account_id' not in account.__dict__:
         raise KeyError("The returned object doesn't contain 'account_id'")
 
+    response = _account_dict(account)
+    # A replica may not have the last committed write yet, so only primary reads are cached
+    if not from_replica(db):
+        account_cache.put(account_id, response, token)
+    return dict(response)
+
+
+def _account_id_in(db, ids):
+    """account_id IN ids; one array parameter on PostgreSQL, so the statement is the same for any number of IDs."""
+    if db.get_bind().dialect.name == "postgresql":
+        return AccountModel.account_id == any_(bindparam("account_ids", list(ids), type_=ARRAY(String)))
+    return AccountModel.account_id.in_(ids)
+
+
+# Endpoint to fetch many accounts by ID with one query, for clients that would otherwise
+# call GET /accounts/{account_id} in a loop
+@router.post("/accounts/lookup", summary="Fetch several accounts by ID")
+def lookup_accounts(
+        lookup: schemas.AccountLookupRequest,
+        db=Depends(get_read_db),
+):
+    account_ids = list(dict.fromkeys(lookup.account_ids))  # Without duplicates, in request order
+
+    # Cached accounts are served from the cache, like GET /accounts/{account_id}
+    found = {}
+    for account_id in account_ids:
+        cached = account_cache.get(account_id)
+        if cached is not None:
+            found[account_id] = dict(cached)
+    misses = [account_id for account_id in account_ids if account_id not in found]
+
+    if misses:
+        token = account_cache.token()
+        # Plain column tuples; the response doesn't need ORM instances or the identity map
+        stmt = (
+            select(AccountModel.account_id, AccountModel.name, AccountModel.balance_cents)
+            .where(_account_id_in(db, misses))
+        )
+        for account_id, name, balance_cents in db.execute(stmt):
+            response = {"account_id": account_id, "name": name, "balance": from_cents(balance_cents)}
+            if not from_replica(db):  # As in get_account
+                account_cache.put(account_id, response, token)
+            found[account_id] = dict(response)
+
     return {
-        "account_id": account.account_id,
-        "name": account.name,
-        "balance": account.balance
+        "accounts": [found[account_id] for account_id in account_ids if account_id in found],
+        "missing": [account_id for account_id in account_ids if account_id not in found],
     }
 
 
 # **Endpoint to update account data by account_id**
-@app.put("/accounts/{account_id}", summary="Update account data by account_id")
+@router.put("/accounts/{account_id}", summary="Update account data by account_id")
 def update_account(
         account_id: str,
         name: str,
-        balance: float,
+        balance: Decimal = Query(..., decimal_places=2),
         db=Depends(get_db),
 ):
-    # Find the existing account
-    stmt = select(AccountModel).where(AccountModel.account_id == account_id)
+    # Find the existing account, locked so the adjustment entry is taken from the balance it replaces
+    stmt = select(AccountModel).where(AccountModel.account_id == account_id).with_for_update()
     result = db.execute(stmt)  # Await the query
     account = result.scalar_one_or_none()  # Retrieve the existing account
 
@@ -143,29 +461,29 @@ def update_account(
         raise HTTPException(status_code=404, detail="Account not found")
 
     # Update the account's data
+    cents = to_cents(balance)
+    if account.balance_cents != cents:
+        _record_transactions(db, [_ledger_entry(account_id, "adjustment", cents - account.balance_cents, cents)])
     account.name = name
-    account.balance = balance
+    account.balance_cents = cents
 
     # Commit the changes to the database
     db.commit()  # Commit the transaction
+    account_cache.invalidate(account_id)
     db.refresh(account)  # Refresh the account to reflect changes
 
     return {
         "message": f"Account with account_id '{account_id}' has been updated.",
-        "account": {
-            "account_id": account.account_id,
-            "name": account.name,
-            "balance": account.balance,
-        },
+        "account": _account_dict(account),
     }
 
 
-@app.delete("/accounts/{account_id}", summary="Delete an account by account_id")
+@router.delete("/accounts/{account_id}", summary="Delete an account by account_id")
 def delete_account(
         account_id: str, db=Depends(get_db)
 ):
-    # Find the account by account_id
-    stmt = select(AccountModel).where(AccountModel.account_id == account_id)
+    # Find the account by account_id, locked so the close entry is taken from its final balance
+    stmt = select(AccountModel).where(AccountModel.account_id == account_id).with_for_update()
     result = db.execute(stmt)  # Await the database query
     account = result.scalar_one_or_none()  # Retrieve the account or None
 
@@ -174,15 +492,14 @@ def delete_account(
         raise HTTPException(status_code=404, detail=f"Account with account_id '{account_id}' not found")
 
     # Store information about the account to be deleted
-    account_info = {
-        "account_id": account.account_id,
-        "name": account.name,
-        "balance": account.balance,
-    }
+    account_info = _account_dict(account)
 
-    # Delete the account from the database
+    # Delete the account from the database; its ledger history stays
     db.delete(account)  # Delete the record
+    _record_transactions(db, [_ledger_entry(account_id, "close", -account.balance_cents, 0)])
+    _record_tombstones(db, [account_id])
     db.commit()  # Commit the transaction to apply the changes
+    account_cache.invalidate(account_id)
 
     # Return a confirmation message along with deleted account info
     return {
@@ -191,161 +508,1022 @@ def delete_account(
     }
 
 
+def _ledger_entry(account_id, kind, amount_cents, balance_cents, counterparty_id=None):
+    return {
+        "account_id": account_id,
+        "kind": kind,
+        "amount_cents": amount_cents,
+        "balance_cents": balance_cents,
+        "counterparty_id": counterparty_id,
+    }
+
+
+def _record_transactions(db, entries, new_accounts=()):
+    """
+    Append ledger entries in the current transaction with one executemany INSERT.
+
+    Every balance change comes through here, so the GET /stats counters are updated along
+    with the ledger. Opening and closing entries add and remove an account; so do entries
+    for the IDs in new_accounts, which imports create without opening them.
+    """
+    if entries:
+        db.connection().execute(insert(TransactionModel), entries)
+        balance_stats.record(db, [
+            (
+                None if entry["kind"] == "open" or entry["account_id"] in new_accounts
+                else entry["balance_cents"] - entry["amount_cents"],
+                None if entry["kind"] == "close" else entry["balance_cents"],
+            )
+            for entry in entries
+        ])
+
+
+def _encode_transaction_cursor(transaction):
+    return _encode_cursor(f"{transaction.created_at.isoformat()}|{transaction.transaction_id}")
+
+
+def _decode_transaction_cursor(cursor):
+    created_at, _, transaction_id = _decode_cursor(cursor).partition("|")
+    try:
+        return datetime.fromisoformat(created_at), int(transaction_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# Endpoint to get an account's transaction history, newest first
+@router.get("/accounts/{account_id}/transactions", summary="Fetch an account's transactions")
+def get_account_transactions(
+        account_id: str,
+        after: Annotated[Optional[str], Query(
+            description="Cursor from a previous response's 'next_cursor'")] = None,
+        page_size: Annotated[int, Query(ge=1, le=1000, description="Number of transactions per page")] = 10,
+        db=Depends(get_db),
+):
+    # Keyset pagination over the (account_id, created_at, transaction_id) index
+    stmt = (
+        select(TransactionModel)
+        .where(TransactionModel.account_id == account_id)
+        .order_by(TransactionModel.created_at.desc(), TransactionModel.transaction_id.desc())
+        .limit(page_size + 1)
+    )
+    if after:
+        stmt = stmt.where(
+            tuple_(TransactionModel.created_at, TransactionModel.transaction_id) < _decode_transaction_cursor(after)
+        )
+    transactions = db.execute(stmt).scalars().all()
+
+    # History outlives a deleted account, so only an account with neither is unknown
+    if not transactions and not after:
+        _require_account(db, account_id)
+
+    has_more = len(transactions) > page_size
+    transactions = transactions[:page_size]
+    return {
+        "account_id": account_id,
+        "page_size": page_size,
+        "transactions": [
+            {
+                "transaction_id": transaction.transaction_id,
+                "kind": transaction.kind,
+                "amount": transaction.amount,
+                "balance": transaction.balance,
+                "counterparty_id": transaction.counterparty_id,
+                "created_at": transaction.created_at,
+            }
+            for transaction in transactions
+        ],
+        "next_cursor": _encode_transaction_cursor(transactions[-1]) if has_more else None,
+    }
+
+
+def _add_to_balance(db, account_id, cents):
+    """Add cents to the account's balance in one statement and return the new balance."""
+    stmt = (
+        update(AccountModel)
+        .where(AccountModel.account_id == account_id)
+        .values(balance_cents=AccountModel.balance_cents + cents)
+        .returning(AccountModel.balance_cents)
+        .execution_options(synchronize_session=False)
+    )
+    balance = db.execute(stmt).scalar_one_or_none()
+
+    if balance is None:
+        raise HTTPException(status_code=404, detail="Account not found")
+    return balance
+
+
+def _apply_deposits(db, account_id, amounts):
+    """Apply several deposits to one account with one UPDATE and commit; return each one's balance."""
+    total = sum(amounts)
+
+    def apply():
+        balance = _add_to_balance(db, account_id, total)
+        # Each deposit's balance as if they had been applied one after the other
+        balances = list(itertools.accumulate(amounts, initial=balance - total))[1:]
+        _record_transactions(db, [
+            _ledger_entry(account_id, "deposit", cents, after) for cents, after in zip(amounts, balances)
+        ])
+        return balances
+
+    balances = _commit_with_retries(db, apply)
+    MONEY_OPERATIONS.inc(len(amounts), operation="deposit")
+    return balances
+
+
+# Combines concurrent deposits to the same account, so a hot account takes one commit per
+# window instead of one per deposit
+deposit_coalescer = Coalescer(
+    window=DEPOSIT_COALESCE_WINDOW_MS / 1000,
+    max_batch=DEPOSIT_COALESCE_MAX_BATCH,
+    apply=_apply_deposits,
+)
+
+
 # Endpoint to deposit money into an account
-@app.put("/accounts/{account_id}/deposit")
+@router.put("/accounts/{account_id}/deposit")
 def deposit(
         account_id: str,
-        amount: float = Query(..., ge=0),
+        amount: Decimal = Query(..., ge=0, decimal_places=2),
+        idempotency_key: IdempotencyKeyHeader = None,
         db=Depends(get_db),
 ):
-    stmt = select(AccountModel).where(AccountModel.account_id == account_id)
-    result = db.execute(stmt)
-    account = result.scalar_one_or_none()
+    cents = to_cents(amount)
 
-    if not account:
-        raise HTTPException(status_code=404, detail="Account not found")
+    if deposit_coalescer.window and idempotency_key is None:
+        # Idempotent deposits record their own response, so only the others are coalesced
+        balance = deposit_coalescer.submit(db, account_id, cents)
+        account_cache.invalidate(account_id)
+        return {"message": "Deposit successful", "balance": from_cents(balance)}
 
-    account.balance += amount
-    db.commit()
-    db.refresh(account)
+    def apply():
+        # Apply the deposit in the database in one statement, RETURNING the new balance
+        balance = _add_to_balance(db, account_id, cents)
+        _record_transactions(db, [_ledger_entry(account_id, "deposit", cents, balance)])
+        return {"message": "Deposit successful", "balance": from_cents(balance)}
 
-    return {"message": "Deposit successful", "balance": account.balance}
+    response = _idempotent(db, idempotency_key, ("deposit", account_id, cents), apply)
+    account_cache.invalidate(account_id)
+    return response
 
 
 # Endpoint to withdraw money from an account
-@app.put("/accounts/{account_id}/withdraw")
+@router.put("/accounts/{account_id}/withdraw")
 def withdraw(
         account_id: str,
-        amount: float,
+        amount: Decimal = Query(..., decimal_places=2),
+        idempotency_key: IdempotencyKeyHeader = None,
         db=Depends(get_db),
 ):
-    stmt = select(AccountModel).where(AccountModel.account_id == account_id)
-    result = db.execute(stmt)
-    account = result.scalar_one_or_none()
-
-    if not account:
+    cents = to_cents(amount)
+
+    def apply():
+        # The balance check is part of the UPDATE, so concurrent withdrawals can't overdraw
+        stmt = (
+            update(AccountModel)
+            .where(AccountModel.account_id == account_id, AccountModel.balance_cents >= cents)
+            .values(balance_cents=AccountModel.balance_cents - cents)
+            .returning(AccountModel.balance_cents)
+            .execution_options(synchronize_session=False)
+        )
+        balance = db.execute(stmt).scalar_one_or_none()
+
+        if balance is None:
+            # No row matched: find out whether the account is missing or just short of funds
+            _require_account(db, account_id)
+            INSUFFICIENT_BALANCE.inc(operation="withdraw")
+            raise HTTPException(status_code=400, detail="Insufficient balance")
+
+        _record_transactions(db, [_ledger_entry(account_id, "withdrawal", -cents, balance)])
+        return {
+            "message": "Withdrawal successful",
+            "balance": from_cents(balance)
+        }
+
+    response = _idempotent(db, idempotency_key, ("withdraw", account_id, cents), apply)
+    account_cache.invalidate(account_id)
+    return response
+
+
+def _require_account(db, account_id):
+    stmt = select(AccountModel.account_id).where(AccountModel.account_id == account_id)
+    if db.execute(stmt).first() is None:
         raise HTTPException(status_code=404, detail="Account not found")
 
-    if account.balance < amount:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
 
-    account.balance -= amount
-    db.commit()
-    db.refresh(account)
+# SQLSTATEs for serialization failures and deadlocks; the transaction can simply be retried
+RETRYABLE_SQLSTATES = {"40001", "40P01"}
+TRANSFER_ATTEMPTS = 5  # Attempts before a retryable failure is returned to the client
+TRANSFER_RETRY_DELAY = 0.01  # Base delay in seconds, grows with each attempt
 
-    return {
-        "message": "Withdrawal successful",
-        "balance": account.balance
-    }
+
+def _is_retryable(exc):
+    return getattr(exc.orig, "pgcode", None) in RETRYABLE_SQLSTATES
+
+
+def _commit_with_retries(db, apply):
+    """Run apply() and commit, retrying the whole transaction on serialization failures."""
+    for attempt in range(TRANSFER_ATTEMPTS):
+        try:
+            result = apply()
+            db.commit()  # Commit the changes to the database
+            return result
+        except DBAPIError as exc:
+            db.rollback()
+            if not _is_retryable(exc) or attempt == TRANSFER_ATTEMPTS - 1:
+                raise
+            pause(db, TRANSFER_RETRY_DELAY * (attempt + 1) * random.random())
+
+
+def _idempotent(db, key, request, apply):
+    """
+    Run apply() and commit, at most once per Idempotency-Key, and return apply's response.
+
+    request identifies what the client asked for. The response is recorded under the key in
+    the same transaction as the change, so a retry with the key gets it back without the
+    change being applied again. A request that fails changes and records nothing, so its
+    retries run again. Without a key this is just _commit_with_retries.
+    """
+    if key is None:
+        response = _commit_with_retries(db, apply)
+        MONEY_OPERATIONS.inc(operation=request[0])
+        return response
+
+    request_fingerprint = fingerprint(*request)
+    stored = idempotency_store.lookup(db, key, request_fingerprint)
+    if stored is not None:
+        return stored
+
+    def apply_and_record():
+        response = apply()
+        return response, idempotency_store.record(db, key, request_fingerprint, response)
+
+    try:
+        response, body = _commit_with_retries(db, apply_and_record)
+    except IntegrityError:
+        # A concurrent request with the same key got there first and ours was rolled back
+        stored = idempotency_store.lookup(db, key, request_fingerprint)
+        if stored is None:
+            raise
+        return stored
+
+    idempotency_store.remember(key, request_fingerprint, body)
+    idempotency_store.schedule_prune(db)
+    MONEY_OPERATIONS.inc(operation=request[0])
+    return response
+
+
+def _transfer_rejection(sender_id, recipient_id, amount, balances):
+    """Return the error a transfer of amount cents fails with given the {account_id: cents} it can see, or None."""
+    if sender_id not in balances:
+        return HTTPException(status_code=404, detail=f"Sender account '{sender_id}' not found")
+    if recipient_id not in balances:
+        return HTTPException(status_code=404, detail=f"Recipient account '{recipient_id}' not found")
+    # Check if sender has sufficient balance for the transfer
+    if balances[sender_id] < amount:
+        return HTTPException(status_code=400, detail="Insufficient balance for transfer")
+    return None
 
 
-# Corrected endpoint to transfer money between accounts
-@app.put("/accounts/{sender_id}/transfer/{recipient_id}")
+# Endpoint to transfer money between accounts
+@router.put("/accounts/{sender_id}/transfer/{recipient_id}")
 def transfer(
         sender_id: str,
         recipient_id: str,
-        amount: float,  # Using the correct request body schema
+        amount: Decimal = Query(..., decimal_places=2),  # Using the correct request body schema
+        idempotency_key: IdempotencyKeyHeader = None,
         db=Depends(get_db),
 ):
-    # Validate sender and recipient accounts
-    sender_stmt = select(AccountModel).where(AccountModel.account_id == sender_id)
-    recipient_stmt = select(AccountModel).where(AccountModel.account_id == recipient_id)
+    cents = to_cents(amount)
+
+    def apply():
+        sender_balance = _apply_transfer(db, sender_id, recipient_id, cents)
+        return {
+            "message": "Transfer successful",
+            "sender": {"account_id": sender_id, "balance": from_cents(sender_balance)},
+            "recipient": {"account_id": recipient_id},
+        }
+
+    response = _idempotent(db, idempotency_key, ("transfer", sender_id, recipient_id, cents), apply)
+    account_cache.invalidate(sender_id, recipient_id)
+    return response
+
+
+def _apply_transfer(db, sender_id, recipient_id, amount):
+    """
+    Move amount cents between two accounts with guarded UPDATEs and return the sender's new balance.
+
+    The rows are updated in account_id order, so two transfers in opposite directions take
+    their row locks in the same order and can't deadlock. Nothing is held across Python code
+    between the statements except the transaction itself.
+    """
+    debit = (
+        update(AccountModel)
+        .where(AccountModel.account_id == sender_id, AccountModel.balance_cents >= amount)
+        .values(balance_cents=AccountModel.balance_cents - amount)
+        .returning(AccountModel.balance_cents)
+        .execution_options(synchronize_session=False)
+    )
+    credit = (
+        update(AccountModel)
+        .where(AccountModel.account_id == recipient_id)
+        .values(balance_cents=AccountModel.balance_cents + amount)
+        .returning(AccountModel.balance_cents)
+        .execution_options(synchronize_session=False)
+    )
+
+    if sender_id <= recipient_id:
+        sender_balance = db.execute(debit).scalar_one_or_none()
+        recipient_balance = db.execute(credit).scalar_one_or_none() if sender_balance is not None else None
+    else:
+        recipient_balance = db.execute(credit).scalar_one_or_none()
+        sender_balance = db.execute(debit).scalar_one_or_none() if recipient_balance is not None else None
+
+    if sender_balance is None or recipient_balance is None:
+        # Undo a half-applied transfer, then look at both rows to report why it failed
+        db.rollback()
+        stmt = select(AccountModel.account_id, AccountModel.balance_cents).where(
+            AccountModel.account_id.in_([sender_id, recipient_id])
+        )
+        balances = dict(db.execute(stmt).all())
+        # The balance may have changed since the guard failed; the guard's verdict stands
+        rejection = (_transfer_rejection(sender_id, recipient_id, amount, balances)
+                     or HTTPException(status_code=400, detail="Insufficient balance for transfer"))
+        if rejection.status_code == 400:
+            INSUFFICIENT_BALANCE.inc(operation="transfer")
+        raise rejection
+
+    _record_transactions(db, _transfer_entries(sender_id, recipient_id, amount, sender_balance, recipient_balance))
+    return sender_balance
+
+
+def _transfer_entries(sender_id, recipient_id, amount, sender_balance, recipient_balance):
+    return [
+        _ledger_entry(sender_id, "transfer_out", -amount, sender_balance, counterparty_id=recipient_id),
+        _ledger_entry(recipient_id, "transfer_in", amount, recipient_balance, counterparty_id=sender_id),
+    ]
+
+
+# Endpoint to apply many transfers in one request
+@router.post("/transfers/batch", summary="Apply a batch of transfers")
+def batch_transfer(
+        batch: schemas.BatchTransferRequest,
+        chunk_size: Annotated[Optional[int], Query(
+            ge=1, description="Transfers per transaction; the whole batch is one transaction if omitted")] = None,
+        db=Depends(get_db),
+):
+    transfers = batch.transfers
+    chunk_size = chunk_size or len(transfers)
+
+    results = []
+    for start in range(0, len(transfers), chunk_size):
+        chunk = transfers[start:start + chunk_size]
+        try:
+            results.extend(_commit_with_retries(db, lambda: _apply_transfer_chunk(db, chunk, start)))
+        except DBAPIError as exc:
+            if len(chunk) == len(transfers):
+                raise  # One transaction for the whole batch, so nothing was applied
+            # The chunks before this one are committed, so report which transfers went through
+            results.extend(
+                {"index": index, "status": "failed", "status_code": 500, "detail": str(exc.orig)}
+                for index in range(start, start + len(chunk))
+            )
+            continue
+        account_cache.invalidate(*({item.sender_id for item in chunk} | {item.recipient_id for item in chunk}))
+
+    succeeded = sum(1 for result in results if result["status"] == "ok")
+    MONEY_OPERATIONS.inc(succeeded, operation="transfer")
+    INSUFFICIENT_BALANCE.inc(
+        sum(1 for result in results if result.get("status_code") == 400), operation="transfer"
+    )
+    return {
+        "message": "Batch processed",
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results,
+    }
 
-    sender_result = db.execute(sender_stmt)  # Await the query
-    recipient_result = db.execute(recipient_stmt)  # Await the query
 
-    sender = sender_result.scalar_one_or_none()  # Get sender account
-    recipient = recipient_result.scalar_one_or_none()  # Get recipient account
+def _apply_transfer_chunk(db, chunk, offset):
+    """
+    Apply a chunk of transfers in the current transaction and return one result per item.
+
+    Every account the chunk touches is read and locked with a single SELECT ... FOR UPDATE
+    in account_id order, the transfers are checked and applied one after another against
+    those balances, and the changed balances are written back in one executemany UPDATE.
+    """
+    account_ids = sorted({item.sender_id for item in chunk} | {item.recipient_id for item in chunk})
+    stmt = (
+        select(AccountModel.account_id, AccountModel.balance_cents)
+        .where(AccountModel.account_id.in_(account_ids))
+        .order_by(AccountModel.account_id)
+        .with_for_update()
+    )
+    balances = dict(db.execute(stmt).all())
+
+    results = []
+    changed = set()
+    entries = []
+    for index, item in enumerate(chunk, start=offset):
+        amount = to_cents(item.amount)
+        rejection = _transfer_rejection(item.sender_id, item.recipient_id, amount, balances)
+        if rejection:
+            results.append({
+                "index": index,
+                "status": "failed",
+                "status_code": rejection.status_code,
+                "detail": rejection.detail,
+            })
+            continue
+
+        balances[item.sender_id] -= amount
+        balances[item.recipient_id] += amount
+        changed.update((item.sender_id, item.recipient_id))
+        entries.extend(_transfer_entries(
+            item.sender_id, item.recipient_id, amount, balances[item.sender_id], balances[item.recipient_id]
+        ))
+        results.append({"index": index, "status": "ok", "sender_balance": from_cents(balances[item.sender_id])})
+
+    if changed:
+        db.execute(update(AccountModel), [
+            {"account_id": account_id, "balance_cents": balances[account_id]} for account_id in sorted(changed)
+        ])
+    _record_transactions(db, entries)
+    return results
+
+
+# Format of a /save, /load or background job file, chosen with ?format=
+SnapshotFormat = Annotated[Literal[snapshot.FORMATS], Query(
+    alias="format",
+    description="csv, csv.gz, csv.zst (needs zstandard), binary, or arrow (an Arrow IPC stream, needs pyarrow)",
+)]
+
+
+# Header of a /save response with its checkpoint, to pass back as since= for the changes after it
+CHECKPOINT_HEADER = "X-SBS-Checkpoint"
+
+# Checkpoint of an earlier /save or export job, making the export a delta of the accounts changed after it
+SinceQuery = Annotated[Optional[datetime], Query(
+    description="Checkpoint of an earlier export; only accounts changed or deleted after it are exported",
+)]
+
+
+# Key ranges of the accounts an export reads at once, refused above what the pool can serve
+ParallelQuery = Annotated[int, Query(
+    ge=1, le=EXPORT_MAX_PARALLELISM,
+    description="Key ranges read at once, each on a pooled connection of its own (PostgreSQL in sync mode)",
+)]
 
-    if not sender:
-        raise HTTPException(status_code=404, detail=f"Sender account '{sender_id}' not found")
-    if not recipient:
-        raise HTTPException(status_code=404, detail=f"Recipient account '{recipient_id}' not found")
 
-    # Check if sender has sufficient balance for the transfer
-    if sender.balance < amount:
-        raise HTTPException(status_code=400, detail="Insufficient balance for transfer")
+# **Export System State to CSV**
+@router.get("/save", summary="Export system state to CSV or another snapshot format")
+def export_system_state(
+        snapshot_format: SnapshotFormat = "csv",
+        since: SinceQuery = None,
+        parallel: ParallelQuery = EXPORT_PARALLELISM,
+        db=Depends(get_read_db),
+):
+    snapshot.require(snapshot_format)
+    since = _check_since(snapshot_format, since)
+    checkpoint = _checkpoint()
+    # Rows are read and written while the response is being sent, on a connection of its own
+    bind = db.get_bind()
+    filename = ("system_state_delta" if since else "system_state") + snapshot.EXTENSIONS[snapshot_format]
+
+    # Return as a streaming response
+    return StreamingResponse(
+        StreamBody(bind, _export_chunks(bind, snapshot_format, since=since, parallel=parallel)),
+        media_type=snapshot.MEDIA_TYPES[snapshot_format],
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            CHECKPOINT_HEADER: _format_checkpoint(checkpoint),
+        },
+    )
+
+
+def _check_since(snapshot_format, since):
+    """Return since in UTC, treating a checkpoint without a time zone as UTC; deltas are CSV only."""
+    if since is None:
+        return None
+    if snapshot_format not in snapshot.CSV_FORMATS:
+        raise HTTPException(status_code=400, detail="since= needs a CSV format")
+    if since.tzinfo is None:
+        return since.replace(tzinfo=timezone.utc)
+    return since.astimezone(timezone.utc)
+
+
+def _checkpoint():
+    """
+    Checkpoint for an export starting now: changes after it are in a delta since it.
+
+    Rows are stamped before their transaction commits, so a transaction still running when
+    the export starts can commit changes stamped earlier that the export doesn't see. Setting
+    the checkpoint back by CHECKPOINT_OVERLAP_SECONDS sends those again in the next delta;
+    applying a change twice does no harm.
+    """
+    return datetime.now(timezone.utc) - timedelta(seconds=CHECKPOINT_OVERLAP_SECONDS)
+
+
+def _format_checkpoint(checkpoint):
+    """A checkpoint in ISO 8601 with a Z, which unlike +00:00 survives being put in a URL unencoded."""
+    return checkpoint.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _export_chunks(bind, snapshot_format="csv", progress=None, since=None, parallel=1):
+    """
+    Yield the accounts table in snapshot_format, one chunk per EXPORT_BATCH_SIZE rows.
+
+    With since, only the accounts changed after it, followed by the accounts deleted after it,
+    as a delta. With parallel above 1, the accounts are read over that many key ranges at
+    once where the database allows it. progress, if given, is called with the running row
+    count after every chunk.
+    """
+    encoder = snapshot.encoder(snapshot_format, delta=since is not None)
+    yield encoder.start()  # The header goes out before the query even starts
+
+    # Plain columns over a server-side cursor: no ORM objects, no full result in memory
+    stmt = select(AccountModel.account_id, AccountModel.name, AccountModel.balance_cents)
+    if since is not None:
+        stmt = stmt.where(AccountModel.updated_at >= since)
+    exported = 0
+    for rows in _account_batches(bind, stmt, parallel):
+        yield encoder.write(rows)
+
+        exported += len(rows)
+        if progress:
+            progress(exported)
+
+    if since is not None:
+        # Tombstones of accounts that have since been created again are left out
+        recreated = select(AccountModel.account_id).where(
+            AccountModel.account_id == AccountTombstone.account_id
+        ).exists()
+        stmt = select(AccountTombstone.account_id).where(AccountTombstone.deleted_at >= since, ~recreated)
+        with bind.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE).execute(stmt)
+            for account_ids in result.scalars().partitions():
+                yield encoder.write_deletes(account_ids)
+
+                exported += len(account_ids)
+                if progress:
+                    progress(exported)
+    yield encoder.finish()
+
+
+def _account_batches(bind, stmt, parallel):
+    """Yield the rows of stmt in lists of EXPORT_BATCH_SIZE, from parallel key ranges or one cursor."""
+    if parallel > 1 and partitioned.supported(bind):
+        yield from partitioned.read(bind, stmt, AccountModel.account_id, parallel, EXPORT_BATCH_SIZE)
+        return
+    with bind.connect() as conn:
+        yield from conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE).execute(stmt).partitions()
+
+
+# **Import System State from CSV**
+@router.post("/load", summary="Import system state from CSV or another snapshot format")
+def import_system_state(
+        file: UploadFile = File(...),
+        chunk_size: Annotated[int, Query(
+            ge=1, description="Rows upserted per batch; each batch is committed on its own")] = IMPORT_CHUNK_SIZE,
+        snapshot_format: SnapshotFormat = "csv",
+        db=Depends(get_db),
+):
+    snapshot.require(snapshot_format)
+    return _import_snapshot(db, file.file, snapshot_format, chunk_size)
+
 
-    # Perform the transfer
-    sender.balance -= amount
-    recipient.balance += amount
+def _import_snapshot(db, binary, snapshot_format, chunk_size, progress=None):
+    """Import a file in snapshot_format from a binary file object and return the /load response body."""
+    if snapshot_format in snapshot.CSV_FORMATS:
+        return _import_csv(db, snapshot.decompress(snapshot_format, binary), chunk_size, progress)
 
-    db.commit()  # Commit the changes to the database
-    db.refresh(sender)  # Refresh sender account
-    db.refresh(recipient)  # Refresh recipient account
+    decode = snapshot.decode_binary if snapshot_format == "binary" else snapshot.decode_arrow
+    errors = []
+    imported = _import_rows(db, _check_records(decode(binary), errors), chunk_size, progress)
+    return _import_result(imported, errors)
 
+
+def _import_csv(db, binary, chunk_size, progress=None):
+    """Import a CSV from a binary file object and return the /load response body."""
+    # Parse the spooled upload as it is read, never holding more than a buffer of it
+    reader = csv.DictReader(_iter_lines(binary, IMPORT_BUFFER_SIZE, IMPORT_MAX_LINE_BYTES))
+
+    try:
+        fieldnames = reader.fieldnames or []
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV is not valid UTF-8")
+    except snapshot.CorruptSnapshot as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    for column in ("account_id", "name", "balance"):
+        if column not in fieldnames:
+            raise HTTPException(status_code=400, detail=f"CSV missing '{column}'")
+
+    # Insert or update accounts from CSV
+    errors = []
+    imported = _import_rows(db, _parse_rows(reader, errors), chunk_size, progress)
+    return _import_result(imported, errors)
+
+
+def _import_result(imported, errors):
+    if not errors:
+        return {"message": "Import successful"}
     return {
-        "message": "Transfer successful",
-        "sender": {"account_id": sender.account_id, "balance": sender.balance},
-        "recipient": {"account_id": recipient.account_id},
+        "message": "Import completed with errors",
+        "imported": imported,
+        "error_count": len(errors),
+        "errors": errors[:IMPORT_MAX_REPORTED_ERRORS],
     }
 
 
-# **Export System State to CSV**
-@app.get("/save", summary="Export system state to CSV")
-def export_system_state(db=Depends(get_db)):
-    stmt = select(AccountModel)
-    result = db.execute(stmt)
-    accounts = result.scalars().all()  # Await to avoid coroutine issues
+def _iter_lines(binary, buffer_size, max_line_bytes):
+    """
+    Decode a binary file as UTF-8 and yield it line by line, reading buffer_size bytes at a time.
+
+    Lines keep their endings and are only split after LF, so csv sees quoted fields that
+    span lines, and CRLF endings, as it would from a file opened with newline="".
+    Raises CorruptSnapshot at a line longer than max_line_bytes, rather than buffer it.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    # The unfinished line, kept in pieces so a long one isn't copied again on every read
+    pending = []
+    pending_bytes = 0
+    while True:
+        block = binary.read(buffer_size)
+        lines = decoder.decode(block, final=not block).split("\n")
+        last = lines.pop()
+        if lines and pending:
+            lines[0] = "".join(pending) + lines[0]
+            pending, pending_bytes = [], 0
+        for line in lines:
+            yield line + "\n"
+        if last:
+            pending.append(last)
+            pending_bytes += len(last.encode())
+            if pending_bytes > max_line_bytes:
+                raise snapshot.CorruptSnapshot(f"Line longer than {max_line_bytes} bytes")
+        if not block:
+            break
+    if pending:
+        yield "".join(pending)
+
+
+def _parse_rows(reader, errors):
+    """
+    Yield validated account rows from a csv.DictReader.
+
+    Rows that can't be imported are skipped and recorded in errors with the line they end on,
+    so one bad row doesn't stop the rows before or after it from being imported. In a delta,
+    with an op column, "delete" rows are yielded as {"account_id": ..., "op": "delete"}.
+    """
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as exc:
+            errors.append({"line": reader.line_num, "error": str(exc)})
+            continue
+        except UnicodeDecodeError:
+            errors.append({"line": reader.line_num + 1, "error": "Invalid UTF-8, import stopped"})
+            return
+        except snapshot.CorruptSnapshot as exc:
+            errors.append({"line": reader.line_num + 1, "error": f"{exc}, import stopped"})
+            return
+
+        if None in row or None in row.values():
+            errors.append({"line": reader.line_num, "error": "Wrong number of fields"})
+            continue
+        if not row["account_id"]:
+            errors.append({"line": reader.line_num, "error": "Missing account_id"})
+            continue
+        op = row.get("op", "upsert")
+        if op == "delete":
+            yield {"account_id": row["account_id"], "op": "delete"}
+            continue
+        if op != "upsert":
+            errors.append({"line": reader.line_num, "error": f"Invalid op '{op}'"})
+            continue
+        try:
+            balance = to_cents(row["balance"])
+        except ValueError:
+            errors.append({"line": reader.line_num, "error": f"Invalid balance '{row['balance']}'"})
+            continue
 
-    # Create a CSV in memory
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=["account_id", "name", "balance"])
-    writer.writeheader()
+        yield {"account_id": row["account_id"], "name": row["name"], "balance_cents": balance}
 
-    for account in accounts:
-        writer.writerow({
-            "account_id": account.account_id,
-            "name": account.name,
-            "balance": account.balance,
-        })
 
-    # Reset the buffer's position to read from it
-    output.seek(0)
+def _check_records(records, errors):
+    """
+    Yield validated account rows from (account_id, name, cents) records of a binary or Arrow snapshot.
 
-    # Return as a streaming response
-    return StreamingResponse(
-        output,
-        media_type="text/csv; charset=utf-8",
-        headers={"Content-Disposition": "attachment; filename=system_state.csv"},
+    Like _parse_rows, records that can't be imported are skipped and recorded in errors, by
+    their position. A file that is corrupt from the start is refused with a 400; corruption
+    further in stops the import there, keeping the rows already imported.
+    """
+    number = 0
+    while True:
+        try:
+            account_id, name, cents = next(records)
+        except StopIteration:
+            return
+        except snapshot.CorruptSnapshot as exc:
+            if number == 0:
+                raise HTTPException(status_code=400, detail=str(exc))
+            errors.append({"record": number + 1, "error": f"{exc}, import stopped"})
+            return
+        number += 1
+
+        if not isinstance(account_id, str) or not account_id:
+            errors.append({"record": number, "error": "Missing account_id"})
+            continue
+        if name is not None and not isinstance(name, str):
+            errors.append({"record": number, "error": f"Invalid name '{name}'"})
+            continue
+        if type(cents) is not int or abs(cents) > MAX_CENTS:
+            errors.append({"record": number, "error": f"Invalid balance '{cents}'"})
+            continue
+
+        yield {"account_id": account_id, "name": name, "balance_cents": cents}
+
+
+IMPORT_MAX_REPORTED_ERRORS = 100  # Malformed rows listed in a /load response
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def _account_upsert(db):
+    """INSERT ... ON CONFLICT (account_id) DO UPDATE for the session's database."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upserts are not supported on '{dialect}'")
+
+    stmt = insert(AccountModel)
+    return stmt.on_conflict_do_update(
+        index_elements=[AccountModel.account_id],
+        set_={
+            "name": stmt.excluded.name,
+            "balance_cents": stmt.excluded.balance_cents,
+            "updated_at": stmt.excluded.updated_at,
+        },
+        # Rows that already match are left alone, so reloading a snapshot doesn't mark every
+        # account changed for the next GET /save?since=
+        where=AccountModel.name.is_distinct_from(stmt.excluded.name)
+        | (AccountModel.balance_cents != stmt.excluded.balance_cents),
     )
 
 
-# **Import System State from CSV**
-@app.post("/load", summary="Import system state from CSV")
-def import_system_state(
-        file: UploadFile = File(...), db=Depends(get_db)
+def _import_rows(db, rows, chunk_size, progress=None):
+    """
+    Upsert parsed account rows in chunks of chunk_size and return the number of rows imported.
+
+    Each chunk is one locking read of the existing balances, one multi-row upsert, one ledger
+    insert and one commit. Rows of a delta marked {"op": "delete"} delete their account
+    instead. progress, if given, is called with the running row count after every chunk.
+    """
+    upsert = _account_upsert(db)
+    imported = 0
+    for chunk in _chunked(rows, chunk_size):
+        # A statement may only touch a row once; later rows for an account win, as they
+        # did when rows were applied one at a time
+        latest = {row["account_id"]: row for row in chunk}
+        values = {account_id: row for account_id, row in latest.items() if row.get("op") != "delete"}
+
+        # Lock the chunk's existing rows and read their balances for the ledger, in one query
+        stmt = (
+            select(AccountModel.account_id, AccountModel.balance_cents)
+            .where(AccountModel.account_id.in_(latest))
+            .order_by(AccountModel.account_id)
+            .with_for_update()
+        )
+        previous = dict(db.execute(stmt).all())
+        deleted = sorted(account_id for account_id in latest.keys() - values.keys() if account_id in previous)
+
+        # Core executemany on the session's connection skips the ORM bulk-insert bookkeeping
+        if values:
+            db.connection().execute(upsert, list(values.values()))
+        if deleted:
+            db.execute(delete(AccountModel).where(AccountModel.account_id.in_(deleted)))
+            _record_tombstones(db, deleted)
+        _record_transactions(db, [
+            _ledger_entry(account_id, "import", row["balance_cents"] - previous.get(account_id, 0), row["balance_cents"])
+            for account_id, row in values.items()
+            if account_id not in previous or previous[account_id] != row["balance_cents"]
+        ] + [
+            _ledger_entry(account_id, "close", -previous[account_id], 0) for account_id in deleted
+        ], new_accounts=values.keys() - previous.keys())
+        db.commit()
+        account_cache.invalidate(*latest)
+
+        imported += len(chunk)
+        if progress:
+            progress(imported)
+    return imported
+
+
+# Endpoint for totals over all accounts, read from counters rather than the accounts themselves
+@router.get("/stats", summary="Account count, balance total and balance distribution")
+def get_stats(db=Depends(get_read_db), primary=Depends(get_db)):
+    stats = balance_stats.read(db)
+    # The scan corrects the counters, so it runs on the primary even when a replica serves the read
+    balance_stats.schedule_reconcile(primary, _reconcile_stats)
+
+    def money(cents):
+        return None if cents is None else from_cents(cents)
+
+    return {
+        "accounts": stats["accounts"],
+        "total_balance": from_cents(stats["balance_cents"]),
+        "min_balance": money(stats["min_balance_cents"]),
+        "max_balance": money(stats["max_balance_cents"]),
+        # Accounts and their total per balance range, up to and including "le"
+        "histogram": [
+            {
+                "le": money(bucket["le"]),
+                "accounts": bucket["accounts"],
+                "total_balance": from_cents(bucket["balance_cents"]),
+            }
+            for bucket in stats["histogram"]
+        ],
+        "reconciled_at": balance_stats.reconciled_at,
+    }
+
+
+def _reconcile_stats(db):
+    return _commit_with_retries(db, lambda: balance_stats.reconcile(db))
+
+
+# Endpoint to check the GET /stats counters against a full scan now, correcting any drift
+@router.post("/stats/reconcile", summary="Check the stats counters against the accounts")
+def reconcile_stats(db=Depends(get_db)):
+    drift = _reconcile_stats(db)
+    return {
+        "drift": [
+            {"bucket": bucket, "accounts": accounts, "total_balance": from_cents(cents)}
+            for bucket, (accounts, cents) in sorted(drift.items())
+        ],
+        "reconciled_at": balance_stats.reconciled_at,
+    }
+
+
+@router.get("/cache/stats", summary="Account cache hit/miss/eviction counters")
+def get_cache_stats():
+    return account_cache.stats()
+
+
+@router.get("/metrics", summary="Metrics in the Prometheus text format", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Background jobs for imports and exports too large to run inside a request
+job_runner = JobRunner(InMemoryJobStore(), max_workers=JOB_WORKERS)
+
+
+# Dependency to get the job runner, so another store or runner can be swapped in
+def get_job_runner():
+    return job_runner
+
+
+# Dependency copying an import job's upload to a file of its own, since the upload is gone
+# once the request ends. A sync dependency runs in the threadpool in both modes, so the
+# copy doesn't hold up the event loop the way it would inside an async endpoint's run_sync.
+# The copy is deleted when the request ends unless a job claimed it by moving it away, so a
+# request refused after the copy, e.g. for an invalid query parameter, leaves nothing behind
+def copy_job_upload(file: UploadFile = File(...), snapshot_format: SnapshotFormat = "csv"):
+    snapshot.require(snapshot_format)
+    os.makedirs(JOB_DIR, exist_ok=True)
+    suffix = snapshot.EXTENSIONS[snapshot_format]
+    with tempfile.NamedTemporaryFile(dir=JOB_DIR, suffix=suffix, delete=False) as upload:
+        shutil.copyfileobj(file.file, upload, IMPORT_BUFFER_SIZE)
+    try:
+        yield upload.name
+    finally:
+        if os.path.exists(upload.name):
+            os.remove(upload.name)
+
+
+@router.post("/jobs/import", status_code=202, summary="Import system state from CSV in the background")
+def create_import_job(
+        chunk_size: Annotated[int, Query(
+            ge=1, description="Rows upserted per batch; each batch is committed on its own")] = IMPORT_CHUNK_SIZE,
+        snapshot_format: SnapshotFormat = "csv",
+        upload_path=Depends(copy_job_upload),
+        runner=Depends(get_job_runner),
+        db=Depends(get_db),
 ):
-    content = file.file.read()  # Read file content synchronously
-    content_str = content.decode("utf-8")  # Convert to string
-    reader = csv.DictReader(io.StringIO(content_str))
+    run = session_runner(db)
+    # Claim the upload, so it outlives the request
+    path = os.path.join(JOB_DIR, f"import-{uuid.uuid4()}{snapshot.EXTENSIONS[snapshot_format]}")
+    os.replace(upload_path, path)
 
-    # Insert or update accounts from CSV
-    with db.begin():
-        for row in reader:
-            if "account_id" not in row:
-                raise HTTPException(status_code=400, detail="CSV missing 'account_id'")
-            account_id = row["account_id"]
-            name = row["name"]
-            balance = float(row["balance"])
-
-            # Find existing account or create a new one
-            stmt = select(AccountModel).where(AccountModel.account_id == account_id)
-            result = db.execute(stmt)
-            account = result.scalar_one_or_none()
-
-            if not account:
-                # Create a new account
-                new_account = AccountModel(
-                    account_id=account_id,
-                    name=name,
-                    balance=balance,
-                )
-                db.add(new_account)
-            else:
-                # Update existing account
-                account.name = name
-                account.balance = balance
+    def work(progress):
+        try:
+            with open(path, "rb") as binary:
+                return run(lambda session: _import_snapshot(session, binary, snapshot_format, chunk_size, progress))
+        finally:
+            os.remove(path)
+
+    job = runner.submit("import", work)
+    return {"job_id": job.job_id, "status": job.status}
 
-    db.commit()  # Commit changes
-    return {"message": "Import successful"}
+
+@router.post("/jobs/export", status_code=202, summary="Export system state to CSV in the background")
+def create_export_job(
+        snapshot_format: SnapshotFormat = "csv",
+        since: SinceQuery = None,
+        parallel: ParallelQuery = EXPORT_PARALLELISM,
+        runner=Depends(get_job_runner),
+        db=Depends(get_db),
+):
+    snapshot.require(snapshot_format)
+    since = _check_since(snapshot_format, since)
+    os.makedirs(JOB_DIR, exist_ok=True)
+    run = session_runner(db)
+
+    def work(progress):
+        checkpoint = _checkpoint()
+        path = os.path.join(JOB_DIR, f"export-{uuid.uuid4()}{snapshot.EXTENSIONS[snapshot_format]}")
+        rows = {"exported": 0}
+
+        def track(exported):
+            rows["exported"] = exported
+            progress(exported)
+
+        def write(session):
+            with open(path, "wb") as output:
+                for chunk in _export_chunks(session.get_bind(), snapshot_format, track, since, parallel):
+                    output.write(chunk)
+
+        try:
+            run(write)
+        except BaseException:
+            # A failed job has no artifact, so nothing else would delete the partial file
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return {"rows": rows["exported"], "format": snapshot_format, "checkpoint": _format_checkpoint(checkpoint)}, path
+
+    job = runner.submit("export", work)
+    return {"job_id": job.job_id, "status": job.status}
+
+
+@router.get("/jobs/{job_id}", summary="Get the progress of a background job")
+def get_job(job_id: str, runner=Depends(get_job_runner)):
+    job = runner.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@router.get("/jobs/{job_id}/artifact", summary="Download the file a background export produced")
+def get_job_artifact(job_id: str, runner=Depends(get_job_runner)):
+    job = runner.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.artifact is None:
+        raise HTTPException(status_code=409, detail=f"Job has no artifact (status: {job.status})")
+    snapshot_format = job.result.get("format", "csv")
+    return FileResponse(
+        job.artifact,
+        media_type=snapshot.MEDIA_TYPES[snapshot_format],
+        filename="system_state" + snapshot.EXTENSIONS[snapshot_format],
+    )
+
+
+def create_app(mode=DB_MODE, metrics=True):
+    """
+    Build the application, serving the endpoints in "sync" or "async" mode.
+
+    With metrics, every request and database statement is recorded for GET /metrics.
+    """
+    if mode not in ("sync", "async"):
+        raise ValueError(f"Unknown database mode '{mode}', expected 'sync' or 'async'")
+
+    app = FastAPI(
+        title="Simple Banking System",
+        description="A simple banking system with FastAPI, PostgreSQL, and Docker",
+        version="1.0.0",
+    )
+    if mode == "async":
+        app.include_router(async_router(router))
+        app.add_event_handler("startup", on_startup_async)
+    else:
+        app.include_router(router)
+        app.add_event_handler("startup", on_startup)
+    if READ_YOUR_WRITES_SECONDS:
+        app.add_middleware(ReadYourWritesMiddleware, window=READ_YOUR_WRITES_SECONDS)
+    if metrics:
+        # Added last, so it wraps everything else and times the whole request
+        track_queries()
+        app.add_middleware(MetricsMiddleware)
+    return app
+
+
+app = create_app()
@@ -0,0 +1,261 @@
+import contextvars
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named metric with one value per combination of label values."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then the count and sum of all observations
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    def snapshot(self, **labels):
+        """Return (count, sum) of the observations with these labels."""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return (0, 0.0) if state is None else (state[1], state[2])
+
+    def _samples(self, key, state):
+        counts, count, total = state
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+            samples.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+        samples.append(f"{self.name}_bucket{labels} {count}")
+        samples.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        samples.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+        return samples
+
+
+class Registry:
+    """The process's metrics, rendered in the Prometheus text format by GET /metrics."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+REQUESTS = REGISTRY.counter(
+    "sbs_http_requests_total", "HTTP requests handled", ["method", "route", "status"]
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "sbs_http_request_duration_seconds",
+    "Time from receiving a request to sending the last of its response",
+    ["method", "route", "status"],
+)
+REQUEST_QUERIES = REGISTRY.histogram(
+    "sbs_http_request_db_queries", "Database statements executed per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 1000),
+)
+REQUEST_QUERY_SECONDS = REGISTRY.histogram(
+    "sbs_http_request_db_seconds", "Time spent executing database statements per request", ["route"]
+)
+QUERIES = REGISTRY.counter("sbs_db_queries_total", "Database statements executed")
+QUERY_SECONDS = REGISTRY.counter("sbs_db_query_seconds_total", "Time spent executing database statements")
+
+# Route of requests no route matched, so unknown paths don't each become a label value
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class QueryStats:
+    """Database statements run on behalf of one request."""
+
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Set by MetricsMiddleware for each request. Sync endpoints run on the threadpool and async
+# ones in greenlets, and both see the request's context, so statements are counted either way.
+_query_stats = contextvars.ContextVar("sbs_query_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.sbs_query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.sbs_query_started
+    QUERIES.inc()
+    QUERY_SECONDS.inc(elapsed)
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+
+
+QUERY_LISTENERS = [
+    ("before_cursor_execute", _before_cursor_execute),
+    ("after_cursor_execute", _after_cursor_execute),
+]
+
+
+def track_queries():
+    """Time every statement run by any engine in this process."""
+    for name, listener in QUERY_LISTENERS:
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+
+
+def untrack_queries():
+    for name, listener in QUERY_LISTENERS:
+        if event.contains(Engine, name, listener):
+            event.remove(Engine, name, listener)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording each request's count, latency and database statements.
+
+    Requests are labelled with the template of the route that handled them (e.g.
+    /accounts/{account_id}), which the router leaves in the scope. Latency runs until the
+    last body chunk is sent, so streamed responses are measured in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        stats = QueryStats()
+        token = _query_stats.set(stats)
+        status = 500  # Unless a response gets started
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _query_stats.reset(token)
+            route = scope.get("route")
+            route = route.path if route is not None else UNMATCHED_ROUTE
+            labels = {"method": scope["method"], "route": route, "status": str(status)}
+            REQUESTS.inc(**labels)
+            REQUEST_SECONDS.observe(time.perf_counter() - started, **labels)
+            REQUEST_QUERIES.observe(stats.count, route=route)
+            REQUEST_QUERY_SECONDS.observe(stats.seconds, route=route)
+
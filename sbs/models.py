@@ -1,13 +1,140 @@
-from sqlalchemy import Column, String, Float
+from datetime import datetime, timezone
+
+from sqlalchemy import DDL, BigInteger, Column, DateTime, Index, Integer, String, Text, event, func
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.sql.functions import FunctionElement
+
+from sbs.money import from_cents, to_cents
 
 Base = declarative_base()
 
 
+class lower_name(FunctionElement):
+    """
+    A name lowercased for search, compared bytewise.
+
+    On PostgreSQL this is lower(name) COLLATE "C", so a prefix is a range of the index
+    whatever the database's locale; SQLite compares strings bytewise already.
+    """
+    type = String()
+    inherit_cache = True
+    name = "lower_name"
+
+
+@compiles(lower_name)
+def _compile_lower_name(element, compiler, **kw):
+    return f"lower({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(lower_name, "postgresql")
+def _compile_lower_name_postgresql(element, compiler, **kw):
+    return f'lower({compiler.process(element.clauses, **kw)}) COLLATE "C"'
+
+
 class Account(Base):
     __tablename__ = 'accounts'
 
     account_id = Column(String, primary_key=True)
     name = Column(String)
-    balance = Column(Float)
+    balance_cents = Column(BigInteger, nullable=False, default=0)  # Integer minor units
+    # When the row last changed, for GET /save?since=; NULL for rows unchanged since the column was added
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc),
+                        onupdate=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        # Name prefix search, in its keyset order: a range scan that stops after one page
+        Index('ix_accounts_lower_name', lower_name(name), 'account_id'),
+        # Name substring search on PostgreSQL, through pg_trgm
+        Index(
+            'ix_accounts_lower_name_trgm', func.lower(name).label('lower_name'),
+            postgresql_using='gin', postgresql_ops={'lower_name': 'gin_trgm_ops'},
+        ).ddl_if(dialect='postgresql'),
+        # GET /stats reads the smallest and largest balance from either end of this index
+        Index('ix_accounts_balance_cents', 'balance_cents'),
+        # GET /save?since= reads the rows changed after a checkpoint from this index
+        Index('ix_accounts_updated_at', 'updated_at'),
+    )
+
+    @property
+    def balance(self):
+        return None if self.balance_cents is None else from_cents(self.balance_cents)
+
+    @balance.setter
+    def balance(self, amount):
+        self.balance_cents = to_cents(amount)
+
+
+event.listen(
+    Account.__table__, "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
+
+class AccountTombstone(Base):
+    """Deleted account, so a delta snapshot since before the delete can delete it too."""
+    __tablename__ = 'account_tombstones'
+
+    account_id = Column(String, primary_key=True)
+    deleted_at = Column(DateTime(timezone=True), nullable=False, index=True,
+                        default=lambda: datetime.now(timezone.utc))
+
+
+class Transaction(Base):
+    """Append-only ledger entry, written in the same transaction as the balance change."""
+    __tablename__ = 'transactions'
+    __table_args__ = (
+        # Per-account history, newest first, is a range scan on this index
+        Index('ix_transactions_account_created', 'account_id', 'created_at', 'transaction_id'),
+    )
+
+    transaction_id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    account_id = Column(String, nullable=False)
+    kind = Column(String, nullable=False)
+    amount_cents = Column(BigInteger, nullable=False)  # Signed change to the balance
+    balance_cents = Column(BigInteger, nullable=False)  # Balance after the change
+    counterparty_id = Column(String)  # The other account of a transfer
+    created_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    @property
+    def amount(self):
+        return from_cents(self.amount_cents)
+
+    @amount.setter
+    def amount(self, amount):
+        self.amount_cents = to_cents(amount)
+
+    @property
+    def balance(self):
+        return from_cents(self.balance_cents)
+
+    @balance.setter
+    def balance(self, amount):
+        self.balance_cents = to_cents(amount)
+
+
+class IdempotencyKey(Base):
+    """Response recorded for an Idempotency-Key, returned again to retries of the same request."""
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String(64), nullable=False)  # Hash of the request the key was first used for
+    response = Column(Text, nullable=False)  # JSON body of the first response
+    # Indexed so expired keys can be found and pruned in batches
+    created_at = Column(DateTime(timezone=True), nullable=False, index=True,
+                        default=lambda: datetime.now(timezone.utc))
+
+
+class AccountStats(Base):
+    """
+    Account count and balance total of one histogram bucket, spread over several stripes.
+
+    Every balance change adds to one stripe's rows in the same transaction, so concurrent
+    writers rarely wait on the same row; totals are the sum over all stripes.
+    """
+    __tablename__ = 'account_stats'
 
+    stripe = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)  # Index into sbs.stats.BALANCE_BUCKETS
+    accounts = Column(BigInteger, nullable=False, default=0)
+    balance_cents = Column(BigInteger, nullable=False, default=0)
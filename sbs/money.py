@@ -0,0 +1,34 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+
+# Balances and amounts are stored and computed as integer cents; Decimal is only used to
+# convert to and from the decimal amounts clients send and receive
+CENT = Decimal("0.01")
+MAX_CENTS = 2 ** 63 - 1  # BIGINT range
+
+
+def to_cents(amount):
+    """
+    Convert a decimal amount (Decimal, str, int or float) to integer cents.
+
+    Floats go through their shortest repr, so 0.1 is 10 cents rather than the binary
+    value's 10.000000000000000555. Sub-cent digits are rounded half to even.
+    """
+    if isinstance(amount, float):
+        amount = repr(amount)
+    try:
+        cents = int(Decimal(amount).quantize(CENT, rounding=ROUND_HALF_EVEN).scaleb(2))
+    except (InvalidOperation, ValueError, TypeError):
+        raise ValueError(f"Invalid amount '{amount}'")
+    if abs(cents) > MAX_CENTS:
+        raise ValueError(f"Amount '{amount}' is out of range")
+    return cents
+
+
+def from_cents(cents):
+    """Convert integer cents to a Decimal amount with two decimal places."""
+    return Decimal(cents).scaleb(-2)
+
+
+def format_cents(cents):
+    """Format integer cents as a plain decimal string, e.g. 12345 -> '123.45'."""
+    return str(from_cents(cents))
@@ -0,0 +1,128 @@
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func, select, text
+
+# How long a reader waits for room in the queue before checking whether the export was abandoned
+_PUT_TIMEOUT = 0.1
+_DONE = object()
+
+
+def supported(bind):
+    """
+    Whether bind can be read in parallel under one snapshot.
+
+    That takes PostgreSQL's exported snapshots, read over a sync driver, since the readers
+    are threads; SQLite has no way to share a snapshot between connections.
+    """
+    return bind.dialect.name == "postgresql" and not bind.dialect.is_async
+
+
+def key_ranges(conn, column, count):
+    """
+    Split the values of column into at most count ranges of about the same number of rows.
+
+    Returns (low, high) pairs covering every value, low inclusive and high exclusive, with
+    None for no bound. The boundaries come from PostgreSQL's statistics for the column
+    when it has any, which costs nothing; otherwise from an index scan of the column.
+    """
+    bounds = None
+    if conn.dialect.name == "postgresql":
+        stmt = text(
+            "SELECT histogram_bounds::text::text[] FROM pg_stats "
+            "WHERE schemaname = current_schema() AND tablename = :table AND attname = :column"
+        )
+        histogram = conn.execute(stmt, {"table": column.table.name, "column": column.name}).scalar()
+        if histogram and len(histogram) > count:
+            bounds = [histogram[len(histogram) * i // count] for i in range(1, count)]
+    if bounds is None:
+        rows = conn.execute(select(func.count()).select_from(column.table)).scalar_one()
+        stmt = select(column).order_by(column).limit(1)
+        bounds = [conn.execute(stmt.offset(rows * i // count)).scalar() for i in range(1, count)]
+
+    # The database orders the boundaries; only drop repeats, and any past the last row
+    bounds = [bound for i, bound in enumerate(bounds) if bound is not None and (i == 0 or bound != bounds[i - 1])]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def _export_snapshot(conn):
+    """Start a REPEATABLE READ transaction other connections can share the snapshot of, and return its ID."""
+    if conn.dialect.name != "postgresql":
+        return None
+    conn.execution_options(isolation_level="REPEATABLE READ")
+    snapshot_id = conn.execute(text("SELECT pg_export_snapshot()")).scalar_one()
+    if not re.fullmatch(r"[0-9A-Fa-f-]+", snapshot_id):
+        raise ValueError(f"Unexpected snapshot ID '{snapshot_id}'")
+    return snapshot_id
+
+
+def _import_snapshot(conn, snapshot_id):
+    """Start a transaction reading the snapshot _export_snapshot returned; the first thing it does."""
+    if snapshot_id is not None:
+        conn.execution_options(isolation_level="REPEATABLE READ")
+        # Checked by _export_snapshot, since SET doesn't take parameters
+        conn.execute(text(f"SET TRANSACTION SNAPSHOT '{snapshot_id}'"))
+
+
+def read(bind, stmt, column, count, batch_size):
+    """
+    Yield the rows of stmt in lists of up to batch_size, read over count ranges of column at once.
+
+    Each range is read by a thread on a connection of its own. On PostgreSQL they all read
+    the snapshot of one REPEATABLE READ transaction, which stays open until the last row has
+    been read, so together they see the table as a single query would. Rows come out in the
+    order the readers produce them rather than in key order. An error in any reader is
+    raised here, and closing the generator early stops the readers.
+    """
+    with bind.connect() as coordinator:
+        snapshot_id = _export_snapshot(coordinator)
+        ranges = key_ranges(coordinator, column, count)
+
+        # Bounded, so readers wait for the consumer rather than buffer the whole table
+        batches = queue.Queue(maxsize=2 * len(ranges))
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=_PUT_TIMEOUT)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def read_range(low, high):
+            try:
+                ranged = stmt
+                if low is not None:
+                    ranged = ranged.where(column >= low)
+                if high is not None:
+                    ranged = ranged.where(column < high)
+                with bind.connect() as conn:
+                    _import_snapshot(conn, snapshot_id)
+                    result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(ranged)
+                    for rows in result.partitions():
+                        if not put(rows):
+                            return
+            except BaseException as exc:
+                put(exc)
+            finally:
+                put(_DONE)
+
+        with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="sbs-export") as readers:
+            for low, high in ranges:
+                readers.submit(read_range, low, high)
+            try:
+                running = len(ranges)
+                while running:
+                    item = batches.get()
+                    if item is _DONE:
+                        running -= 1
+                    elif isinstance(item, BaseException):
+                        raise item
+                    else:
+                        yield item
+            finally:
+                stopped.set()
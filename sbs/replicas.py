@@ -0,0 +1,79 @@
+import threading
+import time
+from http.cookies import SimpleCookie
+
+# Cookie holding the time until which a client that wrote reads from the primary
+PRIMARY_COOKIE = "sbs_primary_until"
+
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class ReplicaSet:
+    """
+    Read replica engines, handed out round-robin.
+
+    A replica whose connection failed is left out for retry_interval seconds, then tried
+    again; callers report failures with mark_down.
+    """
+
+    def __init__(self, engines, retry_interval):
+        self.engines = list(engines)
+        self.retry_interval = retry_interval
+        self._next = 0
+        self._down_until = {}
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.engines)
+
+    def candidates(self):
+        """Return the healthy replicas, starting with the one whose turn it is."""
+        with self._lock:
+            now = time.monotonic()
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.engines), 1)
+            ordered = self.engines[start:] + self.engines[:start]
+            return [engine for engine in ordered if self._down_until.get(engine, 0.0) <= now]
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry_interval
+
+
+def pinned_to_primary(request):
+    """Whether the client wrote recently enough that it should read from the primary."""
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReadYourWritesMiddleware:
+    """
+    ASGI middleware pinning a client to the primary for window seconds after each write.
+
+    Successful requests with an unsafe method get a cookie saying until when; read
+    dependencies check it, so a client doesn't read a replica that hasn't caught up yet.
+    """
+
+    def __init__(self, app, window):
+        self.app = app
+        self.window = window
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                cookie = SimpleCookie()
+                cookie[PRIMARY_COOKIE] = f"{time.time() + self.window:.3f}"
+                cookie[PRIMARY_COOKIE]["max-age"] = int(self.window) + 1
+                cookie[PRIMARY_COOKIE]["path"] = "/"
+                cookie[PRIMARY_COOKIE]["httponly"] = True
+                header = cookie.output(header="").strip().encode("latin-1")
+                message = dict(message, headers=[*message.get("headers", []), (b"set-cookie", header)])
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
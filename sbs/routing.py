@@ -0,0 +1,72 @@
+import functools
+import inspect
+
+from fastapi import APIRouter, Depends, params
+from fastapi.routing import APIRoute
+
+from sbs.db import get_db, get_async_db, get_read_db, get_async_read_db
+
+# Sync session dependencies and the async dependency that replaces each in async mode
+ASYNC_DEPENDENCIES = {get_db: get_async_db, get_read_db: get_async_read_db}
+
+
+def async_endpoint(func):
+    """
+    Wrap a sync endpoint so it runs on the event loop.
+
+    Session parameters are re-declared against the async dependency and the body runs
+    through AsyncSession.run_sync, which drives the database driver from a greenlet on
+    the event loop rather than from a threadpool worker. An endpoint taking more than one
+    session gets the others' sync sessions, which work from that same greenlet.
+    """
+    signature = inspect.signature(func)
+    session_params = []
+    parameters = []
+    for param in signature.parameters.values():
+        default = param.default
+        if isinstance(default, params.Depends) and default.dependency in ASYNC_DEPENDENCIES:
+            session_params.append(param.name)
+            param = param.replace(default=Depends(ASYNC_DEPENDENCIES[default.dependency]))
+        parameters.append(param)
+
+    if not session_params:
+        return func
+
+    @functools.wraps(func)
+    async def wrapper(**kwargs):
+        # Run the whole body against the first session
+        name, *others = session_params
+        async_session = kwargs.pop(name)
+        for other in others:
+            kwargs[other] = kwargs[other].sync_session
+        return await async_session.run_sync(lambda session: func(**kwargs, **{name: session}))
+
+    wrapper.__signature__ = signature.replace(parameters=parameters)
+    return wrapper
+
+
+def async_router(router):
+    """Copy a router of sync endpoints, serving each of them from the event loop."""
+    converted = APIRouter()
+    for route in router.routes:
+        if not isinstance(route, APIRoute):
+            converted.routes.append(route)
+            continue
+        converted.add_api_route(
+            route.path,
+            async_endpoint(route.endpoint),
+            response_model=route.response_model,
+            status_code=route.status_code,
+            tags=route.tags,
+            summary=route.summary,
+            description=route.description,
+            response_description=route.response_description,
+            responses=route.responses,
+            deprecated=route.deprecated,
+            methods=route.methods,
+            operation_id=route.operation_id,
+            include_in_schema=route.include_in_schema,
+            response_class=route.response_class,
+            name=route.name,
+        )
+    return converted
@@ -1,7 +1,46 @@
+from decimal import Decimal
+from typing import List
+
 from pydantic import BaseModel, Field
 
+from sbs.config import BATCH_CREATE_MAX_ITEMS, BATCH_TRANSFER_MAX_ITEMS, LOOKUP_MAX_IDS
+
 
 # Pagination parameters model
 class PaginationParams(BaseModel):
     page: int = Field(1, ge=1, description="Page number (starting from 1)")
     page_size: int = Field(10, ge=1, description="Number of records per page")
+
+
+# Request body for the multi-account lookup endpoint
+class AccountLookupRequest(BaseModel):
+    account_ids: List[str] = Field(
+        ..., min_length=1, max_length=LOOKUP_MAX_IDS, description="Accounts to fetch"
+    )
+
+
+# A single account to create inside a batch
+class AccountCreateItem(BaseModel):
+    name: str = Field(..., description="Account holder's name")
+    starting_balance: Decimal = Field(..., decimal_places=2, description="Opening balance")
+
+
+# Request body for the batch account creation endpoint
+class BatchCreateAccountsRequest(BaseModel):
+    accounts: List[AccountCreateItem] = Field(
+        ..., min_length=1, max_length=BATCH_CREATE_MAX_ITEMS, description="Accounts to create, in order"
+    )
+
+
+# A single transfer inside a batch
+class TransferItem(BaseModel):
+    sender_id: str = Field(..., description="Account the money is taken from")
+    recipient_id: str = Field(..., description="Account the money is paid into")
+    amount: Decimal = Field(..., decimal_places=2, description="Amount to transfer")
+
+
+# Request body for the batch transfer endpoint
+class BatchTransferRequest(BaseModel):
+    transfers: List[TransferItem] = Field(
+        ..., min_length=1, max_length=BATCH_TRANSFER_MAX_ITEMS, description="Transfers to apply, in order"
+    )
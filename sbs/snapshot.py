@@ -0,0 +1,282 @@
+import csv
+import gzip
+import io
+import struct
+import zlib
+
+from fastapi import HTTPException
+
+from sbs.money import format_cents
+
+try:
+    import zstandard
+except ImportError:  # Optional: enables csv.zst
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # Optional: enables arrow
+    pyarrow = None
+
+# Formats /save writes and /load reads, selected with their format= parameter
+FORMATS = ("csv", "csv.gz", "csv.zst", "binary", "arrow")
+CSV_FORMATS = ("csv", "csv.gz", "csv.zst")
+
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "csv.gz": "application/gzip",
+    "csv.zst": "application/zstd",
+    "binary": "application/octet-stream",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+EXTENSIONS = {
+    "csv": ".csv",
+    "csv.gz": ".csv.gz",
+    "csv.zst": ".csv.zst",
+    "binary": ".sbs",
+    "arrow": ".arrows",
+}
+
+# Packages the optional formats need
+_REQUIREMENTS = {"csv.zst": ("zstandard", lambda: zstandard), "arrow": ("pyarrow", lambda: pyarrow)}
+
+
+class CorruptSnapshot(Exception):
+    """The uploaded data isn't valid for its format."""
+
+
+def require(snapshot_format):
+    """Raise a 400 if snapshot_format needs a package that isn't installed."""
+    package, module = _REQUIREMENTS.get(snapshot_format, (None, lambda: True))
+    if module() is None:
+        raise HTTPException(status_code=400, detail=f"format '{snapshot_format}' needs the {package} package")
+
+
+class CsvEncoder:
+    """
+    Writes rows as CSV with a balance column in decimal, compressed for csv.gz and csv.zst.
+
+    A delta has an op column first: "upsert" for rows written with write(), "delete" for
+    account IDs written with write_deletes(). Each method returns the bytes to send next; a
+    compressor may hold some back until it has enough to compress, so those can be empty.
+    """
+
+    def __init__(self, snapshot_format="csv", delta=False):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.delta = delta
+        if snapshot_format == "csv.gz":
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+        elif snapshot_format == "csv.zst":
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            self.compressor = None
+
+    def _output(self):
+        data = _drain(self.buffer).encode("utf-8")
+        return data if self.compressor is None else self.compressor.compress(data)
+
+    def start(self):
+        self.writer.writerow((["op"] if self.delta else []) + ["account_id", "name", "balance"])
+        return self._output()
+
+    def write(self, rows):
+        rows = ((account_id, name, format_cents(cents)) for account_id, name, cents in rows)
+        self.writer.writerows((("upsert",) + row for row in rows) if self.delta else rows)
+        return self._output()
+
+    def write_deletes(self, account_ids):
+        self.writer.writerows(("delete", account_id, "", "") for account_id in account_ids)
+        return self._output()
+
+    def finish(self):
+        return b"" if self.compressor is None else self.compressor.flush()
+
+
+class _CheckedReader(io.RawIOBase):
+    """File object turning the errors a decompressor raises on bad data into CorruptSnapshot."""
+
+    def __init__(self, stream, errors):
+        self.stream = stream
+        self.errors = errors
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        try:
+            return self.stream.read(size)
+        except self.errors as exc:
+            raise CorruptSnapshot(f"Invalid compressed data: {exc}") from exc
+
+
+def decompress(snapshot_format, binary):
+    """Return a file object reading the CSV out of an uploaded csv, csv.gz or csv.zst file, as it is read."""
+    if snapshot_format == "csv.gz":
+        return _CheckedReader(gzip.GzipFile(fileobj=binary, mode="rb"), (OSError, EOFError, zlib.error))
+    if snapshot_format == "csv.zst":
+        reader = zstandard.ZstdDecompressor().stream_reader(binary, read_across_frames=True)
+        return _CheckedReader(reader, zstandard.ZstdError)
+    return binary
+
+
+# The binary format, version 1. All integers are little-endian.
+#
+#   magic   8 bytes  b"SBSSNAP1"
+#   blocks  any number of:
+#           u32 payload length in bytes, u32 row count, then the payload: row count rows of
+#               u16 account_id length, account_id (UTF-8)
+#               i32 name length, or -1 for no name, name (UTF-8)
+#               i64 balance in cents
+#   end     a block header with a row count of 0 (and a payload length of 0)
+#
+# The end block tells a complete snapshot from a truncated one.
+BINARY_MAGIC = b"SBSSNAP1"
+_BLOCK = struct.Struct("<II")
+_ID_LENGTH = struct.Struct("<H")
+_NAME_LENGTH = struct.Struct("<i")
+_BALANCE = struct.Struct("<q")
+MAX_BLOCK_BYTES = 64 * 1024 * 1024  # Larger blocks are refused rather than read into memory
+
+
+class BinaryEncoder:
+    """Writes rows in the binary format, one block per write."""
+
+    def start(self):
+        return BINARY_MAGIC
+
+    def write(self, rows):
+        payload = bytearray()
+        for account_id, name, cents in rows:
+            encoded_id = account_id.encode("utf-8")
+            payload += _ID_LENGTH.pack(len(encoded_id))
+            payload += encoded_id
+            if name is None:
+                payload += _NAME_LENGTH.pack(-1)
+            else:
+                encoded_name = name.encode("utf-8")
+                payload += _NAME_LENGTH.pack(len(encoded_name))
+                payload += encoded_name
+            payload += _BALANCE.pack(cents)
+        if not rows:
+            return b""  # A block without rows would end the snapshot
+        return _BLOCK.pack(len(payload), len(rows)) + bytes(payload)
+
+    def finish(self):
+        return _BLOCK.pack(0, 0)
+
+
+def _read_exactly(binary, size):
+    data = binary.read(size)
+    while len(data) < size:
+        more = binary.read(size - len(data))
+        if not more:
+            raise CorruptSnapshot("Snapshot is truncated")
+        data += more
+    return data
+
+
+def decode_binary(binary):
+    """
+    Yield (account_id, name, cents) rows from a binary snapshot, a block at a time.
+
+    Raises CorruptSnapshot where the data stops following the format.
+    """
+    if binary.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise CorruptSnapshot("Not a binary snapshot")
+    while True:
+        length, count = _BLOCK.unpack(_read_exactly(binary, _BLOCK.size))
+        if count == 0:
+            return
+        if length > MAX_BLOCK_BYTES:
+            raise CorruptSnapshot(f"Block of {length} bytes is too large")
+        payload = _read_exactly(binary, length)
+        offset = 0
+        try:
+            for _ in range(count):
+                (id_length,) = _ID_LENGTH.unpack_from(payload, offset)
+                offset += _ID_LENGTH.size
+                account_id = payload[offset:offset + id_length].decode("utf-8")
+                offset += id_length
+                (name_length,) = _NAME_LENGTH.unpack_from(payload, offset)
+                offset += _NAME_LENGTH.size
+                name = None
+                if name_length >= 0:
+                    name = payload[offset:offset + name_length].decode("utf-8")
+                    offset += name_length
+                (cents,) = _BALANCE.unpack_from(payload, offset)
+                offset += _BALANCE.size
+                yield account_id, name, cents
+        except (struct.error, UnicodeDecodeError) as exc:
+            raise CorruptSnapshot(f"Invalid block: {exc}") from exc
+        if offset != length:
+            raise CorruptSnapshot("Block length doesn't match its rows")
+
+
+def _arrow_schema():
+    return pyarrow.schema([
+        ("account_id", pyarrow.string()),
+        ("name", pyarrow.string()),
+        ("balance_cents", pyarrow.int64()),
+    ])
+
+
+class ArrowEncoder:
+    """Writes rows as an Arrow IPC stream, one record batch per write."""
+
+    def __init__(self):
+        self.schema = _arrow_schema()
+        self.sink = io.BytesIO()
+        self.writer = None
+
+    def start(self):
+        self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+        return _drain(self.sink)
+
+    def write(self, rows):
+        if rows:
+            columns = [list(column) for column in zip(*rows)]
+            self.writer.write_batch(pyarrow.record_batch(columns, schema=self.schema))
+        return _drain(self.sink)
+
+    def finish(self):
+        self.writer.close()
+        return _drain(self.sink)
+
+
+def encoder(snapshot_format, delta=False):
+    """
+    Return an encoder for snapshot_format: start(), then write(rows) per batch of rows, then finish().
+
+    Only the CSV formats can hold a delta.
+    """
+    if snapshot_format == "binary":
+        return BinaryEncoder()
+    if snapshot_format == "arrow":
+        return ArrowEncoder()
+    return CsvEncoder(snapshot_format, delta)
+
+
+def decode_arrow(binary):
+    """Yield (account_id, name, cents) rows from an Arrow IPC stream, a record batch at a time."""
+    try:
+        reader = pyarrow.ipc.open_stream(binary)
+        missing = {"account_id", "name", "balance_cents"} - set(reader.schema.names)
+        if missing:
+            raise CorruptSnapshot(f"Arrow stream missing '{sorted(missing)[0]}'")
+        for batch in reader:
+            yield from zip(
+                batch.column("account_id").to_pylist(),
+                batch.column("name").to_pylist(),
+                batch.column("balance_cents").to_pylist(),
+            )
+    except pyarrow.ArrowException as exc:
+        raise CorruptSnapshot(f"Invalid Arrow stream: {exc}") from exc
+
+
+def _drain(buffer):
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return data
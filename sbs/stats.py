@@ -0,0 +1,181 @@
+import random
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sqlalchemy import case, func, select
+
+from sbs.db import session_runner
+from sbs.metrics import REGISTRY
+from sbs.models import Account, AccountStats
+
+# Upper bounds, in cents, of the balance histogram buckets; a last bucket holds the rest
+BALANCE_BUCKETS = (0, 10_00, 100_00, 1_000_00, 10_000_00, 100_000_00, 1_000_000_00)
+
+STATS_RECONCILIATIONS = REGISTRY.counter(
+    "sbs_stats_reconciliations_total", "Full scans comparing the GET /stats counters with the accounts"
+)
+STATS_DRIFT = REGISTRY.gauge(
+    "sbs_stats_drift", "Difference between the accounts and the GET /stats counters found by the last scan",
+    ["field"],
+)
+
+
+def bucket_of(cents):
+    return bisect_left(BALANCE_BUCKETS, cents)
+
+
+def _increment(db):
+    """INSERT ... ON CONFLICT DO UPDATE adding to a counter row, for the session's database."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upserts are not supported on '{dialect}'")
+
+    stmt = insert(AccountStats)
+    return stmt.on_conflict_do_update(
+        index_elements=[AccountStats.stripe, AccountStats.bucket],
+        set_={
+            "accounts": AccountStats.accounts + stmt.excluded.accounts,
+            "balance_cents": AccountStats.balance_cents + stmt.excluded.balance_cents,
+        },
+    )
+
+
+class BalanceStats:
+    """
+    Account count, balance total and balance histogram, kept up to date by the writers.
+
+    Writers add their changes to the account_stats counters in their own transaction, so
+    the counters commit or roll back with the balances, and reading them costs the same
+    whatever the number of accounts. The smallest and largest balance come from the ends
+    of the balance index instead, since they can't be maintained by adding.
+
+    Every reconcile_interval seconds, a read of the stats also starts a full scan in the
+    background that compares the counters with the accounts and corrects any drift.
+    """
+
+    def __init__(self, stripes, reconcile_interval):
+        self.stripes = stripes
+        self.reconcile_interval = reconcile_interval
+        self.reconciled_at = None
+        # Reconcile on the first read, which also fills in counters for an existing database
+        self._next_reconcile = time.monotonic()
+        self._reconcile_lock = threading.Lock()
+        self._reconciler = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sbs-stats-reconcile")
+
+    def record(self, db, changes):
+        """
+        Add balance changes to the counters in the current transaction.
+
+        changes are (old cents, new cents) pairs, with None as the old balance of a new
+        account and the new balance of a deleted one.
+        """
+        deltas = {}
+        for old, new in changes:
+            if old is not None:
+                delta = deltas.setdefault(bucket_of(old), [0, 0])
+                delta[0] -= 1
+                delta[1] -= old
+            if new is not None:
+                delta = deltas.setdefault(bucket_of(new), [0, 0])
+                delta[0] += 1
+                delta[1] += new
+        self._add(db, random.randrange(self.stripes), deltas)
+
+    def _add(self, db, stripe, deltas):
+        # In bucket order, so transactions sharing a stripe lock its rows in the same order
+        rows = [
+            {"stripe": stripe, "bucket": bucket, "accounts": accounts, "balance_cents": cents}
+            for bucket, (accounts, cents) in sorted(deltas.items())
+            if accounts or cents
+        ]
+        if rows:
+            db.connection().execute(_increment(db), rows)
+
+    def read(self, db):
+        """Return the totals, the smallest and largest balance and the histogram, all in cents."""
+        stmt = (
+            select(AccountStats.bucket, func.sum(AccountStats.accounts), func.sum(AccountStats.balance_cents))
+            .group_by(AccountStats.bucket)
+        )
+        counters = {bucket: (int(accounts), int(cents)) for bucket, accounts, cents in db.execute(stmt)}
+
+        # Separate subqueries, since SQLite only reads one end of an index per aggregate query
+        stmt = select(
+            select(func.min(Account.balance_cents)).scalar_subquery(),
+            select(func.max(Account.balance_cents)).scalar_subquery(),
+        )
+        smallest, largest = db.execute(stmt).one()
+
+        histogram = [
+            {
+                "le": BALANCE_BUCKETS[bucket] if bucket < len(BALANCE_BUCKETS) else None,
+                "accounts": counters.get(bucket, (0, 0))[0],
+                "balance_cents": counters.get(bucket, (0, 0))[1],
+            }
+            for bucket in range(len(BALANCE_BUCKETS) + 1)
+        ]
+        return {
+            "accounts": sum(entry["accounts"] for entry in histogram),
+            "balance_cents": sum(entry["balance_cents"] for entry in histogram),
+            "min_balance_cents": smallest,
+            "max_balance_cents": largest,
+            "histogram": histogram,
+        }
+
+    def reconcile(self, db):
+        """
+        Compare the counters with a scan of the accounts and add corrections for any drift.
+
+        The scan and the counters are read from one snapshot (REPEATABLE READ on PostgreSQL),
+        so changes committed meanwhile don't count as drift; this has to be the first thing
+        the session's transaction does. Leaves committing to the caller and returns the
+        drift as {bucket: (accounts, cents)}.
+        """
+        if db.get_bind().dialect.name == "postgresql":
+            db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+
+        bucket_of_balance = case(
+            *((Account.balance_cents <= bound, index) for index, bound in enumerate(BALANCE_BUCKETS)),
+            else_=len(BALANCE_BUCKETS),
+        )
+        stmt = (
+            select(bucket_of_balance, func.count(), func.sum(Account.balance_cents))
+            .group_by(bucket_of_balance)
+        )
+        actual = {bucket: (int(accounts), int(cents)) for bucket, accounts, cents in db.execute(stmt)}
+        stmt = (
+            select(AccountStats.bucket, func.sum(AccountStats.accounts), func.sum(AccountStats.balance_cents))
+            .group_by(AccountStats.bucket)
+        )
+        counted = {bucket: (int(accounts), int(cents)) for bucket, accounts, cents in db.execute(stmt)}
+
+        drift = {}
+        for bucket in actual.keys() | counted.keys():
+            accounts, cents = actual.get(bucket, (0, 0))
+            counted_accounts, counted_cents = counted.get(bucket, (0, 0))
+            if (accounts, cents) != (counted_accounts, counted_cents):
+                drift[bucket] = (accounts - counted_accounts, cents - counted_cents)
+        self._add(db, 0, {bucket: list(delta) for bucket, delta in drift.items()})
+
+        STATS_RECONCILIATIONS.inc()
+        STATS_DRIFT.set(sum(abs(accounts) for accounts, _ in drift.values()), field="accounts")
+        STATS_DRIFT.set(sum(abs(cents) for _, cents in drift.values()), field="balance_cents")
+        self.reconciled_at = datetime.now(timezone.utc)
+        return drift
+
+    def schedule_reconcile(self, db, work):
+        """Run work(session) in the background if reconcile_interval has passed since the last run."""
+        with self._reconcile_lock:
+            now = time.monotonic()
+            if now < self._next_reconcile:
+                return
+            self._next_reconcile = now + self.reconcile_interval
+        run = session_runner(db)
+        self._reconciler.submit(run, work)
@@ -0,0 +1,69 @@
+import time
+
+from sbs.cache import LRUCache
+
+
+def test_lru_cache_hits_and_misses():
+    """
+    Test that the cache returns stored values and counts hits and misses.
+    """
+    cache = LRUCache(maxsize=10, ttl=60)
+    assert cache.get("a") is None
+    cache.put("a", 1, cache.token())
+    assert cache.get("a") == 1
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["size"] == 1
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """
+    Test that the cache stays within maxsize, evicting the least recently used entry.
+    """
+    cache = LRUCache(maxsize=2, ttl=60)
+    for key in ("a", "b"):
+        cache.put(key, key, cache.token())
+    cache.get("a")
+    cache.put("c", "c", cache.token())
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert cache.get("c") == "c"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_cache_expires_entries():
+    """
+    Test that entries older than the TTL are treated as misses.
+    """
+    cache = LRUCache(maxsize=10, ttl=0)
+    cache.put("a", 1, cache.token())
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_lru_cache_entry_ttl():
+    """
+    Test that an entry can be given a shorter TTL than the cache's, but not a longer one.
+    """
+    cache = LRUCache(maxsize=10, ttl=60)
+    cache.put("short", 1, cache.token(), ttl=0)
+    cache.put("long", 2, cache.token(), ttl=3600)
+    assert cache.get("short") is None
+    assert cache._entries["long"][0] <= time.monotonic() + 60
+
+
+def test_lru_cache_drops_fills_racing_an_invalidation():
+    """
+    Test that a value read before an invalidation is not cached after it.
+    """
+    cache = LRUCache(maxsize=10, ttl=60)
+    token = cache.token()  # A reader starts its database read...
+    cache.invalidate("a")  # ...a writer commits and invalidates...
+    cache.put("a", "stale", token)  # ...and the reader's fill is dropped
+    assert cache.get("a") is None
+
+    cache.put("a", "fresh", cache.token())
+    assert cache.get("a") == "fresh"
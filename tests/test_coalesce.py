@@ -0,0 +1,135 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.util import greenlet_spawn
+
+from sbs.coalesce import Coalescer
+
+
+def fake_db(engine):
+    return SimpleNamespace(get_bind=lambda: engine)
+
+
+sync_db = fake_db(create_engine("sqlite://"))
+
+
+class Recorder:
+    """apply() returning each item's running total, like deposits to one balance."""
+
+    def __init__(self):
+        self.calls = []
+        self.total = 0
+
+    def __call__(self, db, key, items):
+        self.calls.append((key, items))
+        results = []
+        for item in items:
+            self.total += item
+            results.append(self.total)
+        return results
+
+
+def submit_concurrently(coalescer, key, items):
+    results = [None] * len(items)
+    barrier = threading.Barrier(len(items))
+
+    def run(index):
+        barrier.wait()
+        results[index] = coalescer.submit(sync_db, key, items[index])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(items))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_submits_are_applied_once():
+    """
+    Test that submits arriving within the window are applied together, each getting its own result.
+    """
+    apply = Recorder()
+    coalescer = Coalescer(window=0.2, max_batch=100, apply=apply)
+
+    results = submit_concurrently(coalescer, "a", [1] * 8)
+
+    assert len(apply.calls) == 1
+    assert apply.calls[0] == ("a", [1] * 8)
+    assert sorted(results) == list(range(1, 9))
+
+
+def test_keys_are_batched_separately():
+    """
+    Test that submits for different keys don't share a batch.
+    """
+    apply = Recorder()
+    coalescer = Coalescer(window=0.01, max_batch=100, apply=apply)
+
+    assert coalescer.submit(sync_db, "a", 5) == 5
+    assert coalescer.submit(sync_db, "b", 7) == 12
+    assert [key for key, _ in apply.calls] == ["a", "b"]
+
+
+def test_full_batch_takes_no_more_items():
+    """
+    Test that a batch stops taking items at max_batch.
+    """
+    apply = Recorder()
+    coalescer = Coalescer(window=0.2, max_batch=2, apply=apply)
+
+    submit_concurrently(coalescer, "a", [1] * 6)
+
+    assert sum(len(items) for _, items in apply.calls) == 6
+    assert all(len(items) <= 2 for _, items in apply.calls)
+
+
+def test_error_reaches_every_caller():
+    """
+    Test that an exception from apply is raised in every caller of the batch.
+    """
+    def fail(db, key, items):
+        raise LookupError(key)
+
+    coalescer = Coalescer(window=0.2, max_batch=100, apply=fail)
+    errors = []
+    barrier = threading.Barrier(4)
+
+    def run():
+        barrier.wait()
+        try:
+            coalescer.submit(sync_db, "a", 1)
+        except LookupError as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 4
+    # The failed batch is gone; the next submit starts a new one
+    coalescer.apply = Recorder()
+    assert coalescer.submit(sync_db, "a", 3) == 3
+
+
+def test_async_callers_wait_on_the_event_loop():
+    """
+    Test that callers from greenlets on the event loop are batched and woken up too.
+    """
+    apply = Recorder()
+    coalescer = Coalescer(window=0.05, max_batch=100, apply=apply)
+    async_engine = create_async_engine("sqlite+aiosqlite://")
+    db = fake_db(async_engine.sync_engine)
+
+    async def main():
+        return await asyncio.gather(*(greenlet_spawn(coalescer.submit, db, "a", 1) for _ in range(5)))
+
+    results = asyncio.run(main())
+
+    assert len(apply.calls) == 1
+    assert sorted(results) == [1, 2, 3, 4, 5]
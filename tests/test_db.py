@@ -0,0 +1,75 @@
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+
+from sbs.db import (
+    POOL_CHECKOUT_SECONDS, POOL_CONNECTIONS_IN_USE, POOL_CONNECTIONS_OPENED, async_url, engine_options,
+    instrument, sync_url, timed_pool,
+)
+
+
+def test_sync_url_swaps_async_driver():
+    """
+    Test that async driver URLs are mapped to their sync driver.
+    """
+    url = sync_url("postgresql+asyncpg://postgres:postgres@db:5432/simple_banking_system")
+    assert url.drivername == "postgresql+psycopg2"
+    assert url.database == "simple_banking_system"
+    assert sync_url("sqlite+aiosqlite://").drivername == "sqlite+pysqlite"
+
+
+def test_async_url_swaps_sync_driver():
+    """
+    Test that sync driver URLs are mapped to their async driver.
+    """
+    url = async_url("postgresql://postgres:postgres@db:5432/simple_banking_system")
+    assert url.drivername == "postgresql+asyncpg"
+    assert url.host == "db"
+    assert async_url("sqlite://").drivername == "sqlite+aiosqlite"
+
+
+def test_engine_options_for_postgresql(monkeypatch):
+    """
+    Test that pool settings apply to PostgreSQL, and PgBouncer mode turns off prepared statements.
+    """
+    url = "postgresql://postgres:postgres@db:5432/simple_banking_system"
+    monkeypatch.setattr("sbs.db.POOL_SIZE", 20)
+    monkeypatch.setattr("sbs.db.STATEMENT_TIMEOUT_MS", 5000)
+
+    options = engine_options(url, "sync")
+    assert options["pool_size"] == 20
+    assert options["poolclass"].__name__ == "TimedQueuePool"
+    assert options["connect_args"] == {"options": "-c statement_timeout=5000"}
+    options = engine_options(url, "async")
+    assert options["poolclass"].__name__ == "TimedAsyncAdaptedQueuePool"
+    assert options["connect_args"] == {"server_settings": {"statement_timeout": "5000"}}
+
+    monkeypatch.setattr("sbs.db.PGBOUNCER", True)
+    connect_args = engine_options(url, "async")["connect_args"]
+    assert connect_args["statement_cache_size"] == 0
+    assert connect_args["prepared_statement_cache_size"] == 0
+    assert "server_settings" not in connect_args
+    assert "connect_args" not in engine_options(url, "sync")
+
+
+def test_engine_options_leave_sqlite_pool_alone():
+    """
+    Test that SQLite keeps the pool SQLAlchemy picks for it.
+    """
+    assert "poolclass" not in engine_options("sqlite://", "sync")
+    assert "pool_size" not in engine_options("sqlite+aiosqlite://", "async")
+
+
+def test_instrumented_pool_metrics(tmp_path):
+    """
+    Test that checkouts are timed and connections in use are counted.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=timed_pool(QueuePool, "test"))
+    instrument(engine, "test")
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        assert POOL_CONNECTIONS_IN_USE.value(engine="test") == 1
+    assert POOL_CONNECTIONS_IN_USE.value(engine="test") == 0
+    assert POOL_CONNECTIONS_OPENED.value(engine="test") == 1
+    assert POOL_CHECKOUT_SECONDS.snapshot(engine="test")[0] == 1
+    engine.dispose()
@@ -0,0 +1,96 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from sbs.idempotency import IdempotencyStore, fingerprint
+from sbs.models import Base, IdempotencyKey
+
+engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+Base.metadata.create_all(engine)
+SessionLocal = sessionmaker(autoflush=False, bind=engine)
+
+
+@pytest.fixture
+def db():
+    with SessionLocal() as session:
+        yield session
+        session.rollback()
+        session.query(IdempotencyKey).delete()
+        session.commit()
+
+
+@pytest.fixture
+def store():
+    return IdempotencyStore(ttl=60, cache_size=10, prune_interval=300, prune_batch_size=2)
+
+
+def add_key(db, key, age):
+    db.execute(insert(IdempotencyKey), {
+        "key": key,
+        "fingerprint": fingerprint("deposit", key),
+        "response": "{}",
+        "created_at": datetime.now(timezone.utc) - timedelta(seconds=age),
+    })
+    db.commit()
+
+
+def test_record_and_lookup(db, store):
+    request = fingerprint("deposit", "a", 100)
+    assert store.lookup(db, "k", request) is None
+
+    body = store.record(db, "k", request, {"balance": 1})
+    db.commit()
+    store.remember("k", request, body)
+    assert store.lookup(db, "k", request) == {"balance": 1}
+
+    store.cache.clear()
+    assert store.lookup(db, "k", request) == {"balance": 1}
+    with pytest.raises(HTTPException) as exc:
+        store.lookup(db, "k", fingerprint("deposit", "a", 200))
+    assert exc.value.status_code == 422
+
+
+def test_lookup_caches_for_the_rest_of_the_ttl(db, store, monkeypatch):
+    add_key(db, "aging", age=50)
+    assert store.lookup(db, "aging", fingerprint("deposit", "aging")) == {}
+
+    # Cached until the row expires, 10 seconds from now, rather than for a full ttl
+    now = time.monotonic()
+    monkeypatch.setattr("sbs.cache.time.monotonic", lambda: now + 11)
+    assert store.cache.get("aging") is None
+
+
+def test_expired_key_can_be_recorded_again(db, store):
+    add_key(db, "old", age=120)
+    assert store.lookup(db, "old", fingerprint("deposit", "old")) is None
+
+    # A first attempt rolled back, e.g. by a deadlock, brings the expired row back for the retry
+    store.record(db, "old", fingerprint("withdraw", "old"), {})
+    db.rollback()
+    store.record(db, "old", fingerprint("withdraw", "old"), {"balance": 1})
+    db.commit()
+    assert store.lookup(db, "old", fingerprint("withdraw", "old")) == {"balance": 1}
+
+
+def test_prune_deletes_expired_keys_in_batches(db, store):
+    for i in range(5):
+        add_key(db, f"old-{i}", age=120)
+    add_key(db, "fresh", age=0)
+
+    assert store.prune(db) == 5
+    assert db.execute(select(IdempotencyKey.key)).scalars().all() == ["fresh"]
+    assert store.prune(db) == 0
+
+
+def test_schedule_prune_runs_in_the_background(db):
+    store = IdempotencyStore(ttl=60, cache_size=10, prune_interval=0, prune_batch_size=100)
+    add_key(db, "old", age=120)
+
+    store.schedule_prune(db)
+    store._pruner.shutdown(wait=True)
+    assert db.execute(select(func.count()).select_from(IdempotencyKey)).scalar() == 0
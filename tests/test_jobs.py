@@ -0,0 +1,87 @@
+
+from fastapi import HTTPException
+
+from sbs.jobs import InMemoryJobStore, Job, JobRunner
+
+
+def run_job(work):
+    runner = JobRunner(InMemoryJobStore(), max_workers=1)
+    job = runner.submit("test", work)
+    runner.shutdown(wait=True)
+    return runner.store.get(job.job_id)
+
+
+def test_job_runner_records_progress_and_result():
+    """
+    Test that a successful job reports its rows, result and artifact.
+    """
+    def work(progress):
+        progress(5)
+        progress(10)
+        return {"rows": 10}, "/tmp/artifact.csv"
+
+    job = run_job(work)
+    assert job.status == "succeeded"
+    assert job.rows_processed == 10
+    assert job.result == {"rows": 10}
+    assert job.artifact == "/tmp/artifact.csv"
+    assert job.to_dict()["rows_per_second"] is not None
+
+
+def test_job_runner_records_failures():
+    """
+    Test that exceptions raised by a job become its error.
+    """
+    def rejected(progress):
+        raise HTTPException(status_code=400, detail="CSV missing 'account_id'")
+
+    def crashed(progress):
+        raise RuntimeError("connection lost")
+
+    assert run_job(rejected).error == "CSV missing 'account_id'"
+    job = run_job(crashed)
+    assert job.status == "failed"
+    assert job.error == "connection lost"
+
+
+def test_in_memory_job_store_is_bounded():
+    """
+    Test that the in-memory store forgets the oldest jobs first.
+    """
+    store = InMemoryJobStore(max_jobs=2)
+    jobs = [Job("test") for _ in range(3)]
+    for job in jobs:
+        store.add(job)
+
+    assert store.get(jobs[0].job_id) is None
+    assert store.get(jobs[2].job_id) is jobs[2]
+    store.update(jobs[2].job_id, status="running")
+    assert jobs[2].status == "running"
+
+
+def test_in_memory_job_store_deletes_evicted_artifacts(tmp_path):
+    """
+    Test that forgetting a job deletes its artifact, even one set after it was forgotten.
+    """
+    store = InMemoryJobStore(max_jobs=1)
+    finished, running = Job("test"), Job("test")
+    finished.artifact = str(tmp_path / "finished.csv")
+    late_artifact = tmp_path / "running.csv"
+    for path in (finished.artifact, late_artifact):
+        open(path, "w").close()
+
+    store.add(finished)
+    store.add(running)
+    store.add(Job("test"))
+    assert not (tmp_path / "finished.csv").exists()
+
+    # A job forgotten while running finishes with nowhere to record its artifact
+    store.update(running.job_id, status="succeeded", artifact=str(late_artifact))
+    assert not late_artifact.exists()
+
+    # Forgetting a job whose artifact is already gone is fine
+    gone = Job("test")
+    gone.artifact = str(tmp_path / "gone.csv")
+    store.add(gone)
+    store.add(Job("test"))
+    assert store.get(gone.job_id) is None
@@ -1,16 +1,30 @@
+import asyncio
+import time
 import pytest
+import sbs.db
 import csv
 import io
+import shutil
+from types import SimpleNamespace
 from unittest.mock import MagicMock
 from fastapi.testclient import TestClient
 from fastapi import HTTPException
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool, StaticPool
 
 from sbs.models import Base, Account
 from sbs import schemas
-from sbs.main import app, get_db, get_paginated_accounts, deposit
+from sbs.main import (
+    create_app, get_db, get_paginated_accounts, deposit, transfer, account_cache, idempotency_store,
+    INSUFFICIENT_BALANCE, MONEY_OPERATIONS,
+)
+from sbs.config import EXPORT_MAX_PARALLELISM
+from sbs.metrics import REQUEST_QUERIES, REQUESTS
+from sbs.db import async_url, get_async_db
+from sbs.replicas import ReplicaSet
 
 SQLALCHEMY_DATABASE_URL = "sqlite://"
 
@@ -24,6 +38,22 @@ TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engin
 
 Base.metadata.create_all(bind=engine)
 
+# The async mode runs the same suite against its own in-memory database through aiosqlite
+async_engine = create_async_engine(
+    "sqlite+aiosqlite://",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False)
+
+
+async def create_async_tables():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+asyncio.run(create_async_tables())
+
 
 # def mock_get_db():
 #     db_mock = MagicMock()
@@ -40,12 +70,35 @@ def override_get_db():
         db.close()
 
 
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+app = create_app("sync")
 app.dependency_overrides[get_db] = override_get_db
 
+async_app = create_app("async")
+async_app.dependency_overrides[get_async_db] = override_get_async_db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def dispose_async_engine():
+    yield
+    # aiosqlite keeps a worker thread per connection open until it is closed
+    asyncio.run(async_engine.dispose())
+
 
-@pytest.fixture()
-def client():
-    return TestClient(app)
+@pytest.fixture(params=["sync", "async"])
+def client(request, monkeypatch):
+    # Startup initializes the engine of the app's mode; point both at the test databases
+    monkeypatch.setattr("sbs.main.engine", engine)
+    monkeypatch.setattr("sbs.main.async_engine", async_engine)
+    # Both modes share the process-wide caches, but not a database
+    account_cache.clear()
+    idempotency_store.cache.clear()
+    with TestClient(app if request.param == "sync" else async_app) as test_client:
+        yield test_client
 
 
 def test_create_account(client):
@@ -185,6 +238,151 @@ def test_transfer(client):
     assert data["message"] == f"Account with account_id '{recipient_id}' has been deleted."
 
 
+def test_transfer_both_directions_and_errors(client):
+    account_ids = []
+    for name in ("First Account", "Second Account"):
+        response_create = client.post(
+            "/accounts",
+            params={"name": name, "starting_balance": 100.0},
+        )
+        assert response_create.status_code == 200
+        account_ids.append(response_create.json()["account_id"])
+    first_id, second_id = account_ids
+
+    # One of these runs with the sender ordered first, the other with the recipient first
+    response = client.put(f"/accounts/{first_id}/transfer/{second_id}", params={"amount": 30.0})
+    assert response.status_code == 200
+    assert response.json()["sender"]["balance"] == 70.0
+    response = client.put(f"/accounts/{second_id}/transfer/{first_id}", params={"amount": 130.0})
+    assert response.status_code == 200
+    assert response.json()["sender"]["balance"] == 0.0
+
+    # A failed transfer leaves both balances untouched, whichever row was updated first
+    for sender_id, recipient_id in ((first_id, second_id), (second_id, first_id)):
+        response = client.put(f"/accounts/{sender_id}/transfer/{recipient_id}", params={"amount": 1000.0})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Insufficient balance for transfer"
+    assert client.get(f"/accounts/{first_id}").json()["balance"] == 200.0
+    assert client.get(f"/accounts/{second_id}").json()["balance"] == 0.0
+
+    for missing_id in ("0", "zzzzzzzz"):
+        response = client.put(f"/accounts/{first_id}/transfer/{missing_id}", params={"amount": 10.0})
+        assert response.status_code == 404
+        assert response.json()["detail"] == f"Recipient account '{missing_id}' not found"
+        response = client.put(f"/accounts/{missing_id}/transfer/{first_id}", params={"amount": 10.0})
+        assert response.status_code == 404
+        assert response.json()["detail"] == f"Sender account '{missing_id}' not found"
+    assert client.get(f"/accounts/{first_id}").json()["balance"] == 200.0
+
+    for account_id in account_ids:
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
+def test_batch_transfer(client):
+    account_ids = []
+    for name, balance in (("Payer", 100.0), ("Merchant A", 0.0), ("Merchant B", 0.0)):
+        response_create = client.post(
+            "/accounts",
+            params={"name": name, "starting_balance": balance},
+        )
+        assert response_create.status_code == 200
+        account_ids.append(response_create.json()["account_id"])
+    payer_id, merchant_a_id, merchant_b_id = account_ids
+
+    transfers = [
+        {"sender_id": payer_id, "recipient_id": merchant_a_id, "amount": 60.0},
+        {"sender_id": payer_id, "recipient_id": merchant_b_id, "amount": 60.0},  # Only 40 left
+        {"sender_id": merchant_a_id, "recipient_id": merchant_b_id, "amount": 10.0},
+        {"sender_id": "missing", "recipient_id": merchant_b_id, "amount": 1.0},
+        {"sender_id": payer_id, "recipient_id": "missing", "amount": 1.0},
+    ]
+    for chunk_size in (None, 2):
+        params = {"chunk_size": chunk_size} if chunk_size else {}
+        response = client.post("/transfers/batch", json={"transfers": transfers}, params=params)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["succeeded"] == 2
+        assert data["failed"] == 3
+        assert [result["index"] for result in data["results"]] == list(range(len(transfers)))
+        assert [result["status"] for result in data["results"]] == ["ok", "failed", "ok", "failed", "failed"]
+        assert data["results"][1]["status_code"] == 400
+        assert data["results"][1]["detail"] == "Insufficient balance for transfer"
+        assert data["results"][3]["detail"] == "Sender account 'missing' not found"
+        assert data["results"][4]["detail"] == "Recipient account 'missing' not found"
+
+        # Reset the accounts for the next round
+        for account_id, balance in zip(account_ids, (100.0, 0.0, 0.0)):
+            assert client.get(f"/accounts/{account_id}").json()["balance"] == \
+                {payer_id: 40.0, merchant_a_id: 50.0, merchant_b_id: 10.0}[account_id]
+            client.put(f"/accounts/{account_id}", params={"name": "Reset", "balance": balance})
+
+    for account_id in account_ids:
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
+def test_batch_transfer_failed_chunk(client, monkeypatch):
+    """
+    Test that a chunk that fails in the database is reported per transfer, along with the chunks committed around it.
+    """
+    from sqlalchemy.exc import OperationalError as DatabaseError
+    from sbs import main
+
+    payer = client.post("/accounts", params={"name": "Chunk Payer", "starting_balance": "10.00"}).json()["account_id"]
+    payee = client.post("/accounts", params={"name": "Chunk Payee", "starting_balance": "0"}).json()["account_id"]
+
+    apply_chunk = main._apply_transfer_chunk
+
+    def fail_third_transfer(db, chunk, offset):
+        if offset <= 2 < offset + len(chunk):
+            raise DatabaseError("SELECT", {}, Exception("canceling statement due to statement timeout"))
+        return apply_chunk(db, chunk, offset)
+
+    monkeypatch.setattr(main, "_apply_transfer_chunk", fail_third_transfer)
+    transfers = [{"sender_id": payer, "recipient_id": payee, "amount": "1.00"}] * 5
+    response = client.post("/transfers/batch", json={"transfers": transfers}, params={"chunk_size": 2})
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["succeeded"], data["failed"]) == (3, 2)
+    assert [result["status"] for result in data["results"]] == ["ok", "ok", "failed", "failed", "ok"]
+    assert data["results"][2] == {
+        "index": 2, "status": "failed", "status_code": 500, "detail": "canceling statement due to statement timeout",
+    }
+    assert client.get(f"/accounts/{payee}").json()["balance"] == 3.0
+
+    # Without chunks the batch is one transaction, and its failure the request's
+    with pytest.raises(DatabaseError):
+        client.post("/transfers/batch", json={"transfers": transfers[:3]})
+    assert client.get(f"/accounts/{payee}").json()["balance"] == 3.0
+
+    for account_id in (payer, payee):
+        assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+def test_batch_transfer_rejects_empty_batch(client):
+    response = client.post("/transfers/batch", json={"transfers": []})
+    assert response.status_code == 422
+
+
+def test_transfer_retries_deadlock(mocker):
+    # The first attempt is picked as a deadlock victim, the second one goes through
+    deadlock = MagicMock(pgcode="40P01")
+    apply_transfer = mocker.patch(
+        "sbs.main._apply_transfer",
+        side_effect=[OperationalError("UPDATE accounts", {}, deadlock), 5000],
+    )
+    mocker.patch("sbs.main.pause")
+    db_mock = MagicMock()
+
+    result = transfer(sender_id="a", recipient_id="b", amount=10.0, db=db_mock)
+
+    assert apply_transfer.call_count == 2
+    assert db_mock.rollback.call_count == 1
+    assert db_mock.commit.call_count == 1
+    assert result["sender"] == {"account_id": "a", "balance": 50.0}
+
+
 def test_get_paginated_accounts_success():
     # Mock pagination and db dependencies
     pagination_mock = MagicMock(spec=schemas.PaginationParams)
@@ -211,13 +409,12 @@ def test_get_paginated_accounts_success():
     assert result["total_pages"] == 1
     assert result["current_page"] == pagination_mock.page
     assert result["page_size"] == pagination_mock.page_size
-    print(result["accounts"][0].__dict__)
-    assert result["accounts"][0].__dict__["account_id"] == "1"
-    assert result["accounts"][0].__dict__["name"] == "Account 1"
-    assert result["accounts"][0].__dict__["balance"] == 100
-    assert result["accounts"][1].__dict__["account_id"] == "2"
-    assert result["accounts"][1].__dict__["name"] == "Account 2"
-    assert result["accounts"][1].__dict__["balance"] == 200
+    assert result["accounts"][0]["account_id"] == "1"
+    assert result["accounts"][0]["name"] == "Account 1"
+    assert result["accounts"][0]["balance"] == 100
+    assert result["accounts"][1]["account_id"] == "2"
+    assert result["accounts"][1]["name"] == "Account 2"
+    assert result["accounts"][1]["balance"] == 200
 
 
 def test_get_paginated_accounts_no_accounts():
@@ -271,6 +468,58 @@ def test_get_paginated_accounts_pagination_metadata():
     assert len(result["accounts"]) == 11
 
 
+def test_get_paginated_accounts_cursor(client):
+    # Create a few accounts to page through
+    account_ids = []
+    for i in range(3):
+        response_create = client.post(
+            "/accounts",
+            params={"name": f"Cursor Account {i}", "starting_balance": 10.0},
+        )
+        assert response_create.status_code == 200
+        account_ids.append(response_create.json()["account_id"])
+
+    # Walk every page with the cursor, starting from an empty cursor
+    seen = []
+    params = {"after": "", "page_size": 2, "include_total": True}
+    while True:
+        response = client.get("/accounts", params=params)
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["accounts"]) <= 2
+        if "include_total" in params:
+            assert data["total_count"] >= 3
+        seen.extend(account["account_id"] for account in data["accounts"])
+        if data["next_cursor"] is None:
+            break
+        params = {"after": data["next_cursor"], "page_size": 2}
+
+    # Pages come back in key order without duplicates
+    assert seen == sorted(seen)
+    assert set(account_ids) <= set(seen)
+
+    # Page mode hands out a cursor that continues where the page ended
+    response_page = client.get("/accounts", params={"page": 1, "page_size": 1})
+    assert response_page.status_code == 200
+    response_next = client.get("/accounts", params={"after": response_page.json()["next_cursor"], "page_size": 1})
+    assert response_next.json()["accounts"][0]["account_id"] == seen[1]
+
+    # ... and none on the last page
+    last_page = client.get("/accounts", params={"page": len(seen), "page_size": 1}).json()
+    assert last_page["accounts"][0]["account_id"] == seen[-1]
+    assert last_page["next_cursor"] is None
+
+    for account_id in account_ids:
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
+def test_get_paginated_accounts_invalid_cursor(client):
+    response = client.get("/accounts", params={"after": "not a cursor!"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
 def test_deposit_success(client):
     # Send request to the endpoint
     response_create = client.post(
@@ -293,6 +542,70 @@ def test_deposit_success(client):
     assert data["message"] == f"Account with account_id '{account_id}' has been deleted."
 
 
+def test_deposit_account_not_found(client):
+    response = client.put("/accounts/does-not-exist/deposit", params={"amount": 100})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Account not found"
+
+
+def test_deposits_do_not_drift(client):
+    account_id = client.post("/accounts", params={"name": "Cents", "starting_balance": 0}).json()["account_id"]
+
+    # 0.1 has no exact float representation; ten float additions would give 0.9999999999999999
+    for _ in range(10):
+        response = client.put(f"/accounts/{account_id}/deposit", params={"amount": "0.1"})
+        assert response.status_code == 200
+    assert response.json()["balance"] == 1.0
+
+    other_id = client.post("/accounts", params={"name": "Other", "starting_balance": 0}).json()["account_id"]
+    response = client.put(f"/accounts/{account_id}/transfer/{other_id}", params={"amount": "0.3"})
+    assert response.json()["sender"]["balance"] == 0.7
+
+    lines = client.get("/save").text.splitlines()
+    assert f"{account_id},Cents,0.70" in lines
+    assert f"{other_id},Other,0.30" in lines
+
+    for deleted_id in (account_id, other_id):
+        assert client.delete(f"/accounts/{deleted_id}").status_code == 200
+
+
+def test_sub_cent_amounts_are_rejected(client):
+    account_id = client.post("/accounts", params={"name": "Cents", "starting_balance": 1}).json()["account_id"]
+
+    for path in ("deposit", "withdraw", f"transfer/{account_id}"):
+        response = client.put(f"/accounts/{account_id}/{path}", params={"amount": "0.005"})
+        assert response.status_code == 422
+    assert client.get(f"/accounts/{account_id}").json()["balance"] == 1.0
+    assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+def test_withdraw(client):
+    response_create = client.post(
+        "/accounts",
+        params={"name": "Test Account", "starting_balance": 200.0},
+    )
+    assert response_create.status_code == 200
+    account_id = response_create.json()["account_id"]
+
+    response = client.put(f"/accounts/{account_id}/withdraw", params={"amount": 50})
+    assert response.status_code == 200
+    assert response.json() == {"message": "Withdrawal successful", "balance": 150}
+
+    # Overdrawing is rejected and leaves the balance untouched
+    response = client.put(f"/accounts/{account_id}/withdraw", params={"amount": 500})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Insufficient balance"
+    assert client.get(f"/accounts/{account_id}").json()["balance"] == 150
+
+    # A missing account is still reported as such, not as a balance problem
+    response = client.put("/accounts/does-not-exist/withdraw", params={"amount": 500})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Account not found"
+
+    response_delete = client.delete(f"/accounts/{account_id}")
+    assert response_delete.status_code == 200
+
+
 def test_export_system_state(client):
     # Mock accounts data
     accounts = [
@@ -327,7 +640,7 @@ def test_export_system_state(client):
     for i, row in enumerate(rows):
         print(row)
         print(accounts[i])
-        assert row == [accounts[i]["account_id"], accounts[i]["name"], str(accounts[i]["balance"])]
+        assert row == [accounts[i]["account_id"], accounts[i]["name"], f"{accounts[i]['balance']:.2f}"]
 
     # Delete the account
     for account in accounts:
@@ -337,6 +650,53 @@ def test_export_system_state(client):
         assert data["message"] == f"Account with account_id '{account['account_id']}' has been deleted."
 
 
+def test_export_system_state_in_chunks(client, monkeypatch):
+    # One row per chunk, so the export spans several cursor batches
+    monkeypatch.setattr("sbs.main.EXPORT_BATCH_SIZE", 1)
+    account_ids = []
+    for i in range(3):
+        response_create = client.post(
+            "/accounts",
+            params={"name": f"Export {i}", "starting_balance": 10.0 * i},
+        )
+        account_ids.append(response_create.json()["account_id"])
+
+    with client.stream("GET", "/save") as response:
+        assert response.status_code == 200
+        chunks = list(response.iter_text())
+
+    rows = list(csv.reader(io.StringIO("".join(chunks))))
+    assert rows[0] == ["account_id", "name", "balance"]
+    assert sorted(rows[1:]) == sorted(
+        [account_id, f"Export {i}", f"{10.0 * i:.2f}"] for i, account_id in enumerate(account_ids)
+    )
+
+    for account_id in account_ids:
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
+def test_export_system_state_parallel(client):
+    account_ids = [
+        client.post("/accounts", params={"name": f"Parallel {i}", "starting_balance": 1.0}).json()["account_id"]
+        for i in range(3)
+    ]
+
+    # SQLite can't share a snapshot between connections, so this falls back to one cursor
+    response = client.get("/save", params={"parallel": 4})
+    assert response.status_code == 200
+    assert sorted(response.text.splitlines()) == sorted(client.get("/save").text.splitlines())
+    assert client.get("/save", params={"parallel": 0}).status_code == 422
+    # More ranges than the connection pool can serve at once are refused before any are read
+    too_many = {"parallel": EXPORT_MAX_PARALLELISM + 1}
+    assert client.get("/save", params=too_many).status_code == 422
+    assert client.post("/jobs/export", params=too_many).status_code == 422
+
+    for account_id in account_ids:
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
 def test_import_system_state(client):
     # Define CSV content
     csv_content = (
@@ -367,3 +727,966 @@ def test_import_system_state(client):
     assert data["account_id"] == "d4cdc8fa-ff88-477a-b531-c4267543fff5"
     assert data["name"] == "Bob"
     assert data["balance"] == 200.0
+
+
+def test_import_system_state_upserts_in_chunks(client):
+    response_create = client.post(
+        "/accounts",
+        params={"name": "Existing", "starting_balance": 1.0},
+    )
+    existing_id = response_create.json()["account_id"]
+
+    # Updates an existing account, creates two new ones, and repeats one of them
+    csv_content = (
+        "account_id,name,balance\n"
+        f"{existing_id},Existing Renamed,2.5\n"
+        "import-new-1,Carol,30\n"
+        "import-new-2,Dave,40\n"
+        "import-new-1,Carol Again,35\n"
+    )
+    for chunk_size in (1, 2, 100):
+        file = ("file.csv", io.BytesIO(csv_content.encode()))
+        response = client.post("/load", files={"file": file}, params={"chunk_size": chunk_size})
+        assert response.status_code == 200
+        assert response.json() == {"message": "Import successful"}
+
+        assert client.get(f"/accounts/{existing_id}").json() == {
+            "account_id": existing_id, "name": "Existing Renamed", "balance": 2.5,
+        }
+        assert client.get("/accounts/import-new-1").json()["name"] == "Carol Again"
+        assert client.get("/accounts/import-new-1").json()["balance"] == 35.0
+        assert client.get("/accounts/import-new-2").json()["balance"] == 40.0
+
+    for account_id in (existing_id, "import-new-1", "import-new-2"):
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
+def test_import_system_state_missing_account_id(client):
+    file = ("file.csv", io.BytesIO(b"name,balance\nAlice,100\n"))
+    response = client.post("/load", files={"file": file})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "CSV missing 'account_id'"
+
+
+def test_import_system_state_reports_malformed_rows(client, monkeypatch):
+    # A tiny read buffer splits lines, and the multi-byte name, across reads
+    monkeypatch.setattr("sbs.main.IMPORT_BUFFER_SIZE", 3)
+    csv_content = (
+        "account_id,name,balance\r\n"
+        "stream-1,Zoë,10\r\n"
+        "stream-2,Eve,not-a-number\r\n"
+        "stream-3,\"Multi\nLine\",30\r\n"
+        "stream-4,Too,Many,Fields\r\n"
+        ",Nobody,5\r\n"
+        "stream-5,Last,50"
+    )
+    file = ("file.csv", io.BytesIO(csv_content.encode("utf-8")))
+    response = client.post("/load", files={"file": file}, params={"chunk_size": 2})
+    assert response.status_code == 200
+    assert response.json() == {
+        "message": "Import completed with errors",
+        "imported": 3,
+        "error_count": 3,
+        "errors": [
+            {"line": 3, "error": "Invalid balance 'not-a-number'"},
+            {"line": 6, "error": "Wrong number of fields"},
+            {"line": 7, "error": "Missing account_id"},
+        ],
+    }
+
+    # Rows before and after the malformed ones were imported
+    assert client.get("/accounts/stream-1").json()["name"] == "Zoë"
+    assert client.get("/accounts/stream-3").json()["name"] == "Multi\nLine"
+    assert client.get("/accounts/stream-5").json()["balance"] == 50.0
+    assert client.get("/accounts/stream-2").status_code == 404
+
+    for account_id in ("stream-1", "stream-3", "stream-5"):
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
+def test_import_system_state_line_too_long(client, monkeypatch):
+    monkeypatch.setattr("sbs.main.IMPORT_BUFFER_SIZE", 4)
+    monkeypatch.setattr("sbs.main.IMPORT_MAX_LINE_BYTES", 40)
+    csv_content = "account_id,name,balance\nlong-1,First,10\nlong-2," + "x" * 100 + ",20\nlong-3,Never,30\n"
+    file = ("file.csv", io.BytesIO(csv_content.encode("utf-8")))
+    response = client.post("/load", files={"file": file})
+    assert response.status_code == 200
+    assert response.json() == {
+        "message": "Import completed with errors",
+        "imported": 1,
+        "error_count": 1,
+        "errors": [{"line": 3, "error": "Line longer than 40 bytes, import stopped"}],
+    }
+    assert client.get("/accounts/long-3").status_code == 404
+    assert client.delete("/accounts/long-1").status_code == 200
+
+    # In the header, there are no rows to go on with
+    file = ("file.csv", io.BytesIO(b"account_id,name,balance" + b",extra" * 10 + b"\n"))
+    response = client.post("/load", files={"file": file})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Line longer than 40 bytes"
+
+
+@pytest.mark.parametrize("snapshot_format", ["csv", "csv.gz", "csv.zst", "binary", "arrow"])
+def test_snapshot_formats_round_trip(client, snapshot_format):
+    if snapshot_format == "csv.zst":
+        pytest.importorskip("zstandard")
+    if snapshot_format == "arrow":
+        pytest.importorskip("pyarrow")
+    account_ids = []
+    for name, balance in (("Zoë", 10.25), ("Round Trip", 200.0)):
+        response_create = client.post("/accounts", params={"name": name, "starting_balance": balance})
+        account_ids.append(response_create.json()["account_id"])
+
+    response = client.get("/save", params={"format": snapshot_format})
+    assert response.status_code == 200
+    assert response.headers["content-disposition"].startswith("attachment; filename=system_state.")
+    saved = response.content
+
+    # Loading the snapshot back undoes changes made since
+    client.put(f"/accounts/{account_ids[0]}/deposit", params={"amount": 5.0})
+    file = ("snapshot", io.BytesIO(saved))
+    response = client.post("/load", files={"file": file}, params={"format": snapshot_format})
+    assert response.status_code == 200
+    assert response.json() == {"message": "Import successful"}
+    assert client.get(f"/accounts/{account_ids[0]}").json() == {
+        "account_id": account_ids[0], "name": "Zoë", "balance": 10.25,
+    }
+    assert client.get(f"/accounts/{account_ids[1]}").json()["balance"] == 200.0
+
+    for account_id in account_ids:
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
+def test_import_corrupt_snapshots(client):
+    from sbs.snapshot import BinaryEncoder
+
+    file = ("snapshot", io.BytesIO(b"not a snapshot"))
+    response = client.post("/load", files={"file": file}, params={"format": "binary"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Not a binary snapshot"
+
+    file = ("snapshot", io.BytesIO(b"account_id,name,balance\n"))
+    response = client.post("/load", files={"file": file}, params={"format": "csv.gz"})
+    assert response.status_code == 400
+
+    # A truncated file keeps the blocks before the cut, and an invalid record is skipped
+    encoder = BinaryEncoder()
+    data = (
+        encoder.start()
+        + encoder.write([("corrupt-1", None, 100), ("", "Nobody", 5)])
+        + encoder.write([("corrupt-2", "Bob", 200)])
+    )
+    file = ("snapshot", io.BytesIO(data[:-3]))
+    response = client.post("/load", files={"file": file}, params={"format": "binary"})
+    assert response.status_code == 200
+    assert response.json() == {
+        "message": "Import completed with errors",
+        "imported": 1,
+        "error_count": 2,
+        "errors": [
+            {"record": 2, "error": "Missing account_id"},
+            {"record": 3, "error": "Snapshot is truncated, import stopped"},
+        ],
+    }
+    assert client.get("/accounts/corrupt-1").json() == {"account_id": "corrupt-1", "name": None, "balance": 1.0}
+    assert client.get("/accounts/corrupt-2").status_code == 404
+
+    response = client.post("/load", files={"file": file}, params={"format": "parquet"})
+    assert response.status_code == 422
+
+    response_delete = client.delete("/accounts/corrupt-1")
+    assert response_delete.status_code == 200
+
+
+def test_delta_snapshots(client, monkeypatch):
+    monkeypatch.setattr("sbs.main.CHECKPOINT_OVERLAP_SECONDS", 0)
+    account_ids = {}
+    for name in ("Kept", "Changed", "Deleted"):
+        response_create = client.post("/accounts", params={"name": name, "starting_balance": 10.0})
+        account_ids[name] = response_create.json()["account_id"]
+    response = client.get("/save")
+    base, checkpoint = response.content, response.headers["x-sbs-checkpoint"]
+
+    client.put(f"/accounts/{account_ids['Changed']}/deposit", params={"amount": 5.0})
+    client.delete(f"/accounts/{account_ids['Deleted']}")
+    account_ids["Created"] = client.post("/accounts", params={"name": "Created", "starting_balance": 1.0}).json()[
+        "account_id"]
+
+    # Only what changed after the checkpoint, deletes last; the header works pasted into a URL as it is
+    assert checkpoint.endswith("Z")
+    response = client.get(f"/save?since={checkpoint}")
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == "attachment; filename=system_state_delta.csv"
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == ["op", "account_id", "name", "balance"]
+    assert sorted(rows[1:3]) == sorted([
+        ["upsert", account_ids["Changed"], "Changed", "15.00"],
+        ["upsert", account_ids["Created"], "Created", "1.00"],
+    ])
+    assert rows[3:] == [["delete", account_ids["Deleted"], "", ""]]
+    delta = response.content
+
+    # Back to the base snapshot, which only changes the accounts that differ from it...
+    checkpoint = client.get("/save").headers["x-sbs-checkpoint"]
+    response = client.post("/load", files={"file": ("base.csv", io.BytesIO(base))})
+    assert response.json() == {"message": "Import successful"}
+    assert client.get(f"/accounts/{account_ids['Changed']}").json()["balance"] == 10.0
+    assert client.get(f"/accounts/{account_ids['Deleted']}").status_code == 200
+    changed = [row[1] for row in csv.reader(io.StringIO(client.get("/save", params={"since": checkpoint}).text))]
+    assert sorted(changed[1:]) == sorted([account_ids["Changed"], account_ids["Deleted"]])
+
+    # ...then the delta on top of it
+    response = client.post("/load", files={"file": ("delta.csv", io.BytesIO(delta))})
+    assert response.json() == {"message": "Import successful"}
+    assert client.get(f"/accounts/{account_ids['Changed']}").json()["balance"] == 15.0
+    assert client.get(f"/accounts/{account_ids['Deleted']}").status_code == 404
+    assert client.get(f"/accounts/{account_ids['Kept']}").json()["balance"] == 10.0
+
+    file = ("delta.csv", io.BytesIO(b"op,account_id,name,balance\nupdate,x,X,1\n"))
+    response = client.post("/load", files={"file": file})
+    assert response.json()["errors"] == [{"line": 2, "error": "Invalid op 'update'"}]
+    assert client.get("/save", params={"since": checkpoint, "format": "binary"}).status_code == 400
+
+    for name in ("Kept", "Changed", "Created"):
+        response_delete = client.delete(f"/accounts/{account_ids[name]}")
+        assert response_delete.status_code == 200
+
+
+def wait_for_job(client, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish within {timeout}s")
+
+
+def test_import_job_copies_upload_off_the_event_loop(client, monkeypatch):
+    copied_on_loop = []
+
+    def copyfileobj(source, destination, length):
+        try:
+            asyncio.get_running_loop()
+            copied_on_loop.append(True)
+        except RuntimeError:
+            copied_on_loop.append(False)
+        shutil.copyfileobj(source, destination, length)
+
+    monkeypatch.setattr("sbs.main.shutil", SimpleNamespace(copyfileobj=copyfileobj))
+    file = ("file.csv", io.BytesIO(b"account_id,name,balance\ncopy-1,Alice,1\n"))
+    response = client.post("/jobs/import", files={"file": file})
+    assert response.status_code == 202
+    assert wait_for_job(client, response.json()["job_id"])["status"] == "succeeded"
+    assert copied_on_loop == [False]
+    assert client.delete("/accounts/copy-1").status_code == 200
+
+
+def test_import_and_export_jobs(client):
+    csv_content = (
+        "account_id,name,balance\n"
+        "job-1,Alice,100\n"
+        "job-2,Bob,oops\n"
+        "job-3,Carol,300\n"
+    )
+    file = ("file.csv", io.BytesIO(csv_content.encode()))
+    response = client.post("/jobs/import", files={"file": file}, params={"chunk_size": 1})
+    assert response.status_code == 202
+    job = wait_for_job(client, response.json()["job_id"])
+
+    assert job["kind"] == "import"
+    assert job["status"] == "succeeded"
+    assert job["rows_processed"] == 2
+    assert job["result"]["imported"] == 2
+    assert job["result"]["errors"] == [{"line": 3, "error": "Invalid balance 'oops'"}]
+    assert client.get("/accounts/job-3").json()["balance"] == 300.0
+
+    response = client.post("/jobs/export")
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    job = wait_for_job(client, job_id)
+    assert job["status"] == "succeeded"
+    assert job["has_artifact"]
+
+    # The artifact matches what /save streams
+    response_artifact = client.get(f"/jobs/{job_id}/artifact")
+    assert response_artifact.status_code == 200
+    assert sorted(response_artifact.text.splitlines()) == sorted(client.get("/save").text.splitlines())
+    assert job["rows_processed"] == job["result"]["rows"] == len(response_artifact.text.splitlines()) - 1
+
+    # Jobs take the same formats, and the artifact is served as its format
+    response = client.post("/jobs/export", params={"format": "binary"})
+    job = wait_for_job(client, response.json()["job_id"])
+    assert job["result"]["format"] == "binary"
+    assert job["result"]["checkpoint"].endswith("Z")
+    response_artifact = client.get(f"/jobs/{job['job_id']}/artifact")
+    assert response_artifact.headers["content-type"] == "application/octet-stream"
+    assert response_artifact.headers["content-disposition"] == 'attachment; filename="system_state.sbs"'
+    assert response_artifact.content == client.get("/save", params={"format": "binary"}).content
+
+    client.put("/accounts/job-1/deposit", params={"amount": 1.0})
+    file = ("snapshot", io.BytesIO(response_artifact.content))
+    response = client.post("/jobs/import", files={"file": file}, params={"format": "binary"})
+    job = wait_for_job(client, response.json()["job_id"])
+    assert job["status"] == "succeeded"
+    assert client.get("/accounts/job-1").json()["balance"] == 100.0
+
+    for account_id in ("job-1", "job-3"):
+        response_delete = client.delete(f"/accounts/{account_id}")
+        assert response_delete.status_code == 200
+
+
+def test_failed_export_job_leaves_no_file(client, monkeypatch, tmp_path):
+    monkeypatch.setattr("sbs.main.JOB_DIR", str(tmp_path))
+
+    def fail_halfway(*args):
+        yield b"account_id,name,balance\n"
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr("sbs.main._export_chunks", fail_halfway)
+    job = wait_for_job(client, client.post("/jobs/export").json()["job_id"])
+    assert (job["status"], job["error"]) == ("failed", "connection lost")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_import_job_upload_is_deleted(client, monkeypatch, tmp_path):
+    monkeypatch.setattr("sbs.main.JOB_DIR", str(tmp_path))
+
+    # Refused after the upload was copied
+    file = ("file.csv", io.BytesIO(b"account_id,name,balance\n"))
+    assert client.post("/jobs/import", files={"file": file}, params={"chunk_size": 0}).status_code == 422
+    assert list(tmp_path.iterdir()) == []
+
+    # Claimed by a job, which deletes it once done
+    file = ("file.csv", io.BytesIO(b"account_id,name,balance\n"))
+    response = client.post("/jobs/import", files={"file": file})
+    assert wait_for_job(client, response.json()["job_id"])["status"] == "succeeded"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failed_and_unknown_jobs(client):
+    file = ("file.csv", io.BytesIO(b"name,balance\nAlice,100\n"))
+    response = client.post("/jobs/import", files={"file": file})
+    job_id = response.json()["job_id"]
+    job = wait_for_job(client, job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "CSV missing 'account_id'"
+    assert client.get(f"/jobs/{job_id}/artifact").status_code == 409
+
+    assert client.get("/jobs/does-not-exist").status_code == 404
+
+
+def test_get_account_cache_invalidated_by_writes(client):
+    response_create = client.post(
+        "/accounts",
+        params={"name": "Cached", "starting_balance": 100.0},
+    )
+    account_id = response_create.json()["account_id"]
+    other_id = client.post("/accounts", params={"name": "Other", "starting_balance": 0.0}).json()["account_id"]
+
+    stats = client.get("/cache/stats").json()
+    assert client.get(f"/accounts/{account_id}").json()["balance"] == 100.0  # Miss, fills the cache
+    assert client.get(f"/accounts/{account_id}").json()["balance"] == 100.0  # Hit
+    after = client.get("/cache/stats").json()
+    assert after["hits"] == stats["hits"] + 1
+    assert after["misses"] == stats["misses"] + 1
+
+    # Every kind of write is visible on the next read
+    writes = [
+        (lambda: client.put(f"/accounts/{account_id}/deposit", params={"amount": 50}), 150.0),
+        (lambda: client.put(f"/accounts/{account_id}/withdraw", params={"amount": 20}), 130.0),
+        (lambda: client.put(f"/accounts/{account_id}/transfer/{other_id}", params={"amount": 30}), 100.0),
+        (lambda: client.post("/transfers/batch", json={"transfers": [
+            {"sender_id": other_id, "recipient_id": account_id, "amount": 5}]}), 105.0),
+        (lambda: client.put(f"/accounts/{account_id}", params={"name": "Cached", "balance": 7.0}), 7.0),
+        (lambda: client.post("/load", files={"file": (
+            "file.csv", io.BytesIO(f"account_id,name,balance\n{account_id},Cached,8\n".encode()))}), 8.0),
+    ]
+    for write, balance in writes:
+        assert write().status_code == 200
+        assert client.get(f"/accounts/{account_id}").json()["balance"] == balance
+        assert client.get(f"/accounts/{account_id}").json()["balance"] == balance
+
+    for delete_id in (account_id, other_id):
+        response_delete = client.delete(f"/accounts/{delete_id}")
+        assert response_delete.status_code == 200
+    assert client.get(f"/accounts/{account_id}").status_code == 404
+
+
+def test_account_transactions_ledger(client):
+    account_id = client.post("/accounts", params={"name": "Ledger", "starting_balance": 100.0}).json()["account_id"]
+    other_id = client.post("/accounts", params={"name": "Other", "starting_balance": 0.0}).json()["account_id"]
+
+    client.put(f"/accounts/{account_id}/deposit", params={"amount": 50})
+    client.put(f"/accounts/{account_id}/withdraw", params={"amount": 500})  # Rejected, not recorded
+    client.put(f"/accounts/{account_id}/withdraw", params={"amount": 20})
+    client.put(f"/accounts/{account_id}/transfer/{other_id}", params={"amount": 30})
+    client.post("/transfers/batch", json={"transfers": [
+        {"sender_id": other_id, "recipient_id": account_id, "amount": 10}]})
+    client.put(f"/accounts/{account_id}", params={"name": "Ledger", "balance": 200.0})
+    client.post("/load", files={"file": (
+        "file.csv", io.BytesIO(f"account_id,name,balance\n{account_id},Ledger,250\n".encode()))})
+
+    # Walk the history two entries at a time
+    transactions = []
+    params = {"page_size": 2}
+    while True:
+        response = client.get(f"/accounts/{account_id}/transactions", params=params)
+        assert response.status_code == 200
+        data = response.json()
+        transactions.extend(data["transactions"])
+        if data["next_cursor"] is None:
+            break
+        params = {"page_size": 2, "after": data["next_cursor"]}
+
+    # Newest first, and the amounts add up to the balance
+    assert [(t["kind"], t["amount"], t["balance"]) for t in transactions] == [
+        ("import", 50.0, 250.0),
+        ("adjustment", 90.0, 200.0),
+        ("transfer_in", 10.0, 110.0),
+        ("transfer_out", -30.0, 100.0),
+        ("withdrawal", -20.0, 130.0),
+        ("deposit", 50.0, 150.0),
+        ("open", 100.0, 100.0),
+    ]
+    assert transactions[2]["counterparty_id"] == other_id
+    assert sum(t["amount"] for t in transactions) == 250.0
+
+    # The history outlives the account
+    client.delete(f"/accounts/{account_id}")
+    client.delete(f"/accounts/{other_id}")
+    response = client.get(f"/accounts/{account_id}/transactions", params={"page_size": 1})
+    assert response.json()["transactions"][0]["kind"] == "close"
+    assert response.json()["transactions"][0]["amount"] == -250.0
+
+    assert client.get("/accounts/never-existed/transactions").status_code == 404
+    assert client.get(f"/accounts/{account_id}/transactions", params={"after": "bad"}).status_code == 400
+
+
+def test_metrics(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE sbs_db_pool_checkout_seconds histogram" in response.text
+    assert "# TYPE sbs_db_pool_connections_in_use gauge" in response.text
+    assert 'sbs_http_requests_total{method="GET",route="/metrics",status="200"}' in client.get("/metrics").text
+
+
+def test_request_and_business_metrics(client):
+    route = "/accounts/{account_id}/withdraw"
+    labels = {"method": "PUT", "route": route}
+    account_id = client.post("/accounts", params={"name": "Metrics", "starting_balance": 10}).json()["account_id"]
+    before = {
+        "ok": REQUESTS.value(status="200", **labels),
+        "rejected": REQUESTS.value(status="400", **labels),
+        "queries": REQUEST_QUERIES.snapshot(route=route),
+        "withdrawals": MONEY_OPERATIONS.value(operation="withdraw"),
+        "insufficient": INSUFFICIENT_BALANCE.value(operation="withdraw"),
+    }
+
+    assert client.put(f"/accounts/{account_id}/withdraw", params={"amount": 4}).status_code == 200
+    assert client.put(f"/accounts/{account_id}/withdraw", params={"amount": 40}).status_code == 400
+
+    # Per route template and status, with the statements each request ran
+    assert REQUESTS.value(status="200", **labels) == before["ok"] + 1
+    assert REQUESTS.value(status="400", **labels) == before["rejected"] + 1
+    requests, queries = REQUEST_QUERIES.snapshot(route=route)
+    assert requests == before["queries"][0] + 2
+    assert queries >= before["queries"][1] + 4  # UPDATE and INSERT, then UPDATE and SELECT
+    assert MONEY_OPERATIONS.value(operation="withdraw") == before["withdrawals"] + 1
+    assert INSUFFICIENT_BALANCE.value(operation="withdraw") == before["insufficient"] + 1
+
+    # Paths no route matched share one label value
+    unmatched = REQUESTS.value(method="GET", route="<unmatched>", status="404")
+    client.get(f"/no/such/{account_id}")
+    assert REQUESTS.value(method="GET", route="<unmatched>", status="404") == unmatched + 1
+    client.delete(f"/accounts/{account_id}")
+
+
+def test_idempotent_deposit_is_applied_once(client):
+    account_id = client.post("/accounts", params={"name": "Retry", "starting_balance": 100}).json()["account_id"]
+    headers = {"Idempotency-Key": "deposit-once"}
+
+    first = client.put(f"/accounts/{account_id}/deposit", params={"amount": 10}, headers=headers)
+    assert first.status_code == 200
+    assert first.json()["balance"] == 110.0
+
+    # A retry gets the first response back, from the cache and then from the table
+    for clear_cache in (False, True):
+        if clear_cache:
+            idempotency_store.cache.clear()
+        retry = client.put(f"/accounts/{account_id}/deposit", params={"amount": 10}, headers=headers)
+        assert retry.status_code == 200
+        assert retry.json() == first.json()
+
+    assert client.get(f"/accounts/{account_id}").json()["balance"] == 110.0
+    kinds = [t["kind"] for t in client.get(f"/accounts/{account_id}/transactions").json()["transactions"]]
+    assert kinds == ["deposit", "open"]
+
+    # The key can't be reused for a different request
+    response = client.put(f"/accounts/{account_id}/deposit", params={"amount": 20}, headers=headers)
+    assert response.status_code == 422
+    response = client.put(f"/accounts/{account_id}/withdraw", params={"amount": 10}, headers=headers)
+    assert response.status_code == 422
+    assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+def test_idempotent_transfer_and_failed_retry(client):
+    sender_id = client.post("/accounts", params={"name": "Payer", "starting_balance": 10}).json()["account_id"]
+    recipient_id = client.post("/accounts", params={"name": "Payee", "starting_balance": 0}).json()["account_id"]
+    headers = {"Idempotency-Key": "transfer-once"}
+
+    # A failed request records nothing, so its retry runs again
+    response = client.put(f"/accounts/{sender_id}/transfer/{recipient_id}", params={"amount": 25}, headers=headers)
+    assert response.status_code == 400
+    client.put(f"/accounts/{sender_id}/deposit", params={"amount": 15})
+
+    for _ in range(2):
+        response = client.put(
+            f"/accounts/{sender_id}/transfer/{recipient_id}", params={"amount": 25}, headers=headers
+        )
+        assert response.status_code == 200
+        assert response.json()["sender"] == {"account_id": sender_id, "balance": 0.0}
+    assert client.get(f"/accounts/{recipient_id}").json()["balance"] == 25.0
+
+    for account_id in (sender_id, recipient_id):
+        assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+def test_idempotent_request_losing_race_is_rolled_back(client, mocker):
+    account_id = client.post("/accounts", params={"name": "Race", "starting_balance": 0}).json()["account_id"]
+    headers = {"Idempotency-Key": "race"}
+    first = client.put(f"/accounts/{account_id}/deposit", params={"amount": 5}, headers=headers).json()
+
+    # Pretend the first request hadn't committed yet when the second one looked the key up
+    mocker.patch.object(idempotency_store, "lookup", side_effect=[None, first])
+
+    response = client.put(f"/accounts/{account_id}/deposit", params={"amount": 5}, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == first
+    mocker.stopall()
+    assert client.get(f"/accounts/{account_id}").json()["balance"] == 5.0
+    assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+@pytest.fixture(params=["sync", "async"])
+def replica_client(request, monkeypatch, tmp_path):
+    # Two SQLite files stand in for read replicas, each holding one account named after its file
+    urls = [f"sqlite:///{tmp_path / f'replica{i}.db'}" for i in range(2)]
+    for url in urls:
+        seed_engine = create_engine(url)
+        Base.metadata.create_all(seed_engine)
+        with seed_engine.begin() as conn:
+            conn.execute(insert(Account), {"account_id": "replica-only", "name": url, "balance_cents": 100})
+        seed_engine.dispose()
+
+    if request.param == "sync":
+        replicas = [create_engine(url, poolclass=NullPool) for url in urls]
+    else:
+        replicas = [create_async_engine(async_url(url), poolclass=NullPool) for url in urls]
+    monkeypatch.setattr("sbs.db.read_replicas", ReplicaSet(replicas, retry_interval=60))
+    monkeypatch.setattr("sbs.main.READ_YOUR_WRITES_SECONDS", 30)
+    monkeypatch.setattr("sbs.main.engine", engine)
+    monkeypatch.setattr("sbs.main.async_engine", async_engine)
+    account_cache.clear()
+
+    replica_app = create_app(request.param)
+    replica_app.dependency_overrides = (app if request.param == "sync" else async_app).dependency_overrides
+    with TestClient(replica_app) as test_client:
+        yield test_client, urls
+
+
+def read_from(client):
+    # Which database served a page of accounts: a replica's file name, or None for the primary
+    accounts = client.get("/accounts").json()["accounts"]
+    return next((account["name"] for account in accounts if account["account_id"] == "replica-only"), None)
+
+
+def test_reads_are_spread_over_replicas(replica_client):
+    client, urls = replica_client
+
+    assert {read_from(client) for _ in range(4)} == set(urls)
+    assert client.get("/accounts/replica-only").json()["balance"] == 1.0
+    lines = client.get("/save").text.splitlines()
+    assert lines[1].startswith("replica-only,")
+
+    # Writes always go to the primary, which doesn't have the replicas' account
+    assert client.put("/accounts/replica-only/deposit", params={"amount": 1}).status_code == 404
+
+
+def test_replica_reads_are_not_cached(replica_client):
+    client, urls = replica_client
+
+    assert client.get("/accounts/replica-only").json()["balance"] == 1.0
+    assert client.post("/accounts/lookup", json={"account_ids": ["replica-only"]}).status_code == 200
+    # A replica may lag the primary, so nothing it returned is served to later reads
+    assert account_cache.get("replica-only") is None
+
+
+def test_read_your_writes_pins_client_to_primary(replica_client):
+    client, urls = replica_client
+
+    account_id = client.post("/accounts", params={"name": "Writer", "starting_balance": 5}).json()["account_id"]
+    assert "sbs_primary_until" in client.cookies
+    assert read_from(client) is None
+    assert client.get(f"/accounts/{account_id}").json()["name"] == "Writer"
+
+    # Once the window is over (here: the cookie is gone), reads go back to the replicas
+    client.cookies.clear()
+    assert read_from(client) in urls
+    client.delete(f"/accounts/{account_id}")
+
+
+def test_replica_that_is_down_is_skipped(replica_client, tmp_path):
+    client, urls = replica_client
+    replicas = sbs.db.read_replicas
+    url = f"sqlite:///{tmp_path / 'missing' / 'replica.db'}"  # Can't be opened
+    is_async = hasattr(replicas.engines[0], "sync_engine")
+    replicas.engines[0] = create_async_engine(async_url(url)) if is_async else create_engine(url)
+
+    assert [read_from(client) for _ in range(4)] == [urls[1]] * 4
+
+    # With no replica left, reads fall back to the primary
+    replicas.mark_down(replicas.engines[1])
+    assert read_from(client) is None
+
+
+
+def test_stats_reconcile_runs_on_the_primary(replica_client, monkeypatch):
+    client, urls = replica_client
+    monkeypatch.setattr("sbs.main.balance_stats._next_reconcile", 0)  # Due now
+
+    assert client.get("/stats").status_code == 200
+    sbs.main.balance_stats._reconciler.submit(lambda: None).result()  # Wait for the scan
+
+    # The replicas' counters were never written, though their account is missing from them
+    for url in urls:
+        replica = create_engine(url)
+        with replica.connect() as conn:
+            assert conn.execute(text("SELECT count(*) FROM account_stats")).scalar_one() == 0
+        replica.dispose()
+    assert sbs.main.balance_stats.reconciled_at is not None
+
+
+def test_coalesced_deposits(client, monkeypatch):
+    """
+    Test that deposits still get their own balance and ledger entry when coalescing is on.
+    """
+    monkeypatch.setattr("sbs.main.deposit_coalescer.window", 0.001)
+    account_id = client.post("/accounts", params={"name": "Hot", "starting_balance": 0}).json()["account_id"]
+
+    for amount in ("1.00", "2.50"):
+        response = client.put(f"/accounts/{account_id}/deposit", params={"amount": amount})
+        assert response.status_code == 200
+    assert response.json() == {"message": "Deposit successful", "balance": 3.5}
+
+    transactions = client.get(f"/accounts/{account_id}/transactions").json()["transactions"]
+    assert [(t["kind"], t["amount"], t["balance"]) for t in transactions[:2]] == [
+        ("deposit", 2.5, 3.5), ("deposit", 1.0, 1.0),
+    ]
+    assert client.put("/accounts/does-not-exist/deposit", params={"amount": 1}).status_code == 404
+    assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+def test_apply_deposits_reports_each_balance():
+    """
+    Test that a coalesced batch is applied with one UPDATE but reports each deposit's own balance.
+    """
+    from sbs.main import _apply_deposits
+
+    with TestingSessionLocal() as db:
+        db.execute(insert(Account), {"account_id": "coalesced", "name": "Hot", "balance_cents": 1000})
+        db.commit()
+        assert _apply_deposits(db, "coalesced", [100, 250, 5]) == [1100, 1350, 1355]
+        assert db.get(Account, "coalesced").balance_cents == 1355
+        db.delete(db.get(Account, "coalesced"))
+        db.commit()
+
+
+def test_search_accounts_by_name(client):
+    """
+    Test prefix and substring search on account names, case-insensitively and page by page.
+    """
+    names = ["Qzx Alice", "qzx alicia", "Bob Qzxalison", "Qzx_Carol"]
+    account_ids = [
+        client.post("/accounts", params={"name": name, "starting_balance": 1}).json()["account_id"] for name in names
+    ]
+
+    response = client.get("/accounts/search", params={"name": "QZX ALI"})
+    assert response.status_code == 200
+    assert [account["name"] for account in response.json()["accounts"]] == ["Qzx Alice", "qzx alicia"]
+    assert response.json()["next_cursor"] is None
+
+    # "_" is matched literally, not as a LIKE wildcard
+    response = client.get("/accounts/search", params={"name": "qzx_"})
+    assert [account["name"] for account in response.json()["accounts"]] == ["Qzx_Carol"]
+
+    params = {"name": "qzxali", "match": "contains", "page_size": 1}
+    response = client.get("/accounts/search", params=params)
+    assert [account["name"] for account in response.json()["accounts"]] == ["Bob Qzxalison"]
+    assert response.json()["next_cursor"] is None
+
+    seen = []
+    params = {"name": "qzx", "match": "contains", "page_size": 3}
+    while True:
+        page = client.get("/accounts/search", params=params).json()
+        seen.extend(account["name"] for account in page["accounts"])
+        if page["next_cursor"] is None:
+            break
+        params["after"] = page["next_cursor"]
+    assert seen == ["Bob Qzxalison", "Qzx Alice", "qzx alicia", "Qzx_Carol"]
+
+    for account_id in account_ids:
+        assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+def test_search_accounts_rejects_short_substrings_and_bad_cursors(client):
+    """
+    Test that substring search needs three characters and that a malformed cursor is a 400.
+    """
+    response = client.get("/accounts/search", params={"name": "ab", "match": "contains"})
+    assert response.status_code == 422
+    response = client.get("/accounts/search", params={"name": "ab", "after": "not-a-cursor"})
+    assert response.status_code == 400
+    assert client.get("/accounts/search", params={"name": ""}).status_code == 422
+
+
+@pytest.mark.parametrize("change", ["adjust", "delete"])
+def test_deposit_racing_an_adjustment_or_delete(monkeypatch, change):
+    """
+    Test that a deposit racing an adjustment or a delete leaves a ledger that adds up to the balance,
+    and GET /stats counters that need no correcting.
+
+    SQLite ignores FOR UPDATE, so the race is staged: the deposit commits between the account's
+    read and the request's write, unless the read locked the row, in which case it waits for the
+    request to commit, as it would on PostgreSQL.
+    """
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+    from sbs import main
+
+    monkeypatch.setattr("sbs.main.engine", engine)
+    account_cache.clear()
+    client = TestClient(app)
+    monkeypatch.setattr("sbs.main.balance_stats._next_reconcile", float("inf"))  # No background scans
+    # Earlier tests wrote some accounts behind the counters' back
+    assert client.post("/stats/reconcile").status_code == 200
+    account_id = client.post("/accounts", params={"name": "Racing", "starting_balance": "100.00"}).json()["account_id"]
+
+    locked = []  # Whether each read of the account locked it
+    racing = []  # Set while the request's write, and not the deposit's own, is still to come
+
+    def record_read(state):
+        if state.is_select and state.statement.column_descriptions[0]["entity"] is Account:
+            locked.append(state.statement._for_update_arg is not None)
+
+    def deposit_racing():
+        with TestingSessionLocal() as other:
+            main._apply_deposits(other, account_id, [5000])
+
+    record_transactions = main._record_transactions
+
+    def write_after_race(db, entries, new_accounts=()):
+        if racing:
+            racing.pop()
+            if not locked[0]:
+                deposit_racing()  # Commits between the request's read and its write
+        record_transactions(db, entries, new_accounts)
+
+    monkeypatch.setattr(main, "_record_transactions", write_after_race)
+    event.listen(Session, "do_orm_execute", record_read)
+    try:
+        racing.append(True)
+        if change == "adjust":
+            response = client.put(f"/accounts/{account_id}", params={"name": "Racing", "balance": "200.00"})
+            assert response.status_code == 200
+        else:
+            assert client.delete(f"/accounts/{account_id}").status_code == 200
+    finally:
+        event.remove(Session, "do_orm_execute", record_read)
+    if locked[0]:  # The deposit waited on the lock, so it lands after the request
+        if change == "adjust":
+            deposit_racing()
+        else:
+            with pytest.raises(HTTPException):
+                deposit_racing()
+    response = client.get(f"/accounts/{account_id}")
+    balance = response.json()["balance"] if response.status_code == 200 else 0.0
+
+    with TestingSessionLocal() as db:
+        ledger = db.execute(
+            text("SELECT sum(amount_cents) FROM transactions WHERE account_id = :id"), {"id": account_id}
+        ).scalar_one()
+    assert ledger == balance * 100
+    # Without the lock, the counters take the account out of the bucket of a balance it no longer has
+    assert client.post("/stats/reconcile").json()["drift"] == []
+    assert locked[0]
+    if change == "adjust":
+        assert balance == 250.0
+        assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+def test_stats_follow_every_balance_change(client, monkeypatch):
+    """
+    Test that GET /stats counters follow creates, deposits, withdrawals, transfers, imports and
+    deletes without drifting from the accounts.
+    """
+    monkeypatch.setattr("sbs.main.balance_stats._next_reconcile", float("inf"))  # No background scans
+    # Earlier tests wrote some accounts behind the counters' back
+    assert client.post("/stats/reconcile").status_code == 200
+    before = client.get("/stats").json()
+
+    first = client.post("/accounts", params={"name": "Stats A", "starting_balance": "50.00"}).json()["account_id"]
+    second = client.post("/accounts", params={"name": "Stats B", "starting_balance": "5.00"}).json()["account_id"]
+    client.put(f"/accounts/{first}/deposit", params={"amount": "100.00"})
+    client.put(f"/accounts/{second}/withdraw", params={"amount": "5.00"})
+    client.put(f"/accounts/{first}/transfer/{second}", params={"amount": "20.00"})
+    third = "5f0c1d2e-stats-import"
+    csv_content = f"account_id,name,balance\n{third},Stats C,2000.00\n{first},Stats A,1.00\n"
+    assert client.post("/load", files={"file": ("file.csv", io.BytesIO(csv_content.encode()))}).status_code == 200
+    assert client.delete(f"/accounts/{second}").status_code == 200
+
+    after = client.get("/stats").json()
+    assert after["accounts"] == before["accounts"] + 2
+    assert after["total_balance"] == before["total_balance"] + 2001
+    assert after["min_balance"] <= 1 and after["max_balance"] >= 2000
+    by_bound = {bucket["le"]: bucket for bucket in after["histogram"]}
+    previous = {bucket["le"]: bucket for bucket in before["histogram"]}
+    assert by_bound[10]["accounts"] == previous[10]["accounts"] + 1  # first, at 1.00
+    assert by_bound[10000]["accounts"] == previous[10000]["accounts"] + 1  # third, at 2000.00
+    assert sum(bucket["accounts"] for bucket in after["histogram"]) == after["accounts"]
+
+    response = client.post("/stats/reconcile")
+    assert response.json()["drift"] == []
+    assert response.json()["reconciled_at"] is not None
+
+    for account_id in (first, third):
+        assert client.delete(f"/accounts/{account_id}").status_code == 200
+
+
+def test_create_account_does_not_read_the_row_back(client):
+    """
+    Test that creating an account runs only its INSERTs, without re-selecting the new row.
+    """
+    _, queries = REQUEST_QUERIES.snapshot(route="/accounts")
+    response = client.post("/accounts", params={"name": "No Refresh", "starting_balance": "12.34"})
+    assert response.status_code == 200
+    assert response.json()["balance"] == 12.34
+
+    # The account, its opening ledger entry and the stats counters
+    assert REQUEST_QUERIES.snapshot(route="/accounts")[1] - queries == 3
+    assert client.get(f"/accounts/{response.json()['account_id']}").json()["name"] == "No Refresh"
+    assert client.delete(f"/accounts/{response.json()['account_id']}").status_code == 200
+
+
+@pytest.mark.parametrize("chunk_size", [None, 2])
+def test_batch_create_accounts(client, chunk_size):
+    """
+    Test that a batch of accounts is created with IDs returned in input order.
+    """
+    accounts = [{"name": f"Batch {i}", "starting_balance": f"{i}.50"} for i in range(5)]
+    params = {"chunk_size": chunk_size} if chunk_size else {}
+    response = client.post("/accounts/batch", params=params, json={"accounts": accounts})
+    assert response.status_code == 200
+    created = response.json()["accounts"]
+    assert [(account["name"], account["balance"]) for account in created] == [
+        (f"Batch {i}", i + 0.5) for i in range(5)
+    ]
+    assert len({account["account_id"] for account in created}) == 5
+
+    for account in created:
+        assert client.get(f"/accounts/{account['account_id']}").json() == account
+        transactions = client.get(f"/accounts/{account['account_id']}/transactions").json()["transactions"]
+        assert [(t["kind"], t["balance"]) for t in transactions] == [("open", account["balance"])]
+        assert client.delete(f"/accounts/{account['account_id']}").status_code == 200
+
+
+def test_batch_create_accounts_failed_chunk(client, monkeypatch):
+    """
+    Test that a chunk that fails is reported with the chunks committed before and after it.
+    """
+    from sqlalchemy.exc import IntegrityError
+    from sbs import main
+
+    insert_accounts = main._insert_accounts
+    calls = []
+
+    def fail_second_chunk(db, rows):
+        calls.append(rows)
+        if len(calls) == 2:
+            raise IntegrityError("INSERT INTO accounts", {}, Exception("duplicate key"))
+        insert_accounts(db, rows)
+
+    monkeypatch.setattr(main, "_insert_accounts", fail_second_chunk)
+    accounts = [{"name": f"Chunked {i}", "starting_balance": "1.00"} for i in range(5)]
+    response = client.post("/accounts/batch", params={"chunk_size": 2}, json={"accounts": accounts})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["message"] == "Batch processed"
+    assert (body["succeeded"], body["failed"]) == (3, 2)
+    assert body["chunks"] == [
+        {"index": 0, "count": 2, "status": "ok"},
+        {"index": 2, "count": 2, "status": "failed", "detail": "duplicate key"},
+        {"index": 4, "count": 1, "status": "ok"},
+    ]
+    assert [account["name"] for account in body["accounts"]] == ["Chunked 0", "Chunked 1", "Chunked 4"]
+
+    # Exactly the accounts reported as created were committed
+    found = client.get("/accounts/search", params={"name": "Chunked"}).json()["accounts"]
+    assert sorted(account["name"] for account in found) == ["Chunked 0", "Chunked 1", "Chunked 4"]
+    for account in body["accounts"]:
+        assert client.delete(f"/accounts/{account['account_id']}").status_code == 200
+
+
+def test_batch_create_accounts_validation(client):
+    """
+    Test that empty batches and sub-cent balances are rejected before anything is created.
+    """
+    assert client.post("/accounts/batch", json={"accounts": []}).status_code == 422
+    response = client.post("/accounts/batch", json={"accounts": [
+        {"name": "Batch Valid", "starting_balance": "1.00"}, {"name": "Batch Sub-cent", "starting_balance": "1.001"},
+    ]})
+    assert response.status_code == 422
+    assert client.get("/accounts/search", params={"name": "Batch Valid"}).json()["accounts"] == []
+
+
+def test_lookup_accounts(client):
+    """
+    Test that several accounts are fetched at once, in request order, with unknown IDs listed apart.
+    """
+    first = client.post("/accounts", params={"name": "Lookup A", "starting_balance": "1.25"}).json()
+    second = client.post("/accounts", params={"name": "Lookup B", "starting_balance": "2.50"}).json()
+    client.get(f"/accounts/{second['account_id']}")  # Cached, so it's served without the query
+
+    response = client.post("/accounts/lookup", json={
+        "account_ids": [second["account_id"], "no-such-account", first["account_id"], second["account_id"]],
+    })
+    assert response.status_code == 200
+    assert response.json() == {"accounts": [second, first], "missing": ["no-such-account"]}
+
+    # The lookup filled the cache for the account it read
+    assert account_cache.get(first["account_id"]) == first
+
+    assert client.post("/accounts/lookup", json={"account_ids": []}).status_code == 422
+    for account in (first, second):
+        assert client.delete(f"/accounts/{account['account_id']}").status_code == 200
+
+
+def test_lookup_accounts_postgresql_statement():
+    """
+    Test that on PostgreSQL the IDs are one array parameter, so any number of them is the same statement.
+    """
+    from sqlalchemy import select
+    from sqlalchemy.dialects import postgresql
+    from sbs.main import _account_id_in
+
+    db = MagicMock()
+    db.get_bind.return_value.dialect.name = "postgresql"
+    stmt = select(Account.account_id).where(_account_id_in(db, ["a", "b", "c"]))
+    compiled = stmt.compile(dialect=postgresql.dialect())
+    assert "accounts.account_id = ANY (%(account_ids)s::VARCHAR[])" in str(compiled)
+    assert compiled.params == {"account_ids": ["a", "b", "c"]}
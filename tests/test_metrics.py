@@ -0,0 +1,55 @@
+import pytest
+
+from sbs.metrics import Registry
+
+
+def test_counter_and_gauge_render():
+    """
+    Test that counters and gauges render one sample per label set.
+    """
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests handled", ["method"])
+    in_use = registry.gauge("in_use", "Things in use")
+    requests.inc(method="GET")
+    requests.inc(2, method="PUT")
+    in_use.inc()
+    in_use.dec()
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests handled",
+        "# TYPE requests_total counter",
+        'requests_total{method="GET"} 1',
+        'requests_total{method="PUT"} 2',
+        "# HELP in_use Things in use",
+        "# TYPE in_use gauge",
+        "in_use 0",
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    """
+    Test that histogram buckets count every observation at or below their bound.
+    """
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        latency.observe(value)
+
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert "latency_seconds_count 4" in lines
+    assert latency.snapshot() == (4, 4.25)
+
+
+def test_metric_labels_must_match():
+    """
+    Test that a sample with the wrong labels is refused, as is a duplicate metric name.
+    """
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests handled", ["method"])
+    with pytest.raises(ValueError):
+        requests.inc(path="/")
+    with pytest.raises(ValueError):
+        registry.counter("requests_total", "Again")
@@ -0,0 +1,29 @@
+from sqlalchemy import create_engine, text
+
+from sbs.migrate_changes import migrate
+
+
+def test_migrate_changes_adds_change_tracking(tmp_path):
+    # The accounts table as it was before GET /save?since=, with its other indexes
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE accounts (account_id VARCHAR PRIMARY KEY, name VARCHAR, balance_cents BIGINT NOT NULL)"
+        ))
+        conn.execute(text("INSERT INTO accounts VALUES ('legacy-1', 'Alice', 100)"))
+        conn.execute(text("CREATE INDEX ix_accounts_balance_cents ON accounts (balance_cents)"))
+        conn.execute(text("CREATE INDEX ix_accounts_lower_name ON accounts (lower(name), account_id)"))
+    done = []
+
+    assert migrate(engine, progress=done.append) == [
+        "accounts.updated_at added", "account_tombstones created", "ix_accounts_updated_at created",
+    ]
+    assert len(done) == 3
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT updated_at FROM accounts")).scalar_one() is None
+        assert conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'ix_accounts_updated_at'"
+        )).scalar_one_or_none() == "ix_accounts_updated_at"
+
+    # Running it again finds nothing to do
+    assert migrate(engine) == []
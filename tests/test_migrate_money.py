@@ -0,0 +1,56 @@
+from sqlalchemy import create_engine, inspect, text
+
+from sbs.migrate_money import migrate
+
+
+def legacy_engine(tmp_path):
+    # The schema as it was with Float balances
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE accounts (account_id VARCHAR PRIMARY KEY, name VARCHAR, balance FLOAT)"))
+        conn.execute(text(
+            "CREATE TABLE transactions (transaction_id INTEGER PRIMARY KEY, account_id VARCHAR NOT NULL, "
+            "kind VARCHAR NOT NULL, amount FLOAT NOT NULL, balance FLOAT NOT NULL, counterparty_id VARCHAR, "
+            "created_at DATETIME NOT NULL)"
+        ))
+        conn.execute(text("INSERT INTO accounts VALUES (:id, :name, :balance)"), [
+            {"id": "a", "name": "A", "balance": 0.1 + 0.2},
+            {"id": "b", "name": "B", "balance": 100.29},
+            {"id": "c", "name": "C", "balance": None},
+        ])
+        conn.execute(text(
+            "INSERT INTO transactions (account_id, kind, amount, balance, created_at) "
+            "VALUES ('b', 'deposit', 0.29, 100.29, '2024-01-01')"
+        ))
+    return engine
+
+
+def test_migrate_money_backfills_in_batches(tmp_path):
+    engine = legacy_engine(tmp_path)
+    batches = []
+
+    backfilled = migrate(engine, batch_size=2, progress=lambda table, rows: batches.append((table, rows)))
+
+    assert backfilled == {"accounts": 3, "transactions": 1}
+    assert batches == [("accounts", 2), ("accounts", 3), ("transactions", 1)]
+    with engine.connect() as conn:
+        balances = dict(conn.execute(text("SELECT account_id, balance_cents FROM accounts")).all())
+        ledger = conn.execute(text("SELECT amount_cents, balance_cents FROM transactions")).one()
+    assert balances == {"a": 30, "b": 10029, "c": 0}
+    assert tuple(ledger) == (29, 10029)
+    assert "balance" not in {column["name"] for column in inspect(engine).get_columns("accounts")}
+
+
+def test_migrate_money_resumes(tmp_path):
+    engine = legacy_engine(tmp_path)
+    with engine.begin() as conn:
+        # An earlier run added the column and backfilled one row before stopping
+        conn.execute(text("ALTER TABLE accounts ADD COLUMN balance_cents BIGINT"))
+        conn.execute(text("UPDATE accounts SET balance_cents = 30 WHERE account_id = 'a'"))
+
+    assert migrate(engine, batch_size=10, keep_float_columns=True) == {"accounts": 2, "transactions": 1}
+    assert "balance" in {column["name"] for column in inspect(engine).get_columns("accounts")}
+
+    # Finishing drops the Float columns; after that there is nothing left to do
+    assert migrate(engine, batch_size=10) == {"accounts": 0, "transactions": 0}
+    assert migrate(engine, batch_size=10) == {}
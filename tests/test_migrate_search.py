@@ -0,0 +1,26 @@
+from sqlalchemy import create_engine, text
+
+from sbs.migrate_search import migrate
+
+
+def test_migrate_search_adds_missing_indexes(tmp_path):
+    # The accounts table as it was before name search
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE accounts (account_id VARCHAR PRIMARY KEY, name VARCHAR, balance_cents BIGINT NOT NULL)"
+        ))
+    built = []
+
+    # The trigram index is PostgreSQL only
+    assert migrate(engine, progress=built.append) == ["ix_accounts_balance_cents", "ix_accounts_lower_name"]
+    assert built == ["ix_accounts_balance_cents", "ix_accounts_lower_name"]
+    with engine.connect() as conn:
+        plan = conn.execute(text(
+            "EXPLAIN QUERY PLAN SELECT account_id FROM accounts "
+            "WHERE lower(name) >= 'ab' AND lower(name) < 'ac' ORDER BY lower(name), account_id"
+        )).all()
+    assert "ix_accounts_lower_name" in plan[0][-1]
+
+    # Running it again finds nothing to do
+    assert migrate(engine) == []
@@ -1,7 +1,7 @@
 import pytest
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sbs.models import Base, Account
+from sbs.models import Base, Account, Transaction
 
 # Create an in-memory SQLite database engine
 engine = create_engine('sqlite:///:memory:')
@@ -56,3 +56,27 @@ def test_account_model(db_session):
     assert retrieved_account.account_id == '123'
     assert retrieved_account.name == 'Test Account'
     assert retrieved_account.balance == 100.0
+
+
+def test_transaction_model(db_session):
+    """
+    Test the Transaction model.
+    """
+    transaction = Transaction(
+        account_id='123',
+        kind='deposit',
+        amount=25.0,
+        balance=125.0,
+    )
+
+    db_session.add(transaction)
+    db_session.commit()
+
+    # The id and timestamp are filled in on insert
+    retrieved_transaction = db_session.query(Transaction).filter_by(account_id='123').first()
+    assert retrieved_transaction.transaction_id is not None
+    assert retrieved_transaction.created_at is not None
+    assert retrieved_transaction.kind == 'deposit'
+    assert retrieved_transaction.amount == 25.0
+    assert retrieved_transaction.balance == 125.0
+    assert retrieved_transaction.counterparty_id is None
@@ -0,0 +1,33 @@
+from decimal import Decimal
+
+import pytest
+
+from sbs.money import format_cents, from_cents, to_cents
+
+
+def test_to_cents():
+    assert to_cents(Decimal("12.34")) == 1234
+    assert to_cents("0.1") == 10
+    assert to_cents(7) == 700
+    # Floats are taken at their shortest repr, not their binary value
+    assert to_cents(0.1) == 10
+    assert to_cents(0.1 + 0.2) == 30
+    assert to_cents(-2.5) == -250
+
+
+def test_to_cents_rounds_half_to_even():
+    assert to_cents("0.125") == 12
+    assert to_cents("0.135") == 14
+
+
+@pytest.mark.parametrize("amount", ["abc", "nan", "inf", "1e30", None])
+def test_to_cents_rejects_invalid_amounts(amount):
+    with pytest.raises(ValueError):
+        to_cents(amount)
+
+
+def test_from_cents():
+    assert from_cents(1234) == Decimal("12.34")
+    assert from_cents(-5) == Decimal("-0.05")
+    assert format_cents(10000) == "100.00"
+    assert format_cents(5) == "0.05"
@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+from sqlalchemy import create_engine, insert, literal_column, select
+from sqlalchemy.exc import OperationalError
+
+from sbs import partitioned
+from sbs.models import Account, Base
+
+
+def make_engine(tmp_path, accounts, filename="partitioned.db"):
+    # A file, so each reader gets a connection of its own
+    engine = create_engine(f"sqlite:///{tmp_path / filename}")
+    Base.metadata.create_all(engine)
+    if accounts:
+        with engine.begin() as conn:
+            conn.execute(insert(Account), [
+                {"account_id": f"acct-{i:04d}", "name": f"Account {i}", "balance_cents": i} for i in range(accounts)
+            ])
+    return engine
+
+
+def test_key_ranges(tmp_path):
+    """
+    Test that the key ranges cover every account once, in about equal parts.
+    """
+    engine = make_engine(tmp_path, 1000)
+    with engine.connect() as conn:
+        ranges = partitioned.key_ranges(conn, Account.account_id, 4)
+        assert ranges == [
+            (None, "acct-0250"), ("acct-0250", "acct-0500"), ("acct-0500", "acct-0750"), ("acct-0750", None),
+        ]
+        assert partitioned.key_ranges(conn, Account.account_id, 1) == [(None, None)]
+
+    # An empty table is a single range
+    engine = make_engine(tmp_path, 0, "empty.db")
+    with engine.connect() as conn:
+        assert partitioned.key_ranges(conn, Account.account_id, 4) == [(None, None)]
+
+
+def test_read(tmp_path):
+    """
+    Test that reading in parallel ranges returns the same rows as one query, in batches of batch_size.
+    """
+    engine = make_engine(tmp_path, 1000)
+    stmt = select(Account.account_id, Account.name, Account.balance_cents)
+    with engine.connect() as conn:
+        expected = sorted(conn.execute(stmt).all())
+
+    batches = list(partitioned.read(engine, stmt, Account.account_id, 4, 30))
+    assert all(len(rows) <= 30 for rows in batches)
+    assert sorted(row for rows in batches for row in rows) == expected
+
+    assert not partitioned.supported(engine)
+
+
+def test_read_errors_and_early_close(tmp_path):
+    """
+    Test that an error in a reader is raised to the consumer, and that closing early stops the readers.
+    """
+    engine = make_engine(tmp_path, 1000)
+    stmt = select(Account.account_id, literal_column("no_such_column"))
+    with pytest.raises(OperationalError):
+        list(partitioned.read(engine, stmt, Account.account_id, 4, 30))
+
+    batches = partitioned.read(engine, select(Account.account_id), Account.account_id, 4, 10)
+    assert len(next(batches)) == 10
+    batches.close()
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith("sbs-export")]
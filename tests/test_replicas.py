@@ -0,0 +1,27 @@
+from sbs.replicas import ReplicaSet
+
+
+def test_replica_set_round_robin():
+    """
+    Test that replicas take turns being tried first.
+    """
+    replicas = ReplicaSet(["a", "b", "c"], retry_interval=60)
+    assert replicas.candidates() == ["a", "b", "c"]
+    assert replicas.candidates() == ["b", "c", "a"]
+    assert replicas.candidates() == ["c", "a", "b"]
+    assert replicas.candidates() == ["a", "b", "c"]
+    assert not ReplicaSet([], retry_interval=60)
+
+
+def test_replica_set_skips_replicas_marked_down(mocker):
+    """
+    Test that a replica marked down is left out until the retry interval has passed.
+    """
+    clock = mocker.patch("sbs.replicas.time.monotonic", return_value=100.0)
+    replicas = ReplicaSet(["a", "b"], retry_interval=5)
+    replicas.mark_down("a")
+
+    assert replicas.candidates() == ["b"]
+    assert replicas.candidates() == ["b"]
+    clock.return_value = 105.0
+    assert replicas.candidates() == ["a", "b"]
@@ -0,0 +1,118 @@
+import gzip
+import io
+
+import pytest
+
+from sbs import snapshot
+from sbs.snapshot import BINARY_MAGIC, CorruptSnapshot, decode_binary, decompress, encoder
+
+ROWS = [
+    ("a-1", "Alice", 10025),
+    ("a-2", None, -5),
+    ("a-3", "Zoë, \"quoted\"\nname", 2 ** 63 - 1),
+]
+
+
+def encode(snapshot_format, batches):
+    chunks = encoder(snapshot_format)
+    return chunks.start() + b"".join(chunks.write(rows) for rows in batches) + chunks.finish()
+
+
+def test_binary_round_trip():
+    """
+    Test that the binary format decodes to the rows written, across blocks, keeping a missing name apart from "".
+    """
+    data = encode("binary", [ROWS[:2], [], ROWS[2:] + [("a-4", "", 0)]])
+    assert data.startswith(BINARY_MAGIC)
+    assert list(decode_binary(io.BytesIO(data))) == ROWS + [("a-4", "", 0)]
+    assert list(decode_binary(io.BytesIO(encode("binary", [])))) == []
+
+
+def test_binary_corrupt():
+    """
+    Test that a binary snapshot that stops following the format raises CorruptSnapshot where it does.
+    """
+    data = encode("binary", [ROWS[:1], ROWS[1:]])
+    with pytest.raises(CorruptSnapshot, match="Not a binary snapshot"):
+        list(decode_binary(io.BytesIO(b"SBSSNAP2" + data[8:])))
+
+    # Truncated, even if only the end block is missing: the rows of whole blocks come first
+    decoded = decode_binary(io.BytesIO(data[:-8]))
+    assert next(decoded) == ROWS[0]
+    with pytest.raises(CorruptSnapshot, match="truncated"):
+        list(decoded)
+
+    # A block whose length doesn't cover its rows
+    block = encoder("binary").write(ROWS[:1])
+    short = (len(block) - 9).to_bytes(4, "little") + block[4:-1]
+    with pytest.raises(CorruptSnapshot, match="Invalid block"):
+        list(decode_binary(io.BytesIO(BINARY_MAGIC + short)))
+
+    too_large = (snapshot.MAX_BLOCK_BYTES + 1).to_bytes(4, "little") + (1).to_bytes(4, "little")
+    with pytest.raises(CorruptSnapshot, match="too large"):
+        list(decode_binary(io.BytesIO(BINARY_MAGIC + too_large)))
+
+
+def test_csv_formats():
+    """
+    Test that the CSV formats write balances in decimal and decompress back to the same CSV.
+    """
+    plain = encode("csv", [ROWS[:2], ROWS[2:]])
+    assert plain.decode().splitlines()[:3] == ["account_id,name,balance", "a-1,Alice,100.25", "a-2,,-0.05"]
+
+    gzipped = encode("csv.gz", [ROWS[:2], ROWS[2:]])
+    assert gzip.decompress(gzipped) == plain
+    assert decompress("csv.gz", io.BytesIO(gzipped)).read() == plain
+    assert decompress("csv", io.BytesIO(plain)).read() == plain
+
+    with pytest.raises(CorruptSnapshot):
+        decompress("csv.gz", io.BytesIO(gzipped[:-10])).read()
+    with pytest.raises(CorruptSnapshot):
+        decompress("csv.gz", io.BytesIO(plain)).read()
+
+
+def test_zstd():
+    """
+    Test that csv.zst decompresses back to the same CSV, and raises CorruptSnapshot on bad data.
+    """
+    pytest.importorskip("zstandard")
+    compressed = encode("csv.zst", [ROWS])
+    assert decompress("csv.zst", io.BytesIO(compressed)).read() == encode("csv", [ROWS])
+    with pytest.raises(CorruptSnapshot):
+        decompress("csv.zst", io.BytesIO(b"not zstd data")).read()
+
+
+def test_arrow_round_trip():
+    """
+    Test that an Arrow IPC stream decodes to the rows written, and that a truncated one raises CorruptSnapshot.
+    """
+    pytest.importorskip("pyarrow")
+    data = encode("arrow", [ROWS[:2], [], ROWS[2:]])
+    assert list(snapshot.decode_arrow(io.BytesIO(data))) == ROWS
+    with pytest.raises(CorruptSnapshot):
+        list(snapshot.decode_arrow(io.BytesIO(data[:len(data) // 2])))
+    with pytest.raises(CorruptSnapshot):
+        list(snapshot.decode_arrow(io.BytesIO(b"not arrow")))
+
+
+def test_require(monkeypatch):
+    """
+    Test that a format whose package is missing is refused with a 400.
+    """
+    from fastapi import HTTPException
+
+    snapshot.require("csv")
+    monkeypatch.setattr(snapshot, "zstandard", None)
+    with pytest.raises(HTTPException) as exc_info:
+        snapshot.require("csv.zst")
+    assert exc_info.value.status_code == 400
+    assert exc_info.value.detail == "format 'csv.zst' needs the zstandard package"
+
+
+def test_csv_delta():
+    """
+    Test that a delta has an op column, with upserts as rows and deletes with no name or balance.
+    """
+    chunks = encoder("csv", delta=True)
+    data = chunks.start() + chunks.write(ROWS[:1]) + chunks.write_deletes(["a-2"]) + chunks.finish()
+    assert data.decode().splitlines() == ["op,account_id,name,balance", "upsert,a-1,Alice,100.25", "delete,a-2,,"]
@@ -0,0 +1,65 @@
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from sbs.models import Account, Base
+from sbs.stats import BALANCE_BUCKETS, BalanceStats, bucket_of
+
+
+def make_session():
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    return Session(bind=engine)
+
+
+def test_bucket_of():
+    """
+    Test that balances land in the first bucket whose upper bound they don't exceed.
+    """
+    assert bucket_of(-5) == 0
+    assert bucket_of(0) == 0
+    assert bucket_of(1) == 1
+    assert bucket_of(10_00) == 1
+    assert bucket_of(10_01) == 2
+    assert bucket_of(10 ** 12) == len(BALANCE_BUCKETS)
+
+
+def test_record_and_read():
+    """
+    Test that recorded changes add up across stripes, moving accounts between buckets.
+    """
+    stats = BalanceStats(stripes=4, reconcile_interval=3600)
+    with make_session() as db:
+        db.add_all([Account(account_id="a", name="A", balance_cents=5_00),
+                    Account(account_id="b", name="B", balance_cents=0)])
+        stats.record(db, [(None, 5_00), (None, 0)])
+        stats.record(db, [(5_00, 500_00)])  # A's deposit moves it up two buckets
+        db.commit()
+        db.execute(update(Account).where(Account.account_id == "a").values(balance_cents=500_00))
+
+        result = stats.read(db)
+
+    assert result["accounts"] == 2
+    assert result["balance_cents"] == 500_00
+    assert (result["min_balance_cents"], result["max_balance_cents"]) == (0, 500_00)
+    counts = {bucket["le"]: bucket["accounts"] for bucket in result["histogram"]}
+    assert counts[0] == 1 and counts[10_00] == 0 and counts[1_000_00] == 1
+    assert len(result["histogram"]) == len(BALANCE_BUCKETS) + 1
+
+
+def test_reconcile_corrects_drift():
+    """
+    Test that a full scan finds accounts the counters missed and corrects them once.
+    """
+    stats = BalanceStats(stripes=4, reconcile_interval=3600)
+    with make_session() as db:
+        db.add(Account(account_id="a", name="A", balance_cents=20_00))
+        stats.record(db, [(None, 20_00)])
+        db.add(Account(account_id="b", name="B", balance_cents=7_00))  # Behind the counters' back
+        db.commit()
+
+        assert stats.reconcile(db) == {1: (1, 7_00)}
+        db.commit()
+        assert stats.read(db)["balance_cents"] == 27_00
+        assert stats.reconcile(db) == {}
+        assert stats.reconciled_at is not None